@@ -37,6 +37,8 @@ static jmethodID 	g_RawMessageCTOR 		= NULL;
 static jfieldID 	g_FieldFDs 				= NULL;
 static jfieldID 	g_FieldMetadata 		= NULL;
 static jfieldID 	g_FieldParams 			= NULL;
+static jfieldID 	g_FieldMetadataBytes 	= NULL;
+static jfieldID 	g_FieldParamsBytes 		= NULL;
 
 static jclass 		g_ClassFileDescriptor 	= NULL;
 static jmethodID 	g_FDCTOR 				= NULL;
@@ -85,6 +87,18 @@ int init_java_accessors( JNIEnv* env )
     if( NULL == g_FieldMetadata )
         return -1;
 
+    g_FieldParamsBytes =
+    		(*env)->GetFieldID( env, g_ClassRawMessage,
+    							"bParams_", "[B");
+    if( NULL == g_FieldParamsBytes )
+        return -1;
+
+    g_FieldMetadataBytes =
+    		(*env)->GetFieldID( env, g_ClassRawMessage,
+    							"bMetadata_", "[B");
+    if( NULL == g_FieldMetadataBytes )
+        return -1;
+
     /*------------------------------------------------------------------------
      * Reflecting java.io.FileDescriptor
      * */
@@ -110,6 +124,19 @@ int init_java_accessors( JNIEnv* env )
 }
 
 
+/*----------------------------------------------------------------------------
+ * set_bytes_field
+ *
+ * Sets a byte[] field of obj to a copy of the buffer
+ * */
+static void set_bytes_field( JNIEnv* env, jobject obj, jfieldID field,
+                             const char* pBuf, int nLen )
+{
+	jbyteArray jBytes = (*env)->NewByteArray( env, nLen );
+	(*env)->SetByteArrayRegion( env, jBytes, 0, nLen, (const jbyte*) pBuf );
+	(*env)->SetObjectField( env, obj, field, jBytes );
+}
+
 /*----------------------------------------------------------------------------
  *
  * */
@@ -288,8 +315,15 @@ Java_com_ibm_storlet_sbus_SBusJNI_receiveRawMessage( 	JNIEnv* env,
 				                       g_RawMessageCTOR );
 
 		// Params is never empty. We have 'command' at least.
-		jstring jstrParams = (*env)->NewStringUTF( env, strParams );
-		(*env)->SetObjectField( env, RawMsgObj, g_FieldParams, jstrParams );
+		// The binary framing starts with a NUL byte, and is passed as bytes
+		if( 0 < nParamsLen && '\0' == strParams[0] )
+			set_bytes_field( env, RawMsgObj, g_FieldParamsBytes,
+			                 strParams, nParamsLen );
+		else {
+			jstring jstrParams = (*env)->NewStringUTF( env, strParams );
+			(*env)->SetObjectField( env, RawMsgObj, g_FieldParams,
+			                        jstrParams );
+		}
 
 		if( 0 < nFiles )
 		{
@@ -317,11 +351,16 @@ Java_com_ibm_storlet_sbus_SBusJNI_receiveRawMessage( 	JNIEnv* env,
 			// Assign obtained object
 			(*env)->SetObjectField(env,RawMsgObj, g_FieldFDs, jFileDscrArr );
 
-			jstring jstrMetadata = (*env)->NewStringUTF(env, strMetadata );
-			(*env)->SetObjectField( env,
-					                RawMsgObj,
-					                g_FieldMetadata,
-					                jstrMetadata );
+			if( 0 < nMetadataLen && '\0' == strMetadata[0] )
+				set_bytes_field( env, RawMsgObj, g_FieldMetadataBytes,
+				                 strMetadata, nMetadataLen );
+			else {
+				jstring jstrMetadata = (*env)->NewStringUTF(env, strMetadata );
+				(*env)->SetObjectField( env,
+						                RawMsgObj,
+						                g_FieldMetadata,
+						                jstrMetadata );
+			}
 		}
 		syslog(LOG_DEBUG, "receiveRawMessage: %d files", nFiles );
 
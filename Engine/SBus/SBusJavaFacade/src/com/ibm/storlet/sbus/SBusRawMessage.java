@@ -46,6 +46,11 @@ public class SBusRawMessage {
 	// for storlet execution
 	private String strParams_;
 
+	// The above, when received with the binary framing. The JNI layer sets
+	// these instead of the strings.
+	private byte[] bMetadata_;
+	private byte[] bParams_;
+
 	/*------------------------------------------------------------------------
 	 * Default CTOR
 	 * */
@@ -53,6 +58,8 @@ public class SBusRawMessage {
 		hFiles_ = null;
 		strMetadata_ = null;
 		strParams_ = null;
+		bMetadata_ = null;
+		bParams_ = null;
 	}
 
 	/*------------------------------------------------------------------------
@@ -81,5 +88,13 @@ public class SBusRawMessage {
 	public void setParams(String strParams) {
 		this.strParams_ = strParams;
 	}
+
+	public byte[] getMetadataBytes() {
+		return bMetadata_;
+	}
+
+	public byte[] getParamsBytes() {
+		return bParams_;
+	}
 }
 /* ============================== END OF FILE =============================== */
@@ -29,6 +29,9 @@
 package com.ibm.storlet.sbus;
 
 import java.io.FileDescriptor;
+import java.nio.BufferUnderflowException;
+import java.nio.ByteBuffer;
+import java.nio.charset.Charset;
 import java.util.ArrayList;
 import java.util.Iterator;
 import java.util.HashMap;
@@ -50,6 +53,22 @@ public class ServerSBusInDatagram {
 	private HashMap<String, HashMap<String, String>>[] metadata;
 	private String taskID;
 
+	/*
+	 * The binary framing, see SBusPythonFacade.SBusDatagram for its
+	 * description.
+	 */
+	private static final byte BINARY_MARKER = 0;
+	private static final byte BINARY_VERSION = 1;
+	private static final Charset UTF8 = Charset.forName("UTF-8");
+	// Shared with SBusPythonFacade.SBusDatagram.SBUS_INTERNED_STRINGS
+	private static final String[] INTERNED_STRINGS = {
+		"storlets", "storage", "type", "start", "end",
+		"SBUS_FD_INPUT_OBJECT", "SBUS_FD_OUTPUT_OBJECT",
+		"SBUS_FD_OUTPUT_OBJECT_METADATA",
+		"SBUS_FD_OUTPUT_OBJECT_AND_METADATA", "SBUS_FD_LOGGER",
+		"SBUS_FD_OUTPUT_CONTAINER", "SBUS_FD_OUTPUT_TASK_ID",
+		"SBUS_FD_SERVICE_OUT" };
+
 	private void populateMetadata(HashMap<String, String> dest, JSONObject source) throws ParseException {
 		for (Object key : source.keySet()) {
 			String strKey = (String)key;
@@ -90,6 +109,8 @@ public class ServerSBusInDatagram {
 	 *     ...
 	 * ]
 	 * All the values in the above JSON elemens are strings.
+	 * The same structures may come with the binary framing instead of
+	 * JSON, in which case the raw message has them as bytes.
 	 * Once constructed the class provides all necessary accessors to the parsed
 	 * fields.
 	 * @param msg	the raw mwssage consisting of the string encoded json formats
@@ -100,6 +121,19 @@ public class ServerSBusInDatagram {
 		this.fds = msg.getFiles();
                 numFDs = this.fds == null ? 0 : this.fds.length;
 
+		if (msg.getParamsBytes() != null) {
+			try {
+				parseBinary(msg.getParamsBytes(), msg.getMetadataBytes());
+			} catch (BufferUnderflowException e) {
+				throw new ParseException(ParseException.ERROR_UNEXPECTED_EXCEPTION, e);
+			} catch (IndexOutOfBoundsException e) {
+				throw new ParseException(ParseException.ERROR_UNEXPECTED_EXCEPTION, e);
+			} catch (NegativeArraySizeException e) {
+				throw new ParseException(ParseException.ERROR_UNEXPECTED_EXCEPTION, e);
+			}
+			return;
+		}
+
 		JSONObject jsonCmdParams = (JSONObject)(new JSONParser().parse(msg.getParams()));
 		this.command = (String)jsonCmdParams.get("command");
 		this.params = new HashMap<String, String>();
@@ -136,6 +170,74 @@ public class ServerSBusInDatagram {
 		}
 	}
 
+	private static ByteBuffer binaryBuffer(final byte[] data) throws ParseException {
+		ByteBuffer buffer = ByteBuffer.wrap(data);
+		if (buffer.get() != BINARY_MARKER || buffer.get() != BINARY_VERSION)
+			throw new ParseException(ParseException.ERROR_UNEXPECTED_TOKEN,
+					"Unsupported framing");
+		return buffer;
+	}
+
+	/*
+	 * Strings are returned as such, other values as their JSON encoding
+	 */
+	private static String readToken(final ByteBuffer buffer) throws ParseException {
+		byte tag = buffer.get();
+		switch (tag) {
+		case 'N':
+			return null;
+		case 'I':
+			return INTERNED_STRINGS[buffer.get() & 0xff];
+		case 'S':
+		case 'J':
+			byte[] bytes = new byte[buffer.getInt()];
+			buffer.get(bytes);
+			return new String(bytes, UTF8);
+		default:
+			throw new ParseException(ParseException.ERROR_UNEXPECTED_TOKEN,
+					"Unknown token tag " + tag);
+		}
+	}
+
+	private static void readDict(final ByteBuffer buffer, HashMap<String, String> dest)
+			throws ParseException {
+		int n = buffer.getInt();
+		for (int i = 0; i < n; i++) {
+			String key = readToken(buffer);
+			dest.put(key, readToken(buffer));
+		}
+	}
+
+	private void parseBinary(final byte[] paramsData, final byte[] mdData)
+			throws ParseException {
+		ByteBuffer buffer = binaryBuffer(paramsData);
+		this.command = readToken(buffer);
+		this.taskID = readToken(buffer);
+		this.params = new HashMap<String, String>();
+		readDict(buffer, this.params);
+
+		this.metadata = (HashMap<String, HashMap<String, String>>[])new HashMap[getNFiles()];
+		if (mdData == null)
+			return;
+		buffer = binaryBuffer(mdData);
+		int n = buffer.getInt();
+		for (int i = 0; i < n; i++) {
+			this.metadata[i] = new HashMap<String, HashMap<String, String>>();
+			this.metadata[i].put("storage", new HashMap<String, String>());
+			this.metadata[i].put("storlets", new HashMap<String, String>());
+			int nSections = buffer.getInt();
+			for (int j = 0; j < nSections; j++) {
+				String section = readToken(buffer);
+				HashMap<String, String> values = this.metadata[i].get(section);
+				if (values == null) {
+					values = new HashMap<String, String>();
+					this.metadata[i].put(section, values);
+				}
+				readDict(buffer, values);
+			}
+		}
+	}
+
 	public FileDescriptor[] getFiles() {
                 return fds;
         }
@@ -20,6 +20,12 @@ from ctypes import c_char_p
 from ctypes import c_int
 from ctypes import POINTER
 
+try:
+    import _sbus
+except ImportError:
+    # The native facade is not built, the C-library is used through ctypes
+    _sbus = None
+
 
 class SBus(object):
     '''@summary: This class wraps low level C-API for SBus functionality
@@ -27,59 +33,135 @@ class SBus(object):
     '''
     SBUS_SO_NAME = '/usr/local/lib/python2.7/dist-packages/sbus.so'
 
-    def __init__(self):
+    # Whether to use the native facade, when available, rather than ctypes
+    USE_NATIVE = True
+
+    # The loaded C-library is shared by all the SBus instances in a process
+    _sbus_back = None
+
+    @classmethod
+    def _get_backend(cls):
+        """
+        Load the C-library and register the argument types, once per process
+        """
+        if cls._sbus_back is not None:
+            return cls._sbus_back
+
         # load the C-library
-        self.sbus_back_ = ctypes.CDLL(SBus.SBUS_SO_NAME)
+        sbus_back_ = ctypes.CDLL(cls.SBUS_SO_NAME)
 
         # create SBus
-        self.sbus_back_.sbus_create.argtypes = [c_char_p]
-        self.sbus_back_.sbus_create.restype = c_int
+        sbus_back_.sbus_create.argtypes = [c_char_p]
+        sbus_back_.sbus_create.restype = c_int
 
         # listen to SBus
-        self.sbus_back_.sbus_listen.argtypes = [c_int]
-        self.sbus_back_.sbus_listen.restype = c_int
+        sbus_back_.sbus_listen.argtypes = [c_int]
+        sbus_back_.sbus_listen.restype = c_int
 
         # send message
-        self.sbus_back_.sbus_send_msg.argtypes = [c_char_p,
+        sbus_back_.sbus_send_msg.argtypes = [c_char_p,
+                                             POINTER(c_int),
+                                             c_int,
+                                             c_char_p,
+                                             c_int,
+                                             c_char_p,
+                                             c_int]
+        sbus_back_.sbus_send_msg.restype = c_int
+
+        # connect to SBus
+        sbus_back_.sbus_connect.argtypes = [c_char_p]
+        sbus_back_.sbus_connect.restype = c_int
+
+        # send message through a connected socket
+        sbus_back_.sbus_send_msg_sock.argtypes = [c_int,
                                                   POINTER(c_int),
                                                   c_int,
                                                   c_char_p,
                                                   c_int,
                                                   c_char_p,
                                                   c_int]
-        self.sbus_back_.sbus_send_msg.restype = c_int
+        sbus_back_.sbus_send_msg_sock.restype = c_int
 
         # receive message
-        self.sbus_back_.sbus_recv_msg.argtypes = [c_int,
-                                                  POINTER(POINTER(c_int)),
-                                                  POINTER(c_int),
-                                                  POINTER(c_char_p),
-                                                  POINTER(c_int),
-                                                  POINTER(c_char_p),
-                                                  POINTER(c_int)]
-        self.sbus_back_.sbus_recv_msg.restype = c_int
+        sbus_back_.sbus_recv_msg.argtypes = [c_int,
+                                             POINTER(POINTER(c_int)),
+                                             POINTER(c_int),
+                                             POINTER(c_char_p),
+                                             POINTER(c_int),
+                                             POINTER(c_char_p),
+                                             POINTER(c_int)]
+        sbus_back_.sbus_recv_msg.restype = c_int
 
-    @staticmethod
-    def start_logger(str_log_level='DEBUG', container_id=None):
-        # load the C-library
-        sbus_back_ = ctypes.CDLL(SBus.SBUS_SO_NAME)
+        # wait on several SBus
+        sbus_back_.sbus_poll_create.argtypes = []
+        sbus_back_.sbus_poll_create.restype = c_int
+        sbus_back_.sbus_poll_add.argtypes = [c_int, c_int]
+        sbus_back_.sbus_poll_add.restype = c_int
+        sbus_back_.sbus_poll_remove.argtypes = [c_int, c_int]
+        sbus_back_.sbus_poll_remove.restype = c_int
+        sbus_back_.sbus_poll_wait.argtypes = [c_int,
+                                              POINTER(c_int),
+                                              c_int,
+                                              c_int]
+        sbus_back_.sbus_poll_wait.restype = c_int
+        sbus_back_.sbus_poll_close.argtypes = [c_int]
+        sbus_back_.sbus_poll_close.restype = c_int
 
         sbus_back_.sbus_start_logger.argtypes = [c_char_p, c_char_p]
+
+        cls._sbus_back = sbus_back_
+        return sbus_back_
+
+    @classmethod
+    def _get_native(cls):
+        """
+        :returns: the native facade module, or None to use ctypes
+        """
+        if cls.USE_NATIVE:
+            return _sbus
+        return None
+
+    def __init__(self):
+        self.native_ = SBus._get_native()
+        if self.native_ is None:
+            self.sbus_back_ = SBus._get_backend()
+
+    @staticmethod
+    def start_logger(str_log_level='DEBUG', container_id=None):
+        native = SBus._get_native()
+        if native is not None:
+            native.start_logger(str_log_level, container_id)
+            return
+        sbus_back_ = SBus._get_backend()
         sbus_back_.sbus_start_logger(str_log_level, container_id)
 
     @staticmethod
     def stop_logger():
-        # load the C-library
-        sbus_back_ = ctypes.CDLL(SBus.SBUS_SO_NAME)
+        native = SBus._get_native()
+        if native is not None:
+            native.stop_logger()
+            return
+        sbus_back_ = SBus._get_backend()
         sbus_back_.sbus_stop_logger()
 
     def create(self, sbus_name):
+        if self.native_ is not None:
+            return self.native_.create(sbus_name)
         return self.sbus_back_.sbus_create(sbus_name)
 
     def listen(self, sbus_handler):
+        if self.native_ is not None:
+            return self.native_.listen(sbus_handler)
         return self.sbus_back_.sbus_listen(sbus_handler)
 
     def receive(self, sbus_handler):
+        if self.native_ is not None:
+            res = self.native_.recv(sbus_handler)
+            if res is None:
+                return None
+            h_files, str_metadata, str_params = res
+            return ServerSBusInDatagram(h_files, str_metadata, str_params)
+
         ph_files = POINTER(c_int)()
         pp_metadata = (c_char_p)()
         pp_params = (c_char_p)()
@@ -107,24 +189,27 @@ class SBus(object):
         for i in xrange(n_files):
             h_files.append(ph_files[i])
 
-        # Extract Python strings
+        # Extract Python strings. The binary framing has NUL bytes, so
+        # that the strings are read according to their lengths.
         n_metadata = pn_metadata.value
-        str_metadata = pp_metadata.value
-        n_params = pn_params.value
-        str_params = pp_params.value
-
-        # Trim the junk out
+        str_metadata = None
         if 0 < n_metadata:
-            str_metadata = str_metadata[0:n_metadata]
-        str_params = str_params[0:n_params]
+            str_metadata = ctypes.string_at(pp_metadata, n_metadata)
+        n_params = pn_params.value
+        str_params = ctypes.string_at(pp_params, n_params)
 
         # Construct actual result datagram
         result_dtg = ServerSBusInDatagram(h_files, str_metadata, str_params)
         return result_dtg
 
     @staticmethod
-    def send(sbus_name, datagram):
-        # Serialize the datagram into JSON strings and C integer array
+    def _marshal(datagram):
+        """
+        Serialize the datagram into JSON strings and C integer array
+
+        :param datagram: ClientSBusOutDatagram instance
+        :returns: the arguments of sbus_send_msg following the SBus path
+        """
         str_json_params = datagram.serialized_cmd_params
         p_params = c_char_p(str_json_params)
         n_params = c_int(len(str_json_params))
@@ -148,13 +233,124 @@ class SBus(object):
             for i in xrange(n_fds):
                 h_files[i] = file_fds[i]
 
+        return (h_files, n_files, p_metadata, n_metadata, p_params, n_params)
+
+    @staticmethod
+    def _native_args(datagram):
+        """
+        :param datagram: ClientSBusOutDatagram instance
+        :returns: the fds, metadata and parameters arguments of the native
+                  send functions
+        """
+        if datagram.num_fds > 0:
+            return (datagram.fds, datagram.serialized_md,
+                    datagram.serialized_cmd_params)
+        return [], None, datagram.serialized_cmd_params
+
+    @staticmethod
+    def send(sbus_name, datagram):
+        native = SBus._get_native()
+        if native is not None:
+            return native.send(sbus_name, *SBus._native_args(datagram))
         # Invoke C function
-        sbus = SBus()
-        n_status = sbus.sbus_back_.sbus_send_msg(sbus_name,
-                                                 h_files,
-                                                 n_files,
-                                                 p_metadata,
-                                                 n_metadata,
-                                                 p_params,
-                                                 n_params)
+        sbus_back_ = SBus._get_backend()
+        n_status = sbus_back_.sbus_send_msg(sbus_name,
+                                            *SBus._marshal(datagram))
+        return n_status
+
+    @staticmethod
+    def connect(sbus_name):
+        """
+        Create a socket connected to the SBus, to be used with send_on
+
+        :param sbus_name: path to the SBus
+        :returns: socket descriptor, or a negative value on failure
+        """
+        native = SBus._get_native()
+        if native is not None:
+            return native.connect(sbus_name)
+        sbus_back_ = SBus._get_backend()
+        return sbus_back_.sbus_connect(sbus_name)
+
+    @staticmethod
+    def send_on(sock, datagram):
+        """
+        Send the datagram through a socket created by connect
+
+        :param sock: socket descriptor returned by connect
+        :param datagram: ClientSBusOutDatagram instance
+        :returns: the sendmsg status, negative on failure
+        """
+        native = SBus._get_native()
+        if native is not None:
+            return native.send_on(sock, *SBus._native_args(datagram))
+        sbus_back_ = SBus._get_backend()
+        n_status = sbus_back_.sbus_send_msg_sock(sock,
+                                                 *SBus._marshal(datagram))
         return n_status
+
+
+class SBusPoller(object):
+    '''@summary: Waits on several SBus at once, with a timeout, so that
+       one process may serve several channels
+    '''
+    # Maximum number of ready SBus returned by a single wait
+    MAX_EVENTS = 64
+
+    def __init__(self):
+        self.native_ = SBus._get_native()
+        if self.native_ is None:
+            self.sbus_back_ = SBus._get_backend()
+        self.poll_ = -1
+
+    def create(self):
+        """
+        :returns: the poll handle, or a negative value on failure
+        """
+        if self.native_ is not None:
+            self.poll_ = self.native_.poll_create()
+        else:
+            self.poll_ = self.sbus_back_.sbus_poll_create()
+        return self.poll_
+
+    def add(self, sbus_handler):
+        """
+        :param sbus_handler: SBus handle returned by SBus.create
+        :returns: 0 on success, negative on failure
+        """
+        if self.native_ is not None:
+            return self.native_.poll_add(self.poll_, sbus_handler)
+        return self.sbus_back_.sbus_poll_add(self.poll_, sbus_handler)
+
+    def remove(self, sbus_handler):
+        if self.native_ is not None:
+            return self.native_.poll_remove(self.poll_, sbus_handler)
+        return self.sbus_back_.sbus_poll_remove(self.poll_, sbus_handler)
+
+    def wait(self, timeout=None):
+        """
+        Wait until some of the SBus have messages to receive
+
+        :param timeout: timeout in seconds, None to wait forever
+        :returns: list of the ready SBus handles, empty on timeout or when
+                  interrupted by a signal, None on failure
+        """
+        timeout_ms = -1 if timeout is None else int(timeout * 1000)
+        if self.native_ is not None:
+            return self.native_.poll_wait(self.poll_, timeout_ms)
+
+        h_ready = (c_int * self.MAX_EVENTS)()
+        n_ready = self.sbus_back_.sbus_poll_wait(self.poll_, h_ready,
+                                                 self.MAX_EVENTS, timeout_ms)
+        if n_ready < 0:
+            return None
+        return [h_ready[i] for i in xrange(n_ready)]
+
+    def close(self):
+        if self.poll_ < 0:
+            return
+        if self.native_ is not None:
+            self.native_.poll_close(self.poll_)
+        else:
+            self.sbus_back_.sbus_poll_close(self.poll_)
+        self.poll_ = -1
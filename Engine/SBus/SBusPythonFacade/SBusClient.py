@@ -0,0 +1,245 @@
+# Copyright (c) 2015, 2016 OpenStack Foundation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from contextlib import contextmanager
+
+from SBus import SBus
+from SBusDatagram import ClientSBusOutDatagram, SBusServiceReply, \
+    SBUS_FRAMING_BINARY, SBUS_FRAMING_JSON
+
+
+class SBusClient(object):
+    """Long-lived client side of SBus.
+
+    Sending a command over SBus requires a datagram socket, and service
+    commands also require a pipe the server side writes its reply to.
+    SBusClient keeps both around between commands:
+    - one pool of connected sockets per SBus path
+    - one pool of reply pipes
+    so that a busy client does not create them again for every command.
+
+    The stats dictionary counts how many sockets and pipes were created
+    and how many were reused.
+    """
+
+    # Service replies are usually short and written at once, so that a
+    # single read of this size retrieves the whole reply
+    REPLY_SIZE = 4096
+
+    def __init__(self, max_idle=8, max_framing=SBUS_FRAMING_JSON):
+        """
+        :param max_idle: maximum number of idle sockets kept per SBus path,
+                         and of idle reply pipes
+        :param max_framing: highest datagram framing to use, when the server
+                            side supports it
+        """
+        self.max_idle = max_idle
+        self.max_framing = max_framing
+        self._sockets = {}
+        self._pipes = []
+        # Whether the server side at each path replies with structured
+        # replies, and thus supports batches
+        self._structured = {}
+        # Highest datagram framing advertised by the server side at each
+        # path
+        self._framing = {}
+        self.stats = {'sockets_created': 0, 'sockets_reused': 0,
+                      'pipes_created': 0, 'pipes_reused': 0}
+        # Once closed, the sockets and pipes still in use are closed rather
+        # than kept when released
+        self.closed = False
+
+    def _get_socket(self, path):
+        idle = self._sockets.get(path)
+        if idle:
+            self.stats['sockets_reused'] += 1
+            return idle.pop(), True
+
+        sock = SBus.connect(path)
+        if sock >= 0:
+            self.stats['sockets_created'] += 1
+        return sock, False
+
+    def _put_socket(self, path, sock):
+        idle = self._sockets.setdefault(path, [])
+        if not self.closed and len(idle) < self.max_idle:
+            idle.append(sock)
+        else:
+            os.close(sock)
+
+    def send(self, path, datagram):
+        """
+        Send a datagram to the SBus at path
+
+        :param path: path to the SBus
+        :param datagram: ClientSBusOutDatagram instance
+        :returns: the send status, negative on failure
+        """
+        sock, reused = self._get_socket(path)
+        if sock < 0:
+            return sock
+
+        rc = SBus.send_on(sock, datagram)
+        if rc < 0:
+            # The server side may have been restarted since the socket
+            # was connected. Retry once on a fresh socket.
+            os.close(sock)
+            if not reused:
+                return rc
+            sock, _ = self._get_socket_fresh(path)
+            if sock < 0:
+                return sock
+            rc = SBus.send_on(sock, datagram)
+            if rc < 0:
+                os.close(sock)
+                return rc
+
+        self._put_socket(path, sock)
+        return rc
+
+    def _get_socket_fresh(self, path):
+        # Drop the other idle sockets to the same path, as they were
+        # connected to the same (gone) server side
+        self._structured.pop(path, None)
+        self._framing.pop(path, None)
+        for sock in self._sockets.pop(path, []):
+            os.close(sock)
+        return self._get_socket(path)
+
+    @contextmanager
+    def reply_pipe(self):
+        """
+        Context manager providing a (read_fd, write_fd) pipe
+
+        The pipe goes back to the pool when the block completes, and is
+        closed if the block raises, as a reply may still be pending on it.
+        """
+        if self._pipes:
+            read_fd, write_fd = self._pipes.pop()
+            self.stats['pipes_reused'] += 1
+        else:
+            read_fd, write_fd = os.pipe()
+            self.stats['pipes_created'] += 1
+
+        try:
+            yield read_fd, write_fd
+        except BaseException:
+            # Also covers eventlet Timeout, which interrupts a pending read
+            os.close(read_fd)
+            os.close(write_fd)
+            raise
+
+        if not self.closed and len(self._pipes) < self.max_idle:
+            self._pipes.append((read_fd, write_fd))
+        else:
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def _read_reply(self, read_fd):
+        str_reply = os.read(read_fd, self.REPLY_SIZE)
+        while str_reply and not SBusServiceReply.is_complete(str_reply):
+            chunk = os.read(read_fd, self.REPLY_SIZE)
+            if not chunk:
+                break
+            str_reply += chunk
+        try:
+            return SBusServiceReply.parse(str_reply)
+        except ValueError:
+            return SBusServiceReply(False, 'Malformed reply: %s' % str_reply,
+                                    legacy=True)
+
+    def _send_and_read(self, path, dtg, read_fd):
+        rc = self.send(path, dtg)
+        if rc < 0:
+            return None
+        reply = self._read_reply(read_fd)
+        self._structured[path] = not reply.legacy
+        self._framing[path] = reply.framing or SBUS_FRAMING_JSON
+        return reply
+
+    def get_framing(self, path):
+        """
+        Get the datagram framing to use with the server side at path
+
+        :param path: path to the SBus
+        :returns: the highest framing advertised by the server side in its
+                  replies, up to max_framing, SBUS_FRAMING_JSON until then
+        """
+        return min(self._framing.get(path, SBUS_FRAMING_JSON),
+                   self.max_framing, SBUS_FRAMING_BINARY)
+
+    def call(self, path, command, params=None, task_id=None):
+        """
+        Send a service command and wait for its reply
+
+        :param path: path to the SBus
+        :param command: the command to send
+        :param params: optional dictionary of command parameters
+        :param task_id: optional task id
+        :returns: SBusServiceReply instance, or None when the command failed
+                  to send
+        """
+        with self.reply_pipe() as (read_fd, write_fd):
+            dtg = ClientSBusOutDatagram.create_service_datagram(
+                command, write_fd, params, task_id, self.get_framing(path))
+            return self._send_and_read(path, dtg, read_fd)
+
+    def call_batch(self, path, commands):
+        """
+        Send several service commands at once, and wait for their replies
+
+        The commands are sent one by one until the server side is known to
+        support batches, that is until it sent a structured reply.
+
+        :param path: path to the SBus
+        :param commands: list of (command, params) tuples
+        :returns: list of SBusServiceReply instances, one per command, or
+                  None when the commands failed to send
+        """
+        if not self._structured.get(path):
+            replies = []
+            for command, params in commands:
+                reply = self.call(path, command, params)
+                if reply is None:
+                    return None
+                replies.append(reply)
+            return replies
+
+        with self.reply_pipe() as (read_fd, write_fd):
+            dtg = ClientSBusOutDatagram.create_batch_datagram(
+                commands, write_fd, self.get_framing(path))
+            reply = self._send_and_read(path, dtg, read_fd)
+        if reply is None:
+            return None
+        if reply.replies is None or len(reply.replies) != len(commands):
+            # e.g. the server side does not support batches
+            return [SBusServiceReply(False, reply.message)
+                    for _ in commands]
+        return reply.replies
+
+    def close(self):
+        """
+        Close all the idle sockets and pipes, and the ones in use once they
+        are released
+        """
+        self.closed = True
+        for path in self._sockets.keys():
+            for sock in self._sockets.pop(path):
+                os.close(sock)
+        while self._pipes:
+            read_fd, write_fd = self._pipes.pop()
+            os.close(read_fd)
+            os.close(write_fd)
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import json
+import struct
 
 # Designating the host side as the client side and the storlet side
 # as the server side, the IPC between the client and server requires
@@ -26,8 +27,188 @@ import json
 # ClientSBusOutDatagram - Serializing client commands
 # ServerSBusInDatagram - De-serializing client commands
 # ClientSBusInDatagram - De-srializing server response
+# The replies of the service commands, written to the service out fd,
+# are (de-)serialized by SBusServiceReply on both sides.
 
-from SBusFileDescription import SBUS_FD_SERVICE_OUT
+from SBusFileDescription import SBUS_FD_INPUT_OBJECT, SBUS_FD_LOGGER, \
+    SBUS_FD_OUTPUT_CONTAINER, SBUS_FD_OUTPUT_OBJECT, \
+    SBUS_FD_OUTPUT_OBJECT_AND_METADATA, SBUS_FD_OUTPUT_OBJECT_METADATA, \
+    SBUS_FD_OUTPUT_TASK_ID, SBUS_FD_SERVICE_OUT
+from SBusStorletCommand import SBUS_CMD_BATCH
+
+# The command parameters and the fds metadata are framed either as JSON
+# strings, or with the binary framing below. The server side advertises
+# the highest framing it supports in its service replies, and the client
+# side uses JSON until then.
+SBUS_FRAMING_JSON = 0
+SBUS_FRAMING_BINARY = 1
+
+# Binary framing, version SBUS_FRAMING_BINARY, with big endian integers:
+# body     := '\x00' version payload
+# params   := token(command) token(task_id) dict(params)
+# metadata := u32(number of fds) { u32(number of sections)
+#                                  { token(section name) dict }* }*
+# dict     := u32(number of items) { token(key) token(value) }*
+# token    := 'N'                          None
+#           | 'S' u32(length) utf-8 bytes  string
+#           | 'I' u8(index)                SBUS_INTERNED_STRINGS[index]
+#           | 'J' u32(length) JSON         any other value
+# The leading NUL byte never starts a JSON document, so that the receiver
+# tells both framings apart.
+_BINARY_MARKER = '\x00'
+
+# Strings sent as an index by the binary framing. This table is shared with
+# SBusJavaFacade.ServerSBusInDatagram: only ever append to it.
+SBUS_INTERNED_STRINGS = [
+    'storlets', 'storage', 'type', 'start', 'end',
+    SBUS_FD_INPUT_OBJECT, SBUS_FD_OUTPUT_OBJECT,
+    SBUS_FD_OUTPUT_OBJECT_METADATA, SBUS_FD_OUTPUT_OBJECT_AND_METADATA,
+    SBUS_FD_LOGGER, SBUS_FD_OUTPUT_CONTAINER, SBUS_FD_OUTPUT_TASK_ID,
+    SBUS_FD_SERVICE_OUT]
+# Encoded and decoded interned strings. Decoded strings are unicode, as
+# with JSON.
+_INTERNED_ENCODED = dict((string, 'I' + chr(index)) for index, string
+                         in enumerate(SBUS_INTERNED_STRINGS))
+_INTERNED_DECODED = [unicode(string) for string in SBUS_INTERNED_STRINGS]
+
+_U32 = struct.Struct('>I')
+_pack_u32 = _U32.pack
+_unpack_u32 = _U32.unpack_from
+
+
+def _encode_token(value):
+    if isinstance(value, basestring):
+        encoded = _INTERNED_ENCODED.get(value)
+        if encoded is not None:
+            return encoded
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return 'S' + _pack_u32(len(value)) + value
+    if value is None:
+        return 'N'
+    value = json.dumps(value)
+    return 'J' + _pack_u32(len(value)) + value
+
+
+def _encode_dict(parts, values):
+    parts.append(_pack_u32(len(values)))
+    parts.extend(_encode_token(key) + _encode_token(value)
+                 for key, value in values.iteritems())
+
+
+def encode_binary_params(command, params, task_id):
+    """
+    Frame the command parameters with the binary framing
+
+    :param command: the command
+    :param params: dictionary of command parameters, or None
+    :param task_id: the task id, or None
+    :returns: the framed parameters
+    """
+    parts = [_BINARY_MARKER, chr(SBUS_FRAMING_BINARY),
+             _encode_token(command), _encode_token(task_id)]
+    _encode_dict(parts, params or {})
+    return ''.join(parts)
+
+
+def encode_binary_md(md):
+    """
+    Frame the fds metadata with the binary framing
+
+    :param md: list of dictionaries of sections, one per fd
+    :returns: the framed metadata
+    """
+    parts = [_BINARY_MARKER, chr(SBUS_FRAMING_BINARY), _pack_u32(len(md))]
+    for fd_md in md:
+        parts.append(_pack_u32(len(fd_md)))
+        for section, values in fd_md.iteritems():
+            parts.append(_encode_token(section))
+            _encode_dict(parts, values)
+    return ''.join(parts)
+
+
+def _decode_token(data, pos):
+    """
+    :returns: (value, position after the token) tuple
+    """
+    tag = data[pos]
+    if tag == 'I':
+        return _INTERNED_DECODED[ord(data[pos + 1])], pos + 2
+    if tag == 'N':
+        return None, pos + 1
+    length, = _unpack_u32(data, pos + 1)
+    start = pos + 5
+    end = start + length
+    if end > len(data):
+        raise ValueError('Truncated field')
+    if tag == 'S':
+        return data[start:end].decode('utf-8'), end
+    if tag == 'J':
+        return json.loads(data[start:end]), end
+    raise ValueError('Unknown token tag %r' % tag)
+
+
+def _decode_dict(data, pos):
+    """
+    :returns: (dictionary, position after the dictionary) tuple
+    """
+    values = {}
+    count, = _unpack_u32(data, pos)
+    pos += 4
+    for _ in xrange(count):
+        key, pos = _decode_token(data, pos)
+        values[key], pos = _decode_token(data, pos)
+    return values, pos
+
+
+def _check_version(data):
+    if data[1:2] != chr(SBUS_FRAMING_BINARY):
+        raise ValueError('Unsupported framing version %r' % data[1:2])
+
+
+def is_binary_framed(data):
+    return data.startswith(_BINARY_MARKER)
+
+
+def decode_binary_params(data):
+    """
+    :param data: parameters framed with the binary framing
+    :returns: (command, params, task_id) tuple, params being None when
+              there are no parameters
+    :raises ValueError: when the data is malformed
+    """
+    _check_version(data)
+    try:
+        command, pos = _decode_token(data, 2)
+        task_id, pos = _decode_token(data, pos)
+        params, pos = _decode_dict(data, pos)
+    except (IndexError, struct.error) as err:
+        raise ValueError('Malformed parameters: %s' % err)
+    return command, params or None, task_id
+
+
+def decode_binary_md(data):
+    """
+    :param data: fds metadata framed with the binary framing
+    :returns: list of dictionaries of sections, one per fd
+    :raises ValueError: when the data is malformed
+    """
+    _check_version(data)
+    try:
+        md = []
+        num_fds, = _unpack_u32(data, 2)
+        pos = 6
+        for _ in xrange(num_fds):
+            fd_md = {}
+            num_sections, = _unpack_u32(data, pos)
+            pos += 4
+            for _ in xrange(num_sections):
+                section, pos = _decode_token(data, pos)
+                fd_md[section], pos = _decode_dict(data, pos)
+            md.append(fd_md)
+    except (IndexError, struct.error) as err:
+        raise ValueError('Malformed metadata: %s' % err)
+    return md
 
 
 class ClientSBusOutDatagram(object):
@@ -40,7 +221,8 @@ class ClientSBusOutDatagram(object):
 
     """
 
-    def __init__(self, command, fds, md, params=None, task_id=None):
+    def __init__(self, command, fds, md, params=None, task_id=None,
+                 framing=SBUS_FRAMING_JSON):
         """ Constructs ClientSBusOutDatagram
 
         :param command: A string encoding the command to send
@@ -50,6 +232,8 @@ class ClientSBusOutDatagram(object):
         :params: A optional dictionary with parameters for the command
                  execution
         :params: An optional string task id
+        :params framing: SBUS_FRAMING_JSON or SBUS_FRAMING_BINARY, which the
+                         server side must support
 
         """
         self._command = command
@@ -57,13 +241,33 @@ class ClientSBusOutDatagram(object):
         self._md = md
         self._params = params
         self._task_id = task_id
+        self.framing = framing
 
     @staticmethod
-    def create_service_datagram(command, outfd, params=None, task_id=None):
+    def create_service_datagram(command, outfd, params=None, task_id=None,
+                                framing=SBUS_FRAMING_JSON):
         md = [{'storlets': {'type': SBUS_FD_SERVICE_OUT},
               'storage': {}}]
         fds = [outfd]
-        return ClientSBusOutDatagram(command, fds, md, params, task_id)
+        return ClientSBusOutDatagram(command, fds, md, params, task_id,
+                                     framing)
+
+    @staticmethod
+    def create_batch_datagram(commands, outfd, framing=SBUS_FRAMING_JSON):
+        """
+        Create a datagram carrying several service commands
+
+        The commands are processed in order, and share the reply written to
+        outfd, whose replies attribute has one reply per command.
+
+        :param commands: list of (command, params) tuples
+        :param outfd: file descriptor the reply is written to
+        :param framing: framing of the datagram
+        """
+        params = {'commands': [{'command': command, 'params': params}
+                               for command, params in commands]}
+        return ClientSBusOutDatagram.create_service_datagram(
+            SBUS_CMD_BATCH, outfd, params, framing=framing)
 
     def _get_num_fds(self):
         return len(self._fds)
@@ -75,6 +279,9 @@ class ClientSBusOutDatagram(object):
 
     @property
     def serialized_cmd_params(self):
+        if self.framing == SBUS_FRAMING_BINARY:
+            return encode_binary_params(self._command, self._params,
+                                        self._task_id)
         res = {}
         res['command'] = self._command
         if self._params:
@@ -85,13 +292,15 @@ class ClientSBusOutDatagram(object):
 
     @property
     def serialized_md(self):
+        if self.framing == SBUS_FRAMING_BINARY:
+            return encode_binary_md(self._md)
         return json.dumps(self._md)
 
     def __str__(self):
         return 'num_fds=%s, md=%s, cmd_params=%s' % (
             self.num_fds,
-            str(self.serialized_md),
-            str(self.serialized_cmd_params))
+            repr(self.serialized_md),
+            repr(self.serialized_cmd_params))
 
 
 class ServerSBusInDatagram(object):
@@ -106,11 +315,18 @@ class ServerSBusInDatagram(object):
     """
     def __init__(self, fds, str_md, str_params):
         self._fds = fds
-        self._md = json.loads(str_md)
-        cmd_params = json.loads(str_params)
-        self._command = cmd_params.get('command')
-        self._params = cmd_params.get('params')
-        self._task_id = cmd_params.get('task_id')
+        if is_binary_framed(str_md):
+            self._md = decode_binary_md(str_md)
+        else:
+            self._md = json.loads(str_md)
+        if is_binary_framed(str_params):
+            self._command, self._params, self._task_id = \
+                decode_binary_params(str_params)
+        else:
+            cmd_params = json.loads(str_params)
+            self._command = cmd_params.get('command')
+            self._params = cmd_params.get('params')
+            self._task_id = cmd_params.get('task_id')
 
     def _get_fds(self):
         return self._fds
@@ -143,6 +359,78 @@ class ServerSBusInDatagram(object):
         return None
 
 
+class SBusServiceReply(object):
+    """Reply of a service command
+
+    The reply is serialized as a JSON object terminated by a new line:
+    {"status": true, "message": "OK"}
+    The reply of a batch command has an additional "replies" list, with
+    the reply of each command of the batch, and the server side may
+    advertise the highest datagram framing it supports with "framing".
+    Old daemon factories reply with a plain "True: OK" string, which parse
+    also accepts, setting legacy.
+
+    """
+    def __init__(self, status, message='', replies=None, legacy=False,
+                 framing=None):
+        self.status = status
+        self.message = message
+        self.replies = replies
+        self.legacy = legacy
+        self.framing = framing
+
+    def _to_dict(self):
+        res = {'status': self.status, 'message': self.message}
+        if self.replies is not None:
+            res['replies'] = [reply._to_dict() for reply in self.replies]
+        if self.framing is not None:
+            res['framing'] = self.framing
+        return res
+
+    @staticmethod
+    def _from_dict(res):
+        replies = res.get('replies')
+        if replies is not None:
+            replies = [SBusServiceReply._from_dict(reply)
+                       for reply in replies]
+        return SBusServiceReply(res.get('status') is True,
+                                res.get('message', ''), replies,
+                                framing=res.get('framing'))
+
+    def serialize(self):
+        return json.dumps(self._to_dict()) + '\n'
+
+    @staticmethod
+    def is_complete(str_reply):
+        """
+        Check if the whole reply has been read
+
+        :param str_reply: the reply read so far
+        """
+        return not str_reply.startswith('{') or str_reply.endswith('\n')
+
+    @staticmethod
+    def parse(str_reply):
+        """
+        :param str_reply: serialized reply
+        :returns: SBusServiceReply instance
+        :raises ValueError: when the reply is malformed
+        """
+        if str_reply.startswith('{'):
+            res = json.loads(str_reply)
+            if not isinstance(res, dict):
+                raise ValueError('Malformed reply: %s' % str_reply)
+            return SBusServiceReply._from_dict(res)
+        status, sep, message = str_reply.partition(':')
+        if not sep:
+            raise ValueError('Malformed reply: %s' % str_reply)
+        return SBusServiceReply(status == 'True', message.strip(),
+                                legacy=True)
+
+    def __str__(self):
+        return '%s: %s' % (self.status, self.message)
+
+
 # Curerrently we have no Server to Client commands
 # This serves as a place holder should we want to bring the
 # function back:
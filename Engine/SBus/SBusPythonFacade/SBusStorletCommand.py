@@ -23,3 +23,5 @@ SBUS_CMD_PING = 'SBUS_CMD_PING'
 SBUS_CMD_DESCRIPTOR = 'SBUS_CMD_DESCRIPTOR'
 SBUS_CMD_CANCEL = 'SBUS_CMD_CANCEL'
 SBUS_CMD_NOP = 'SBUS_CMD_NOP'
+# Carries several service commands, processed in order
+SBUS_CMD_BATCH = 'SBUS_CMD_BATCH'
@@ -0,0 +1,325 @@
+/*----------------------------------------------------------------------------
+ * Copyright IBM Corp. 2015, 2015 All Rights Reserved
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ * http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * Limitations under the License.
+ * ---------------------------------------------------------------------------
+ */
+
+/*============================================================================
+ Native Python facade of the SBus transport layer, an alternative to the
+ ctypes bindings of SBus.py. The arguments are converted to C directly, and
+ the GIL is released while the transport layer blocks.
+ ===========================================================================*/
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdlib.h>
+
+#include "sbus.h"
+
+/* Maximum number of ready SBus returned by a single poll_wait */
+#define SBUS_PY_MAX_EVENTS 64
+
+/*----------------------------------------------------------------------------
+ * sbus_py_get_files
+ * converts a sequence of file descriptors to a newly allocated C array
+ * returns 0 on success, -1 with a Python exception set on error
+ */
+static int sbus_py_get_files( PyObject* py_fds, int** pp_files, int* pn_files )
+{
+    PyObject* py_seq = PySequence_Fast( py_fds, "fds must be a sequence" );
+    if( NULL == py_seq )
+        return -1;
+
+    Py_ssize_t n_files = PySequence_Fast_GET_SIZE( py_seq );
+    int* p_files = NULL;
+    if( 0 < n_files ) {
+        p_files = (int*) malloc( n_files * sizeof(int) );
+        if( NULL == p_files ) {
+            Py_DECREF( py_seq );
+            PyErr_NoMemory();
+            return -1;
+        }
+    }
+
+    Py_ssize_t i;
+    for( i = 0; i < n_files; ++i ) {
+        long n_fd = PyInt_AsLong( PySequence_Fast_GET_ITEM( py_seq, i ) );
+        if( -1 == n_fd && PyErr_Occurred() ) {
+            free( p_files );
+            Py_DECREF( py_seq );
+            return -1;
+        }
+        p_files[i] = (int) n_fd;
+    }
+    Py_DECREF( py_seq );
+
+    *pp_files = p_files;
+    *pn_files = (int) n_files;
+    return 0;
+}
+
+/*----------------------------------------------------------------------------
+ * send(path, fds, md, params)
+ * md may be None. Returns the sendmsg status, negative on failure.
+ */
+static PyObject* sbus_py_send( PyObject* self, PyObject* args )
+{
+    const char* str_path;
+    PyObject* py_fds;
+    const char* str_md;
+    Py_ssize_t n_md_len;
+    const char* str_params;
+    Py_ssize_t n_params_len;
+    if( !PyArg_ParseTuple( args, "sOz#s#:send", &str_path, &py_fds,
+                           &str_md, &n_md_len, &str_params, &n_params_len ) )
+        return NULL;
+
+    int* p_files = NULL;
+    int n_files = 0;
+    if( 0 != sbus_py_get_files( py_fds, &p_files, &n_files ) )
+        return NULL;
+
+    int n_status;
+    Py_BEGIN_ALLOW_THREADS
+    n_status = sbus_send_msg( str_path, p_files, n_files,
+                              str_md, (int) n_md_len,
+                              str_params, (int) n_params_len );
+    Py_END_ALLOW_THREADS
+    free( p_files );
+
+    return PyInt_FromLong( n_status );
+}
+
+/*----------------------------------------------------------------------------
+ * send_on(sock, fds, md, params)
+ * same as send, through a socket created by connect
+ */
+static PyObject* sbus_py_send_on( PyObject* self, PyObject* args )
+{
+    int n_sock;
+    PyObject* py_fds;
+    const char* str_md;
+    Py_ssize_t n_md_len;
+    const char* str_params;
+    Py_ssize_t n_params_len;
+    if( !PyArg_ParseTuple( args, "iOz#s#:send_on", &n_sock, &py_fds,
+                           &str_md, &n_md_len, &str_params, &n_params_len ) )
+        return NULL;
+
+    int* p_files = NULL;
+    int n_files = 0;
+    if( 0 != sbus_py_get_files( py_fds, &p_files, &n_files ) )
+        return NULL;
+
+    int n_status;
+    Py_BEGIN_ALLOW_THREADS
+    n_status = sbus_send_msg_sock( n_sock, p_files, n_files,
+                                   str_md, (int) n_md_len,
+                                   str_params, (int) n_params_len );
+    Py_END_ALLOW_THREADS
+    free( p_files );
+
+    return PyInt_FromLong( n_status );
+}
+
+/*----------------------------------------------------------------------------
+ * recv(handle)
+ * returns a (fds, md, params) tuple, md being None when there are no
+ * files, or None on failure
+ */
+static PyObject* sbus_py_recv( PyObject* self, PyObject* args )
+{
+    int n_handle;
+    if( !PyArg_ParseTuple( args, "i:recv", &n_handle ) )
+        return NULL;
+
+    int* p_files = NULL;
+    int n_files = 0;
+    char* str_md = NULL;
+    int n_md_len = 0;
+    char* str_params = NULL;
+    int n_params_len = 0;
+    int n_status;
+    Py_BEGIN_ALLOW_THREADS
+    n_status = sbus_recv_msg( n_handle, &p_files, &n_files,
+                              &str_md, &n_md_len,
+                              &str_params, &n_params_len );
+    Py_END_ALLOW_THREADS
+
+    PyObject* py_result = NULL;
+    if( 0 > n_status ) {
+        Py_INCREF( Py_None );
+        py_result = Py_None;
+    } else {
+        PyObject* py_fds = PyList_New( n_files );
+        int i;
+        for( i = 0; NULL != py_fds && i < n_files; ++i )
+            PyList_SET_ITEM( py_fds, i, PyInt_FromLong( p_files[i] ) );
+        if( 0 < n_md_len )
+            py_result = Py_BuildValue( "(Ns#s#)", py_fds,
+                                       str_md, (Py_ssize_t) n_md_len,
+                                       str_params,
+                                       (Py_ssize_t) n_params_len );
+        else
+            py_result = Py_BuildValue( "(NOs#)", py_fds, Py_None,
+                                       str_params,
+                                       (Py_ssize_t) n_params_len );
+    }
+
+    free( p_files );
+    free( str_md );
+    free( str_params );
+    return py_result;
+}
+
+static PyObject* sbus_py_create( PyObject* self, PyObject* args )
+{
+    const char* str_path;
+    if( !PyArg_ParseTuple( args, "s:create", &str_path ) )
+        return NULL;
+    return PyInt_FromLong( sbus_create( str_path ) );
+}
+
+static PyObject* sbus_py_listen( PyObject* self, PyObject* args )
+{
+    int n_handle;
+    if( !PyArg_ParseTuple( args, "i:listen", &n_handle ) )
+        return NULL;
+
+    int n_status;
+    Py_BEGIN_ALLOW_THREADS
+    n_status = sbus_listen( n_handle );
+    Py_END_ALLOW_THREADS
+    return PyInt_FromLong( n_status );
+}
+
+static PyObject* sbus_py_poll_create( PyObject* self, PyObject* args )
+{
+    return PyInt_FromLong( sbus_poll_create() );
+}
+
+static PyObject* sbus_py_poll_add( PyObject* self, PyObject* args )
+{
+    int n_poll;
+    int n_handle;
+    if( !PyArg_ParseTuple( args, "ii:poll_add", &n_poll, &n_handle ) )
+        return NULL;
+    return PyInt_FromLong( sbus_poll_add( n_poll, n_handle ) );
+}
+
+static PyObject* sbus_py_poll_remove( PyObject* self, PyObject* args )
+{
+    int n_poll;
+    int n_handle;
+    if( !PyArg_ParseTuple( args, "ii:poll_remove", &n_poll, &n_handle ) )
+        return NULL;
+    return PyInt_FromLong( sbus_poll_remove( n_poll, n_handle ) );
+}
+
+/*----------------------------------------------------------------------------
+ * poll_wait(poll, timeout_ms)
+ * returns the list of the ready SBus handles, empty on timeout, or None on
+ * failure
+ */
+static PyObject* sbus_py_poll_wait( PyObject* self, PyObject* args )
+{
+    int n_poll;
+    int n_timeout_ms;
+    if( !PyArg_ParseTuple( args, "ii:poll_wait", &n_poll, &n_timeout_ms ) )
+        return NULL;
+
+    int p_handles[SBUS_PY_MAX_EVENTS];
+    int n_ready;
+    Py_BEGIN_ALLOW_THREADS
+    n_ready = sbus_poll_wait( n_poll, p_handles, SBUS_PY_MAX_EVENTS,
+                              n_timeout_ms );
+    Py_END_ALLOW_THREADS
+    if( 0 > n_ready )
+        Py_RETURN_NONE;
+
+    PyObject* py_handles = PyList_New( n_ready );
+    int i;
+    for( i = 0; NULL != py_handles && i < n_ready; ++i )
+        PyList_SET_ITEM( py_handles, i, PyInt_FromLong( p_handles[i] ) );
+    return py_handles;
+}
+
+static PyObject* sbus_py_poll_close( PyObject* self, PyObject* args )
+{
+    int n_poll;
+    if( !PyArg_ParseTuple( args, "i:poll_close", &n_poll ) )
+        return NULL;
+    return PyInt_FromLong( sbus_poll_close( n_poll ) );
+}
+
+static PyObject* sbus_py_connect( PyObject* self, PyObject* args )
+{
+    const char* str_path;
+    if( !PyArg_ParseTuple( args, "s:connect", &str_path ) )
+        return NULL;
+    return PyInt_FromLong( sbus_connect( str_path ) );
+}
+
+static PyObject* sbus_py_start_logger( PyObject* self, PyObject* args )
+{
+    const char* str_log_level;
+    const char* str_container_id = NULL;
+    if( !PyArg_ParseTuple( args, "s|z:start_logger",
+                           &str_log_level, &str_container_id ) )
+        return NULL;
+    sbus_start_logger( str_log_level, str_container_id );
+    Py_RETURN_NONE;
+}
+
+static PyObject* sbus_py_stop_logger( PyObject* self, PyObject* args )
+{
+    sbus_stop_logger();
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef sbus_py_methods[] = {
+    { "send", sbus_py_send, METH_VARARGS,
+      "send(path, fds, md, params) -> status" },
+    { "send_on", sbus_py_send_on, METH_VARARGS,
+      "send_on(sock, fds, md, params) -> status" },
+    { "recv", sbus_py_recv, METH_VARARGS,
+      "recv(handle) -> (fds, md, params), or None on failure" },
+    { "create", sbus_py_create, METH_VARARGS,
+      "create(path) -> handle" },
+    { "listen", sbus_py_listen, METH_VARARGS,
+      "listen(handle) -> status" },
+    { "poll_create", sbus_py_poll_create, METH_NOARGS,
+      "poll_create() -> poll" },
+    { "poll_add", sbus_py_poll_add, METH_VARARGS,
+      "poll_add(poll, handle) -> status" },
+    { "poll_remove", sbus_py_poll_remove, METH_VARARGS,
+      "poll_remove(poll, handle) -> status" },
+    { "poll_wait", sbus_py_poll_wait, METH_VARARGS,
+      "poll_wait(poll, timeout_ms) -> handles, or None on failure" },
+    { "poll_close", sbus_py_poll_close, METH_VARARGS,
+      "poll_close(poll) -> status" },
+    { "connect", sbus_py_connect, METH_VARARGS,
+      "connect(path) -> socket" },
+    { "start_logger", sbus_py_start_logger, METH_VARARGS,
+      "start_logger(log_level, container_id=None)" },
+    { "stop_logger", sbus_py_stop_logger, METH_NOARGS,
+      "stop_logger()" },
+    { NULL, NULL, 0, NULL }
+};
+
+PyMODINIT_FUNC init_sbus( void )
+{
+    Py_InitModule3( "_sbus", sbus_py_methods,
+                    "Native facade of the SBus transport layer" );
+}
+
+/*============================== END OF FILE ===============================*/
@@ -14,8 +14,18 @@ See the License for the specific language governing permissions and
 Limitations under the License.
 -------------------------------------------------------------------------'''
 
+from setuptools import Extension
 from setuptools import setup
+
+# Native facade of the transport layer. SBus falls back on the C-library
+# through ctypes when it is not available.
+sbus_ext = Extension('SBusPythonFacade._sbus',
+                     sources=['sbusmodule.c', '../SBusTransportLayer/sbus.c'],
+                     include_dirs=['../SBusTransportLayer'],
+                     extra_compile_args=['-O2'])
+
 setup(name='SBusPythonFacade',
       version='1.0',
       package_dir={'SBusPythonFacade': ''},
-      packages=['SBusPythonFacade'])
+      packages=['SBusPythonFacade'],
+      ext_modules=[sbus_ext])
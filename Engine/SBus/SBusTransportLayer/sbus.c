@@ -18,7 +18,10 @@
 #endif
 
 #include <string.h>
+#include <poll.h>
+#include <sys/epoll.h>
 #include <sys/socket.h>
+#include <sys/syscall.h>
 #include <syslog.h>
 #include <stdlib.h>
 #include <sys/un.h>
@@ -33,6 +36,38 @@
 #define SBUS_SYSLOG_PATH  "sbus"
 #define MAX_FDS           4096
 #define MAX_MSG_LENGTH    4096
+#define HEADER_LENGTH     ( 3 * sizeof(int) )
+
+/*
+ * Level of the logger, see sbus_start_logger. Everything is logged until
+ * the logger is started.
+ */
+static int g_n_log_level = LOG_DEBUG;
+
+/*
+ * Per message debug logs. Even filtered out by the log mask, they cost a
+ * syslog call and the evaluation of their arguments per message, so that
+ * they are checked against the level of the logger first. They can also be
+ * compiled out with -DSBUS_NO_DEBUG_LOG.
+ */
+#ifdef SBUS_NO_DEBUG_LOG
+#define sbus_log_debug( ... ) do {} while( 0 )
+#else
+#define sbus_log_debug( ... )                   \
+    do {                                        \
+        if( LOG_DEBUG <= g_n_log_level )        \
+            syslog( LOG_DEBUG, __VA_ARGS__ );   \
+    } while( 0 )
+#endif
+
+/*
+ * Messages whose metadata and data do not fit in MAX_MSG_LENGTH are sent in
+ * the large message mode: the datagram only carries the 3 integers, and the
+ * metadata and data are written to an anonymous file whose descriptor is
+ * passed after the files of the message. The receiver tells both modes
+ * apart by the datagram length, which is shorter than the integers announce
+ * in the large message mode.
+ */
 
 
 /*----------------------------------------------------------------------------
@@ -75,6 +110,7 @@ void sbus_start_logger( const char* str_log_level, const char* container_id )
     strcat(str, SBUS_SYSLOG_PATH);
 
     openlog( str, LOG_PID, LOG_SYSLOG );
+    g_n_log_level = n_level;
     if( LOG_EMERG == n_level )
         setlogmask( LOG_EMERG );
     else
@@ -147,7 +183,7 @@ int sbus_create( const char* str_sbus_path )
                     close( n_sbus_handle );
         }
     }
-    syslog( LOG_DEBUG,
+    sbus_log_debug(
             "sbus_create: SBus created at - %s", str_sbus_path );
 
     return ( 0 <= n_status ? n_sbus_handle : n_status );
@@ -155,39 +191,95 @@ int sbus_create( const char* str_sbus_path )
 
 int sbus_listen( int n_sbus_handle )
 {
-    fd_set fdset;
-
-    FD_ZERO( &fdset );
-    FD_SET( n_sbus_handle, &fdset );
+    struct pollfd poll_fd;
+    poll_fd.fd = n_sbus_handle;
+    poll_fd.events = POLLIN;
+    poll_fd.revents = 0;
 
-    int n_status = select( n_sbus_handle+1,
-                           &fdset,
-                           (fd_set *)0,
-                           (fd_set *)0,
-                           (struct timeval*) 0);
+    // poll, unlike select, is not limited to descriptors below FD_SETSIZE
+    int n_status = poll( &poll_fd, 1, -1 );
     if( 0 > n_status )
         syslog( LOG_ERR,
-                "sbus_listen: Select returned unexpectedly. %s",
+                "sbus_listen: Poll returned unexpectedly. %s",
                 strerror(errno));
     else
-    {
-        if( !FD_ISSET( n_sbus_handle, &fdset ) )
-        {
-            // TBD +1 means return to select.
-            syslog( LOG_ERR,
-                    "sbus_listen: Select returned on a different fs. %s",
-                    strerror(errno) );
-                    n_status = 1;
-        }
-        else
-            n_status = 0;
-    }
-    syslog( LOG_DEBUG,
-            "sbus_listen: SBus listened successfully" );
+        n_status = 0;
+    sbus_log_debug( "sbus_listen: SBus listened successfully" );
 
     return n_status;
 }
 
+int sbus_poll_create( void )
+{
+    int n_poll = epoll_create1( EPOLL_CLOEXEC );
+    if( 0 > n_poll )
+        syslog( LOG_ERR,
+                "sbus_poll_create: Failed to create epoll instance. %s",
+                strerror(errno) );
+    return n_poll;
+}
+
+int sbus_poll_add( int n_poll, int n_sbus_handle )
+{
+    struct epoll_event event;
+    memset( &event, 0, sizeof(event) );
+    event.events = EPOLLIN;
+    event.data.fd = n_sbus_handle;
+
+    int n_status = epoll_ctl( n_poll, EPOLL_CTL_ADD, n_sbus_handle, &event );
+    if( 0 > n_status )
+        syslog( LOG_ERR,
+                "sbus_poll_add: Failed to add SBus %d. %s",
+                n_sbus_handle, strerror(errno) );
+    return n_status;
+}
+
+int sbus_poll_remove( int n_poll, int n_sbus_handle )
+{
+    struct epoll_event event;
+    memset( &event, 0, sizeof(event) );
+
+    int n_status = epoll_ctl( n_poll, EPOLL_CTL_DEL, n_sbus_handle, &event );
+    if( 0 > n_status )
+        syslog( LOG_ERR,
+                "sbus_poll_remove: Failed to remove SBus %d. %s",
+                n_sbus_handle, strerror(errno) );
+    return n_status;
+}
+
+int sbus_poll_wait( int n_poll, int* p_handles, int n_max,
+                    int n_timeout_ms )
+{
+    if( 0 >= n_max )
+        return -1;
+
+    struct epoll_event events[64];
+    if( n_max > (int) ( sizeof(events) / sizeof(events[0]) ) )
+        n_max = sizeof(events) / sizeof(events[0]);
+
+    int n_ready = epoll_wait( n_poll, events, n_max, n_timeout_ms );
+    if( 0 > n_ready ) {
+        // Interrupted by a signal, let the caller check why
+        if( EINTR == errno )
+            return 0;
+        syslog( LOG_ERR,
+                "sbus_poll_wait: epoll_wait returned unexpectedly. %s",
+                strerror(errno) );
+        return -1;
+    }
+
+    int i;
+    for( i = 0; i < n_ready; ++i )
+        p_handles[i] = events[i].data.fd;
+    sbus_log_debug( "sbus_poll_wait: %d SBus ready", n_ready );
+    return n_ready;
+}
+
+int sbus_poll_close( int n_poll )
+{
+    return close( n_poll );
+}
+
 
 /*=========================== MESSAGE SENDING ==============================*/
 
@@ -196,6 +288,7 @@ int sbus_listen( int n_sbus_handle )
  *
  * auxiliary string processing, collects provided data to a single byte stream
  * The "protocol" is : 3 integers, 2 strings
+ * The strings are left out when b_with_data is 0 (large message mode)
  */
 static
 int dump_data_to_bytestream( char** pp_bytestream,
@@ -203,7 +296,8 @@ int dump_data_to_bytestream( char** pp_bytestream,
                              const char* str_files_metadata,
                              int n_files_metadata_len,
                              const char* str_msg_data,
-                             int n_msg_len )
+                             int n_msg_len,
+                             int b_with_data )
 {
     int int_size = sizeof( int );
 
@@ -212,7 +306,9 @@ int dump_data_to_bytestream( char** pp_bytestream,
     // 2 char-encoded buffers;
     // 3 integers: number of files, lengths of metadata and message;
     // terminating NULL
-    int n_bytestream_len = n_files_metadata_len + n_msg_len + 3 * int_size + 1;
+    int n_bytestream_len = 3 * int_size + 1;
+    if( b_with_data )
+        n_bytestream_len += n_files_metadata_len + n_msg_len;
     *pp_bytestream = (char*)(malloc)(n_bytestream_len);
     if( NULL == *pp_bytestream ) {
         syslog( LOG_ERR,
@@ -231,17 +327,86 @@ int dump_data_to_bytestream( char** pp_bytestream,
         n_offset += int_size;
         memcpy( *pp_bytestream + n_offset, (void*) &n_msg_len, int_size );
         n_offset += int_size;
-	memcpy( *pp_bytestream + n_offset, (void*) str_files_metadata,
-                n_files_metadata_len );
-        n_offset += n_files_metadata_len;
-        memcpy( *pp_bytestream + n_offset, (void*) str_msg_data, n_msg_len );
+        if( b_with_data ) {
+            memcpy( *pp_bytestream + n_offset, (void*) str_files_metadata,
+                    n_files_metadata_len );
+            n_offset += n_files_metadata_len;
+            memcpy( *pp_bytestream + n_offset, (void*) str_msg_data,
+                    n_msg_len );
+            n_offset += n_msg_len;
+        }
+        (*pp_bytestream)[n_offset] = 0;
     }
     return ( 0 == n_status ? n_bytestream_len : -1 );
 }
 
+/*----------------------------------------------------------------------------
+ * sbus_write_all
+ * writes the whole buffer to n_fd
+ */
+static
+int sbus_write_all( int n_fd, const char* p_buf, int n_len )
+{
+    while( 0 < n_len ) {
+        ssize_t n_written = write( n_fd, p_buf, n_len );
+        if( 0 > n_written ) {
+            if( EINTR == errno )
+                continue;
+            return -1;
+        }
+        p_buf += n_written;
+        n_len -= n_written;
+    }
+    return 0;
+}
+
+/*----------------------------------------------------------------------------
+ * sbus_create_payload_fd
+ * creates an anonymous file holding the metadata and the message data,
+ * for the large message mode
+ * returns the file descriptor, -1 on error
+ */
+static
+int sbus_create_payload_fd( const char* str_files_metadata,
+                            int n_files_metadata_len,
+                            const char* str_msg_data,
+                            int n_msg_len )
+{
+    int n_fd = -1;
+#ifdef SYS_memfd_create
+    n_fd = syscall( SYS_memfd_create, "sbus", 0 );
+#endif
+    if( 0 > n_fd ) {
+        // No memfd, fall back on an unlinked temporary file
+        char str_path[] = "/tmp/sbus-XXXXXX";
+        n_fd = mkstemp( str_path );
+        if( 0 <= n_fd )
+            unlink( str_path );
+    }
+    if( 0 > n_fd ) {
+        syslog( LOG_ERR,
+                "sbus_create_payload_fd: Failed to create a file. %s",
+                strerror(errno) );
+        return -1;
+    }
+
+    if( 0 != sbus_write_all( n_fd, str_files_metadata,
+                             n_files_metadata_len ) ||
+        0 != sbus_write_all( n_fd, str_msg_data, n_msg_len ) ) {
+        syslog( LOG_ERR,
+                "sbus_create_payload_fd: Failed to write the payload. %s",
+                strerror(errno) );
+        close( n_fd );
+        return -1;
+    }
+    return n_fd;
+}
+
 /*----------------------------------------------------------------------------
  * sbus_pack_message
  * prepares msghdr structure to be sent, fills it with the actual data
+ * In the large message mode, *pn_payload_fd is set to the descriptor of the
+ * file holding the data, which the caller closes once the message is sent.
  */
 static
 int sbus_pack_message( struct msghdr* p_message,
@@ -251,21 +416,39 @@ int sbus_pack_message( struct msghdr* p_message,
                        const char* str_files_metadata,
                        int n_files_metadata_len,
                        const char* str_msg_data,
-                       int n_msg_len )
+                       int n_msg_len,
+                       int* pn_payload_fd )
 {
     int n_status = 0;
-    syslog( LOG_DEBUG, "sbus_pack_message: Got message with %d files",
+    sbus_log_debug( "sbus_pack_message: Got message with %d files",
             n_files );
 
+    int b_large = HEADER_LENGTH + n_files_metadata_len + n_msg_len + 1 >
+                  MAX_MSG_LENGTH;
+    int n_payload_fd = -1;
+    if( b_large ) {
+        n_payload_fd = sbus_create_payload_fd( str_files_metadata,
+                                               n_files_metadata_len,
+                                               str_msg_data,
+                                               n_msg_len );
+        if( 0 > n_payload_fd )
+            return -1;
+        sbus_log_debug(
+                "sbus_pack_message: Sending %d bytes in large message mode",
+                n_files_metadata_len + n_msg_len );
+    }
+
     char* p_bytestream = NULL;
     int n_bytestream_len = dump_data_to_bytestream( &p_bytestream,
                                                     n_files,
                                                     str_files_metadata,
                                                     n_files_metadata_len,
                                                     str_msg_data,
-                                                    n_msg_len );
+                                                    n_msg_len,
+                                                    !b_large );
     if( n_bytestream_len > 0 ) {
-        int n_files_block_len = n_files * sizeof(int);
+        int n_sent_files = n_files + ( b_large ? 1 : 0 );
+        int n_files_block_len = n_sent_files * sizeof(int);
         int n_cbuf_size = CMSG_LEN( n_files_block_len );
         char* cmsg_buf = (char*)(malloc)(n_cbuf_size);
         p_msg_iov->iov_base = p_bytestream;
@@ -280,45 +463,61 @@ int sbus_pack_message( struct msghdr* p_message,
         cmsg->cmsg_type = SCM_RIGHTS;
         cmsg->cmsg_len = p_message->msg_controllen;
         memcpy(CMSG_DATA(cmsg), (void*) p_files, n_files * sizeof(int));
+        if( b_large )
+            ( (int*) CMSG_DATA(cmsg) )[n_files] = n_payload_fd;
     } else
         n_status = -1;
 
+    if( 0 != n_status && 0 <= n_payload_fd ) {
+        close( n_payload_fd );
+        n_payload_fd = -1;
+    }
+    *pn_payload_fd = n_payload_fd;
+
     return n_status;
 }
 
 /*----------------------------------------------------------------------------
- * sbus_send_msg
- * packs the message data and sends it
+ * sbus_fill_sockaddr
+ * fills the address structure of the SBus at str_sbus_path
  */
-int sbus_send_msg( const char* str_sbus_path,
-                   const int* p_files,
-                   int n_files,
-                   const char* str_files_metadata,
-                   int n_files_metadata_len,
-                   const char* str_msg_data,
-                   int n_msg_len  )
+static
+void sbus_fill_sockaddr( struct sockaddr_un* p_sockaddr,
+                         const char* str_sbus_path )
 {
-    int n_sock = socket(PF_UNIX, SOCK_DGRAM, 0);
-    if( 0 > n_sock ) {
-        syslog( LOG_ERR,
-                "sbus_send_msg: Failed to create socket. %s",
-                strerror(errno));
-                return -1;
-    }
+    memset( p_sockaddr, 0, sizeof(*p_sockaddr) );
+    p_sockaddr->sun_family = AF_UNIX;
+    strncpy( p_sockaddr->sun_path,
+             str_sbus_path,
+             sizeof(p_sockaddr->sun_path) );
+    p_sockaddr->sun_path[sizeof(p_sockaddr->sun_path)-1] = 0;
+}
 
-    /* Some network stuff */
-    struct sockaddr_un sockaddr;
-    memset( &sockaddr, 0, sizeof(sockaddr) );
-    sockaddr.sun_family = AF_UNIX;
-    strncpy(sockaddr.sun_path, str_sbus_path, sizeof(sockaddr.sun_path));
-    sockaddr.sun_path[sizeof(sockaddr.sun_path)-1]=0;
+/*----------------------------------------------------------------------------
+ * sbus_send_packed
+ * packs the message data and sends it through n_sock.
+ * p_sockaddr may be NULL if n_sock is already connected.
+ */
+static
+int sbus_send_packed( int n_sock,
+                      struct sockaddr_un* p_sockaddr,
+                      const int* p_files,
+                      int n_files,
+                      const char* str_files_metadata,
+                      int n_files_metadata_len,
+                      const char* str_msg_data,
+                      int n_msg_len )
+{
     struct msghdr the_message;
     memset(&the_message, 0, sizeof(the_message));
-    the_message.msg_name = &sockaddr;
-    the_message.msg_namelen = sizeof(sockaddr);
+    if( NULL != p_sockaddr ) {
+        the_message.msg_name = p_sockaddr;
+        the_message.msg_namelen = sizeof(*p_sockaddr);
+    }
     struct iovec msg_iov;
 
     int n_status = 0;
+    int n_payload_fd = -1;
     n_status = sbus_pack_message( &the_message,
                                   &msg_iov,
                                   p_files,
@@ -326,32 +525,128 @@ int sbus_send_msg( const char* str_sbus_path,
                                   str_files_metadata,
                                   n_files_metadata_len,
                                   str_msg_data,
-                                  n_msg_len );
- 
-    if( 0 > n_status ) {
-        close( n_sock );
-    } else {
+                                  n_msg_len,
+                                  &n_payload_fd );
+
+    if( 0 <= n_status ) {
         // Send message to factory daemon via the socket.
         n_status = sendmsg( n_sock, &the_message, 0 );
         if( 0 > n_status )
             syslog( LOG_ERR,
-                    "sbus_send_msg: Failed to send message on channel %s,"
+                    "sbus_send_packed: Failed to send message on socket %d,"
                     " error is %s. Is server side running?",
-                    str_sbus_path, strerror(errno) );
+                    n_sock, strerror(errno) );
 
         // Free resources.
+        // The receiver has its own copy of the payload descriptor.
         free( the_message.msg_iov->iov_base );
         if( NULL != the_message.msg_control )
             free(the_message.msg_control);
-        close(n_sock);
+        if( 0 <= n_payload_fd )
+            close( n_payload_fd );
+    }
+    return n_status;
+}
+
+/*----------------------------------------------------------------------------
+ * sbus_send_msg
+ * packs the message data and sends it
+ */
+int sbus_send_msg( const char* str_sbus_path,
+                   const int* p_files,
+                   int n_files,
+                   const char* str_files_metadata,
+                   int n_files_metadata_len,
+                   const char* str_msg_data,
+                   int n_msg_len  )
+{
+    int n_sock = socket(PF_UNIX, SOCK_DGRAM, 0);
+    if( 0 > n_sock ) {
+        syslog( LOG_ERR,
+                "sbus_send_msg: Failed to create socket. %s",
+                strerror(errno));
+                return -1;
     }
+
+    /* Some network stuff */
+    struct sockaddr_un sockaddr;
+    sbus_fill_sockaddr( &sockaddr, str_sbus_path );
+
+    int n_status = sbus_send_packed( n_sock,
+                                     &sockaddr,
+                                     p_files,
+                                     n_files,
+                                     str_files_metadata,
+                                     n_files_metadata_len,
+                                     str_msg_data,
+                                     n_msg_len );
+    close(n_sock);
+
     if( 0 <= n_status )
-        syslog( LOG_DEBUG,
+        sbus_log_debug(
                 "sbus_send_msg: Message with %d files was sent through %s",
                 n_files, str_sbus_path );
     return n_status;
 }
 
+/*----------------------------------------------------------------------------
+ * sbus_connect
+ * creates a datagram socket connected to the given SBus
+ */
+int sbus_connect( const char* str_sbus_path )
+{
+    int n_sock = socket(PF_UNIX, SOCK_DGRAM, 0);
+    if( 0 > n_sock ) {
+        syslog( LOG_ERR,
+                "sbus_connect: Failed to create socket. %s",
+                strerror(errno));
+        return -1;
+    }
+
+    struct sockaddr_un sockaddr;
+    sbus_fill_sockaddr( &sockaddr, str_sbus_path );
+
+    if( 0 > connect( n_sock,
+                     (struct sockaddr *) &sockaddr,
+                     sizeof(sockaddr) ) ) {
+        syslog( LOG_ERR,
+                "sbus_connect: Failed to connect to %s. %s",
+                str_sbus_path, strerror(errno));
+        close( n_sock );
+        return -1;
+    }
+    sbus_log_debug( "sbus_connect: Connected to %s", str_sbus_path );
+    return n_sock;
+}
+
+/*----------------------------------------------------------------------------
+ * sbus_send_msg_sock
+ * packs the message data and sends it through a connected socket
+ */
+int sbus_send_msg_sock( int n_sock,
+                        const int* p_files,
+                        int n_files,
+                        const char* str_files_metadata,
+                        int n_files_metadata_len,
+                        const char* str_msg_data,
+                        int n_msg_len )
+{
+    int n_status = sbus_send_packed( n_sock,
+                                     NULL,
+                                     p_files,
+                                     n_files,
+                                     str_files_metadata,
+                                     n_files_metadata_len,
+                                     str_msg_data,
+                                     n_msg_len );
+    if( 0 <= n_status )
+        sbus_log_debug(
+                "sbus_send_msg_sock: Message with %d files was sent "
+                "through socket %d",
+                n_files, n_sock );
+    return n_status;
+}
+
 
 /*=========================== MESSAGE RECEIVING ============================*/
 
@@ -400,10 +695,10 @@ int sbus_extract_files(	struct msghdr* p_msg,
         syslog( LOG_ERR,
                 "sbus_extract_files: NULL cmsg. Error is %s",
                 strerror(errno) );
-        n_status = -1;
+        return -1;
     }
 
-    if( 0 != n_status || SCM_RIGHTS != cmsg->cmsg_type ) {
+    if( SCM_RIGHTS != cmsg->cmsg_type ) {
         syslog( LOG_ERR,
                 "sbus_extract_files: cmsg with wrong type. Type is %d",
                 cmsg->cmsg_type );
@@ -429,10 +724,45 @@ int sbus_extract_files(	struct msghdr* p_msg,
     int i;
     *pp_files = (int*) malloc( n_files * sizeof(int) );
     for( i = 0; i < n_files; ++i ) {
-        (*pp_files)[i] = ( (int*) CMSG_DATA( cmsg ) )[i];
+        (*pp_files)[i] = ( i < n_actual_num ?
+                           ( (int*) CMSG_DATA( cmsg ) )[i] : -1 );
     }
     return n_status;
 }
+
+/*----------------------------------------------------------------------------
+ * sbus_read_payload
+ * reads the metadata and message data of a message sent in the large
+ * message mode
+ * Caller shall free the allocated chunk.
+ */
+static
+char* sbus_read_payload( int n_payload_fd, int n_len )
+{
+    char* p_payload = (char*) malloc( n_len > 0 ? n_len : 1 );
+    if( NULL == p_payload )
+        return NULL;
+
+    int n_offset = 0;
+    while( n_offset < n_len ) {
+        ssize_t n_read = pread( n_payload_fd,
+                                p_payload + n_offset,
+                                n_len - n_offset,
+                                n_offset );
+        if( 0 > n_read && EINTR == errno )
+            continue;
+        if( 0 >= n_read ) {
+            syslog( LOG_ERR,
+                    "sbus_read_payload: Failed to read the payload. %s",
+                    0 > n_read ? strerror(errno) : "Unexpected EOF" );
+            free( p_payload );
+            return NULL;
+        }
+        n_offset += n_read;
+    }
+    return p_payload;
+}
+
 /*----------------------------------------------------------------------------
  * sbus_recv_msg
  * receives the data and unpacks the message
@@ -468,6 +798,10 @@ int sbus_recv_msg( int n_sbus_handler,
         syslog(LOG_ERR, "sbus_recv_msg: recvmsg failed. %s", strerror(errno));
 	close(n_sbus_handler);
 	n_status = -1;
+    } else if( n_msg_len < (int) HEADER_LENGTH ) {
+        syslog( LOG_ERR,
+                "sbus_recv_msg: Message too short, %d bytes", n_msg_len );
+        n_status = -1;
     }
 
     if( 0 <= n_status ) {
@@ -478,21 +812,55 @@ int sbus_recv_msg( int n_sbus_handler,
         for( i = 0; i < 3; ++i )
             *(n_lengths[i]) = sbus_extract_integer(p_bytestream + i*int_size);
 
-        if( 0 < *pn_files )
-            sbus_extract_files( &recv_msg, *pn_files , pp_files );
-
-        int n_offset = 3 * int_size;
-        if( 0 < *pn_files_metadata_len )
-            *pstr_files_metadata = sbus_copy_substr( p_bytestream + n_offset,
-                                                     *pn_files_metadata_len );
+        int n_data_len = *pn_files_metadata_len + *pn_msg_len;
+        // The datagram only has the integers in the large message mode
+        int b_large = ( n_msg_len < (int) HEADER_LENGTH + n_data_len );
+
+        int* p_files = NULL;
+        int n_sent_files = *pn_files + ( b_large ? 1 : 0 );
+        if( 0 < n_sent_files )
+            n_status = sbus_extract_files( &recv_msg, n_sent_files,
+                                           &p_files );
+
+        char* p_payload = NULL;
+        char* p_data = p_bytestream + HEADER_LENGTH;
+        if( b_large ) {
+            int n_payload_fd = ( NULL != p_files ? p_files[*pn_files] : -1 );
+            if( 0 <= n_status && 0 <= n_payload_fd )
+                p_payload = sbus_read_payload( n_payload_fd, n_data_len );
+            if( 0 <= n_payload_fd )
+                close( n_payload_fd );
+            if( NULL == p_payload )
+                n_status = -1;
+            p_data = p_payload;
+        }
+        if( 0 > n_status ) {
+            // The callers ignore the descriptors of a message which
+            // could not be received, so that they are closed here
+            for( i = 0; NULL != p_files && i < *pn_files; ++i )
+                if( 0 <= p_files[i] )
+                    close( p_files[i] );
+            *pn_files = 0;
+            free( p_files );
+        }
+        else if( 0 < *pn_files )
+            *pp_files = p_files;
+        else
+            free( p_files );
 
-        n_offset += *pn_files_metadata_len;
-        if( 0 < *pn_msg_len )
-            *pstr_msg_data = sbus_copy_substr( p_bytestream + n_offset, *pn_msg_len );
+        if( 0 <= n_status ) {
+            if( 0 < *pn_files_metadata_len )
+                *pstr_files_metadata = sbus_copy_substr( p_data,
+                                                  *pn_files_metadata_len );
 
+            if( 0 < *pn_msg_len )
+                *pstr_msg_data = sbus_copy_substr(
+                    p_data + *pn_files_metadata_len, *pn_msg_len );
+        }
+        free( p_payload );
     }
     if( 0 <= n_status )
-        syslog( LOG_DEBUG,
+        sbus_log_debug(
                 "sbus_recv_msg: Message with %d files was received",
                 *pn_files );
 
@@ -46,6 +46,42 @@ extern int sbus_create( const char* str_sbus_path );
  */
 extern int sbus_listen( int n_sbus_handle );
 
+/*----------------------------------------------------------------------------
+ * sbus_poll_create
+ * creates an epoll instance waiting on several SBus at once, so that one
+ * process may serve several channels
+ * returns the poll handle, -1 on error
+ */
+extern int sbus_poll_create( void );
+
+/*----------------------------------------------------------------------------
+ * sbus_poll_add, sbus_poll_remove
+ * add or remove an SBus created by sbus_create to or from a poll handle
+ * returns -1 on error, 0 on success
+ */
+extern int sbus_poll_add( int n_poll, int n_sbus_handle );
+extern int sbus_poll_remove( int n_poll, int n_sbus_handle );
+
+/*----------------------------------------------------------------------------
+ * sbus_poll_wait
+ * suspends the caller until one of the SBus of the poll handle is ready to
+ * be received on, or until n_timeout_ms milliseconds elapsed (-1 waits
+ * forever)
+ * p_handles - at least n_max entries, receives the ready SBus handles
+ * returns the number of ready SBus, 0 on timeout or when interrupted by a
+ * signal, -1 on error
+ */
+extern int sbus_poll_wait( int  n_poll,
+                           int* p_handles,
+                           int  n_max,
+                           int  n_timeout_ms );
+
+/*----------------------------------------------------------------------------
+ * sbus_poll_close
+ * releases a poll handle, the SBus it waits on are left open
+ */
+extern int sbus_poll_close( int n_poll );
+
 /*----------------------------------------------------------------------------
  * sbus_recv_msg
  * reads the data, allocates memory for the necessary buffers
@@ -74,6 +110,9 @@ extern int sbus_recv_msg( int    n_sbus_handler,
  * n_files_metadata_len - string length
  * str_msg_data         - the message, JSON-encoded string
  * n_msg_len            - length of the above
+ *
+ * Metadata and messages too large for a single datagram are passed through
+ * an anonymous file, transparently for the receiver.
  */
 extern int sbus_send_msg( const char* str_sbus_path,
                           const int*  p_files,
@@ -83,5 +122,27 @@ extern int sbus_send_msg( const char* str_sbus_path,
                           const char* str_msg_data,
                           int         n_msg_len );
 
+/*----------------------------------------------------------------------------
+ * sbus_connect
+ * create a datagram socket connected to the SBus at str_sbus_path
+ * The socket can be used with sbus_send_msg_sock for several messages,
+ * and shall be closed by the caller.
+ * returns -1 on error, socket descriptor on success
+ */
+extern int sbus_connect( const char* str_sbus_path );
+
+/*----------------------------------------------------------------------------
+ * sbus_send_msg_sock
+ * same as sbus_send_msg, but sends the message through a socket
+ * previously created by sbus_connect
+ */
+extern int sbus_send_msg_sock( int         n_sock,
+                               const int*  p_files,
+                               int         n_files,
+                               const char* str_files_metadata,
+                               int         n_files_metadata_len,
+                               const char* str_msg_data,
+                               int         n_msg_len );
+
 #endif
 /*========================= END OF FILE ======================================*/
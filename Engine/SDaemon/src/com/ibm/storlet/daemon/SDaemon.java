@@ -17,6 +17,7 @@
 
 package com.ibm.storlet.daemon;
 
+import java.io.FileOutputStream;
 import java.io.OutputStream;
 import java.io.IOException;
 
@@ -86,6 +87,8 @@ public class SDaemon {
 	 * args[1] - path to SBus
 	 * args[2] - log level
 	 * args[3] - thread pool size
+	 * args[4] - container id
+	 * args[5] - (optional) file descriptor to report the readiness to
 	 * 
 	 * Invocation from CLI example: 
 	 * java -Djava.library.path=. ...
@@ -138,6 +141,31 @@ public class SDaemon {
 		logger_.trace("Initialising thread pool with " + nPoolSize + " threads");
 		threadPool_ = Executors.newFixedThreadPool(nPoolSize);
 		taskIdToTask_ = new HashMap<String, Future>();
+		if (args.length > 5)
+			reportReadiness(args[5]);
+	}
+
+	/*------------------------------------------------------------------------
+	 * reportReadiness
+	 * 
+	 * Tell the daemon factory that we are ready to process commands, by
+	 * writing to the pipe it gave us. The factory otherwise pings us.
+	 * */
+	private static void reportReadiness(final String strReadyFd) {
+		OutputStream readyOut = null;
+		try {
+			readyOut = new FileOutputStream("/proc/self/fd/" + strReadyFd);
+			readyOut.write((new String("OK")).getBytes());
+		} catch (IOException e) {
+			logger_.error(strStorletName_ + ": Failed to report readiness "
+					+ e.toString());
+		} finally {
+			try {
+				if (readyOut != null)
+					readyOut.close();
+			} catch (IOException e) {
+			}
+		}
 	}
 
 	/*------------------------------------------------------------------------
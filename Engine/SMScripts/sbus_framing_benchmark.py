@@ -0,0 +1,74 @@
+# Copyright (c) 2015, 2016 OpenStack Foundation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import timeit
+
+from SBusPythonFacade.SBusDatagram import ClientSBusOutDatagram
+from SBusPythonFacade.SBusDatagram import SBUS_FRAMING_BINARY
+from SBusPythonFacade.SBusDatagram import SBUS_FRAMING_JSON
+from SBusPythonFacade.SBusDatagram import ServerSBusInDatagram
+from SBusPythonFacade.SBusFileDescription import SBUS_FD_INPUT_OBJECT
+from SBusPythonFacade.SBusFileDescription import SBUS_FD_LOGGER
+from SBusPythonFacade.SBusFileDescription import SBUS_FD_OUTPUT_OBJECT
+from SBusPythonFacade.SBusFileDescription import \
+    SBUS_FD_OUTPUT_OBJECT_METADATA
+from SBusPythonFacade.SBusFileDescription import SBUS_FD_OUTPUT_TASK_ID
+from SBusPythonFacade.SBusStorletCommand import SBUS_CMD_EXECUTE
+
+
+def execute_datagram(framing, num_metadata):
+    """
+    Create a datagram similar to the ones invoking storlets
+
+    :param framing: framing of the datagram
+    :param num_metadata: number of user metadata of the input object
+    """
+    storage = dict(('X-Object-Meta-Key%d' % i, 'value%d' % i)
+                   for i in range(num_metadata))
+    storage['Content-Length'] = '1048576'
+    md = [{'storlets': {'type': SBUS_FD_INPUT_OBJECT}, 'storage': storage}]
+    for fd_type in (SBUS_FD_OUTPUT_TASK_ID, SBUS_FD_OUTPUT_OBJECT,
+                    SBUS_FD_OUTPUT_OBJECT_METADATA, SBUS_FD_LOGGER):
+        md.append({'storlets': {'type': fd_type}, 'storage': {}})
+    params = {'storlet_name': 'org.openstack.storlet.Storlet',
+              'reference': 'container/object', 'quality': '80'}
+    return ClientSBusOutDatagram(SBUS_CMD_EXECUTE, range(5), md, params,
+                                 framing=framing)
+
+
+def main(argv):
+    num_metadata = int(argv[1]) if len(argv) > 1 else 10
+    number = 20000
+    print('Per invocation cost, with %d user metadata' % num_metadata)
+    for name, framing in (('json', SBUS_FRAMING_JSON),
+                          ('binary', SBUS_FRAMING_BINARY)):
+        dtg = execute_datagram(framing, num_metadata)
+        str_md = dtg.serialized_md
+        str_params = dtg.serialized_cmd_params
+
+        encode = timeit.timeit(
+            lambda: (dtg.serialized_md, dtg.serialized_cmd_params),
+            number=number)
+        decode = timeit.timeit(
+            lambda: ServerSBusInDatagram(dtg.fds, str_md, str_params),
+            number=number)
+        print('%-6s: %5d bytes, encode %6.2f us, decode %6.2f us' % (
+            name, len(str_md) + len(str_params),
+            encode * 1e6 / number, decode * 1e6 / number))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,79 @@
+# Copyright (c) 2015, 2016 OpenStack Foundation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import tempfile
+import timeit
+
+from SBusPythonFacade import SBus as sbus_module
+from SBusPythonFacade.SBus import SBus
+from SBusPythonFacade.SBusDatagram import ClientSBusOutDatagram
+from SBusPythonFacade.SBusFileDescription import SBUS_FD_INPUT_OBJECT
+from SBusPythonFacade.SBusStorletCommand import SBUS_CMD_EXECUTE
+
+
+def print_usage(argv):
+    print(argv[0] + ' [/path/to/sbus.so]')
+    print('Compares the cost of a send and receive through the native '
+          'facade and through ctypes')
+
+
+def round_trip(sbus, handle, sock, dtg):
+    SBus.send_on(sock, dtg)
+    sbus.listen(handle)
+    received = sbus.receive(handle)
+    for fd in received.fds:
+        os.close(fd)
+
+
+def main(argv):
+    if len(argv) > 1:
+        SBus.SBUS_SO_NAME = argv[1]
+    if sbus_module._sbus is None:
+        print('The native facade is not built')
+        print_usage(argv)
+        return
+
+    number = 20000
+    read_fd, write_fd = os.pipe()
+    fds = [write_fd] * 5
+    md = [{'storlets': {'type': SBUS_FD_INPUT_OBJECT}, 'storage': {}}] * 5
+    dtg = ClientSBusOutDatagram(SBUS_CMD_EXECUTE, fds, md, {'key': 'value'})
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name, use_native in (('ctypes', False), ('native', True)):
+            SBus.USE_NATIVE = use_native
+            path = os.path.join(tmp_dir, name)
+            sbus = SBus()
+            handle = sbus.create(path)
+            sock = SBus.connect(path)
+            elapsed = timeit.timeit(
+                lambda: round_trip(sbus, handle, sock, dtg),
+                number=number)
+            print('%-6s: send and receive %6.2f us' % (
+                name, elapsed * 1e6 / number))
+            os.close(sock)
+            os.close(handle)
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+        for name in os.listdir(tmp_dir):
+            os.unlink(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
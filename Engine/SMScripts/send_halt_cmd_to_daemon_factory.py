@@ -18,6 +18,7 @@ import sys
 
 from SBusPythonFacade.SBus import SBus
 from SBusPythonFacade.SBusDatagram import ClientSBusOutDatagram
+from SBusPythonFacade.SBusDatagram import SBusServiceReply
 from SBusPythonFacade.SBusStorletCommand import SBUS_CMD_HALT
 
 
@@ -42,8 +43,13 @@ def main(argv):
         print('Sending failed')
     else:
         print('Sending succeeded')
-        cmd_response = os.read(fi, 256)
-        print(cmd_response)
+        cmd_response = os.read(fi, 4096)
+        while not SBusServiceReply.is_complete(cmd_response):
+            chunk = os.read(fi, 4096)
+            if not chunk:
+                break
+            cmd_response += chunk
+        print(SBusServiceReply.parse(cmd_response))
     os.close(fi)
     os.close(fo)
 
@@ -0,0 +1,179 @@
+# Copyright (c) 2015, 2016 OpenStack Foundation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import select
+import sys
+import threading
+import time
+
+from storlet_gateway.common.exceptions import StorletTimeout
+from storlet_gateway.common.stob import FileDescriptorIterator
+
+
+class BytesFileDescriptorIterator(object):
+    """
+    FileDescriptorIterator as it was before reading into a bytearray, which
+    appended the read data to a bytes buffer
+    """
+
+    def __init__(self, obj_data, timeout, cancel_func):
+        self.closed = False
+        self.obj_data = obj_data
+        self.timeout = timeout
+        self.cancel_func = cancel_func
+        self.buf = b''
+
+    def read_with_timeout(self, size):
+        try:
+            with StorletTimeout(self.timeout):
+                chunk = os.read(self.obj_data, size)
+        except StorletTimeout:
+            if self.cancel_func:
+                self.cancel_func()
+            self.close()
+            raise
+        except Exception:
+            self.close()
+            raise
+        return chunk
+
+    def next(self, size=64 * 1024):
+        if len(self.buf) < size:
+            r, w, e = select.select([self.obj_data], [], [], self.timeout)
+            if len(r) == 0:
+                self.close()
+
+            if self.obj_data in r:
+                self.buf += self.read_with_timeout(size - len(self.buf))
+                if self.buf == b'':
+                    raise StopIteration('Stopped iterator ex')
+            else:
+                raise StopIteration('Stopped iterator ex')
+
+        if len(self.buf) > size:
+            data = self.buf[:size]
+            self.buf = self.buf[size:]
+        else:
+            data = self.buf
+            self.buf = b''
+        return data
+
+    def read(self, size=64 * 1024):
+        return self.next(size)
+
+    def readline(self, size=-1):
+        while b'\n' not in self.buf and \
+              (size < 0 or len(self.buf) < size):
+            if size < 0:
+                chunk = self.read()
+            else:
+                chunk = self.read(size - len(self.buf))
+            if not chunk:
+                break
+            self.buf += chunk
+
+        data, sep, rest = self.buf.partition(b'\n')
+        data += sep
+        self.buf = rest
+
+        if size >= 0 and len(data) > size:
+            self.buf = data[size:] + self.buf
+            data = data[:size]
+
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        os.close(self.obj_data)
+        self.closed = True
+
+
+def print_usage(argv):
+    print(argv[0] + ' [size in MB]')
+    print('Compares the throughput of the file descriptor iterators, before '
+          'and after reading into a bytearray, over a pipe')
+
+
+def write_all(fd, chunk, size):
+    try:
+        while size > 0:
+            size -= os.write(fd, chunk[:size])
+    finally:
+        os.close(fd)
+
+
+def read_chunks(data_iter):
+    try:
+        while data_iter.read():
+            pass
+    except StopIteration:
+        pass
+
+
+def read_lines(data_iter):
+    try:
+        while data_iter.readline():
+            pass
+    except StopIteration:
+        pass
+
+
+def run(iterator_class, read, chunk, size):
+    """
+    Read size bytes, written from another thread into a pipe
+
+    :returns: throughput in MB/s
+    """
+    # The former iterator loops forever over a last line without newline
+    size -= size % len(chunk)
+    read_fd, write_fd = os.pipe()
+    writer = threading.Thread(target=write_all, args=(write_fd, chunk, size))
+    writer.start()
+    data_iter = iterator_class(read_fd, 10, None)
+    start = time.time()
+    try:
+        read(data_iter)
+    finally:
+        elapsed = time.time() - start
+        writer.join()
+        data_iter.close()
+    return size / elapsed / 1024 / 1024
+
+
+def main(argv):
+    if len(argv) > 1 and not argv[1].isdigit():
+        print_usage(argv)
+        return
+    size = int(argv[1] if len(argv) > 1 else 64) * 1024 * 1024
+
+    line = b'x' * 99 + b'\n'
+    long_line = b'x' * (16 * 1024 - 1) + b'\n'
+    workloads = (('64 KB chunks', read_chunks, b'x' * 64 * 1024),
+                 ('100 B lines', read_lines, line * 655),
+                 ('16 KB lines', read_lines, long_line * 4))
+    print('Throughput over a pipe, reading %d MB' % (size / 1024 / 1024))
+    for name, read, chunk in workloads:
+        results = []
+        for iterator_class in (BytesFileDescriptorIterator,
+                               FileDescriptorIterator):
+            results.append(run(iterator_class, read, chunk, size))
+        print('%-12s: bytes %8.1f MB/s, bytearray %8.1f MB/s' % (
+            (name,) + tuple(results)))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
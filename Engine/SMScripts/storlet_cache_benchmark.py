@@ -0,0 +1,98 @@
+# Copyright (c) 2015, 2016 OpenStack Foundation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from storlet_gateway.gateways.docker.gateway import DockerStorletRequest, \
+    StorletGatewayDocker, storlet_cache_manifest
+
+
+class FakeFileManager(object):
+
+    def __init__(self, body):
+        self.body = body
+
+    def get_storlet(self, name):
+        return iter([self.body]), None
+
+    def get_dependency(self, name):
+        return iter([self.body]), '0755'
+
+
+def print_usage(argv):
+    print(argv[0] + ' [number of dependencies]')
+    print('Compares the cost of deploying a storlet with its dependencies '
+          'when bringing them from storage, when checking the cache on the '
+          'file system, and when found in the storlet cache manifest')
+
+
+def main(argv):
+    if len(argv) > 1 and not argv[1].isdigit():
+        print_usage(argv)
+        return
+    num_deps = int(argv[1]) if len(argv) > 1 else 2
+    number = 2000
+    body = 'x' * 64 * 1024
+
+    tmpdir = tempfile.mkdtemp()
+    sconf = {'cache_dir': os.path.join(tmpdir, 'cache', 'scopes'),
+             'storlets_dir': os.path.join(tmpdir, 'storlets', 'scopes'),
+             'storlet_timeout': '9'}
+    scope = 'scope'
+    gateway = StorletGatewayDocker(sconf, logging.getLogger(), scope)
+    options = {'storlet_main': 'org.openstack.storlet.Storlet',
+               'storlet_dependency': ','.join(
+                   'dep%d' % i for i in range(num_deps)),
+               'storlet_x_timestamp': '1',
+               'storlet_content_length': str(len(body)),
+               'file_manager': FakeFileManager(body)}
+    sreq = DockerStorletRequest('storlet-1.0.jar', {}, {}, iter([]),
+                                options=options)
+    print('Per request deployment cost, with %d dependencies' % num_deps)
+
+    def cold():
+        # Nothing is cached, everything is brought from storage
+        storlet_cache_manifest.invalidate(scope)
+        shutil.rmtree(os.path.join(tmpdir, 'cache'), ignore_errors=True)
+        shutil.rmtree(os.path.join(tmpdir, 'storlets'), ignore_errors=True)
+        gateway.update_docker_container_from_cache(sreq)
+
+    def warm_file_system():
+        # What every request used to cost, checking the cached files
+        storlet_cache_manifest.invalidate(scope)
+        gateway.update_docker_container_from_cache(sreq)
+
+    def warm_manifest():
+        gateway.update_docker_container_from_cache(sreq)
+
+    try:
+        for name, func, count in (('cold', cold, number // 10),
+                                  ('file system', warm_file_system, number),
+                                  ('manifest', warm_manifest, number)):
+            elapsed = timeit.timeit(func, number=count)
+            print('%-11s: %9.2f us, %8d per second' % (
+                name, elapsed * 1e6 / count, count / elapsed))
+    finally:
+        storlet_cache_manifest.invalidate(scope)
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,57 @@
+# Copyright (c) 2015, 2016 OpenStack Foundation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import sys
+import timeit
+
+from SBusPythonFacade.SBusDatagram import ClientSBusOutDatagram
+from SBusPythonFacade.SBusStorletCommand import SBUS_CMD_EXECUTE
+from storlet_gateway.common.stob import StorletRequest
+
+
+def main(argv):
+    num_params = int(argv[1]) if len(argv) > 1 else 20
+    number = 20000
+    params = dict(('param%d' % i, 'value%d' % i) for i in range(num_params))
+    print('Per request cost, with %d parameters' % num_params)
+
+    def deepcopy_request():
+        # What the request construction used to cost
+        sparams = copy.deepcopy(params)
+        sparams['storlet_execution_path'] = 'path'
+        return ClientSBusOutDatagram(SBUS_CMD_EXECUTE, [], [], sparams) \
+            .serialized_cmd_params
+
+    def storlet_request():
+        sreq = StorletRequest('Storlet-1.0.jar', params, {}, iter([]))
+        sreq.params['storlet_execution_path'] = 'path'
+        return ClientSBusOutDatagram(SBUS_CMD_EXECUTE, [], [],
+                                     sreq.params.as_dict()) \
+            .serialized_cmd_params
+
+    def construct_only():
+        return StorletRequest('Storlet-1.0.jar', params, {}, iter([]))
+
+    for name, func in (('deepcopy', deepcopy_request),
+                       ('request', storlet_request),
+                       ('construct', construct_only)):
+        elapsed = timeit.timeit(func, number=number)
+        print('%-9s: %7.2f us, %8d per second' % (
+            name, elapsed * 1e6 / number, number / elapsed))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
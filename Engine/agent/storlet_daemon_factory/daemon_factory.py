@@ -13,17 +13,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from contextlib import contextmanager
 import errno
+import json
 import logging
 from logging.handlers import SysLogHandler
 import os
 import pwd
+import select
 import signal
 import subprocess
+import threading
 import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 from SBusPythonFacade.SBus import SBus
+from SBusPythonFacade.SBus import SBusPoller
 from SBusPythonFacade.SBusDatagram import ClientSBusOutDatagram
+from SBusPythonFacade.SBusDatagram import SBUS_FRAMING_JSON
+from SBusPythonFacade.SBusDatagram import SBusServiceReply
+from SBusPythonFacade.SBusStorletCommand import SBUS_CMD_BATCH
 from SBusPythonFacade.SBusStorletCommand import SBUS_CMD_DAEMON_STATUS
 from SBusPythonFacade.SBusStorletCommand import SBUS_CMD_HALT
 from SBusPythonFacade.SBusStorletCommand import SBUS_CMD_PING
@@ -36,19 +48,71 @@ EXIT_SUCCESS = 0
 EXIT_FAILURE = 1
 
 
+class WorkerPool(object):
+    """
+    Fixed set of threads calling the functions submitted to the pool
+    """
+
+    def __init__(self, num_workers):
+        self._tasks = queue.Queue()
+        self._workers = []
+        for _ in range(num_workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            try:
+                if task is None:
+                    return
+                func, args = task
+                func(*args)
+            finally:
+                self._tasks.task_done()
+
+    def submit(self, func, *args):
+        """
+        Have a worker call func with the given arguments
+        """
+        self._tasks.put((func, args))
+
+    def drain(self):
+        """
+        Wait until all the submitted functions are done
+        """
+        self._tasks.join()
+
+    def close(self):
+        """
+        Wait until all the submitted functions are done, and stop the
+        workers
+        """
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+
 class DaemonFactory(object):
     """
     This class acts as the manager for storlet daemons.
 
     It listens to commands and reacts on them in an internal loop.
-    As for now (01-Dec-2014) it is a single thread, synchronous
-    processing.
+    The commands are processed by a pool of worker threads, so that a
+    slow daemon start does not delay the other commands. Commands about
+    the same storlet are still processed one at a time, and HALT and
+    STOP_DAEMONS are processed once the other commands are done.
     """
 
-    def __init__(self, path, logger):
+    def __init__(self, path, logger, num_workers=5):
         """
         :param path: Path to the pipe file internal SBus listens to
         :param logger: Logger to dump the information to
+        :param num_workers: Number of the threads processing commands
         """
 
         self.logger = logger
@@ -57,8 +121,30 @@ class DaemonFactory(object):
         self.storlet_name_to_pipe_name = dict()
         # Dictionary: map storlet name to daemon process PID
         self.storlet_name_to_pid = dict()
+        self.num_workers = num_workers
+        # Locks serializing the commands about each storlet
+        self.storlet_locks = dict()
+        self._storlet_locks_lock = threading.Lock()
+        # Lock serializing the changes of the environment
+        self._spawn_lock = threading.Lock()
 
         self.NUM_OF_TRIES_PINGING_STARTING_DAEMON = 10
+        self.PING_INTERVAL = 0.1
+        # Seconds to wait for a starting daemon to report its readiness
+        self.DAEMON_READY_TIMEOUT = 10
+        # Upper bounds (seconds) of the start latency histogram buckets, the
+        # last bucket counting the slower starts
+        self.START_LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1, 2, 5, 10]
+        self.start_latency_histogram = [0] * \
+            (len(self.START_LATENCY_BUCKETS) + 1)
+
+        # Start requests which spawned a daemon (cold) and which found it
+        # running already (warm), with the seconds spent in the spawns
+        self.start_stats = {'cold': 0, 'warm': 0, 'cold_time': 0.0}
+
+        # Seconds between the checks of a stop request while the SBus is idle
+        self.POLL_INTERVAL = 1
+        self._stop_event = threading.Event()
 
     def get_jvm_args(self, daemon_language, storlet_path, storlet_name,
                      pool_size, uds_path, log_level, container_id):
@@ -129,11 +215,18 @@ class DaemonFactory(object):
 
         return pargs
 
-    def spawn_subprocess(self, pargs):
+    def spawn_subprocess(self, pargs, env=None):
         """
         Launch a JVM process for some storlet daemon
 
+        The write end of a pipe is given to the daemon as its standard input,
+        and its number as its last argument, since the daemon does not
+        inherit the other file descriptors. The daemon writes 'OK' to it once
+        it listens on its SBus, so that we do not need to guess how long it
+        takes to initialize.
+
         :param pargs: Arguments for the JVM
+        :param env: Environment of the JVM, the current one by default
         :returns: (Status, Description text of possible error)
         """
         b_status = True
@@ -141,39 +234,59 @@ class DaemonFactory(object):
         try:
             self.logger.debug('START_DAEMON: actual invocation')
             self.logger.debug('The arguments are: {0}'.format(str(pargs)))
+            start = time.time()
             # TODO(takashi): We had better use contextmanager
             # TODO(takashi): Where is this closed?
             # TODO(takashi): Should we really use this?
             dn = open('/dev/null', 'w')
-            daemon_p = subprocess.Popen(pargs,
-                                        stdout=dn,
-                                        stderr=subprocess.PIPE,
-                                        shell=False)
-
-            logger_p = subprocess.Popen('logger',
-                                        stdin=daemon_p.stderr,
-                                        stdout=dn,
-                                        stderr=dn,
-                                        shell=False)
-            jvm_pid = daemon_p.pid
-            # Wait for the JVM initializes itself
-            time.sleep(1)
-            self.logger.debug('Daemon process ID is: {0}'.format(jvm_pid))
-            self.logger.debug('Logger process ID is: {0}'.format(logger_p.pid))
-            storlet_name = pargs[2]
-
-            # Does JVM run?
-            b_status, error_text = self.get_process_status_by_pid(
-                jvm_pid, storlet_name)
-            if b_status:
-                self.logger.debug('Keeping JVM PID in' +
-                                  'storlet_name_to_pid[{0}] = {1}'.
-                                  format(storlet_name, jvm_pid))
+            # The daemons do not inherit the file descriptors of the factory,
+            # such as the pipes of the daemons spawned by the other workers
+            ready_read_fd, ready_write_fd = os.pipe()
+            try:
+                daemon_p = subprocess.Popen(
+                    pargs + ['0'],
+                    stdin=ready_write_fd,
+                    stdout=dn,
+                    stderr=subprocess.PIPE,
+                    close_fds=True,
+                    shell=False,
+                    env=env)
+            except Exception:
+                os.close(ready_read_fd)
+                raise
+            finally:
+                # Only the daemon keeps the write end open, so that we
+                # get EOF if it exits before being ready
+                os.close(ready_write_fd)
+            try:
+                logger_p = subprocess.Popen('logger',
+                                            stdin=daemon_p.stderr,
+                                            stdout=dn,
+                                            stderr=dn,
+                                            close_fds=True,
+                                            shell=False)
+                jvm_pid = daemon_p.pid
+                self.logger.debug('Daemon process ID is: {0}'.format(jvm_pid))
+                self.logger.debug('Logger process ID is: {0}'.
+                                  format(logger_p.pid))
+                storlet_name = pargs[2]
+
                 # Keep JVM PID
                 self.storlet_name_to_pid[storlet_name] = jvm_pid
-                if not self.wait_for_daemon_to_initialize(storlet_name):
-                    # TODO(takashi): We shoud use more specific exception
-                    raise Exception('No response from Daemon')
+                b_ready = self.wait_for_daemon_ready(ready_read_fd,
+                                                     storlet_name)
+            finally:
+                os.close(ready_read_fd)
+
+            if b_ready is None:
+                # The daemon did not tell us, check it the old way
+                b_ready = self.wait_for_daemon_to_initialize(storlet_name)
+            if not b_ready:
+                b_status, error_text = self.get_process_status_by_pid(
+                    jvm_pid, storlet_name)
+                # TODO(takashi): We shoud use more specific exception
+                raise Exception('No response from Daemon: %s' % error_text)
+            self.record_start_latency(time.time() - start)
             self.logger.debug('START_DAEMON: just occurred')
             error_text = 'OK'
         except Exception:
@@ -185,11 +298,56 @@ class DaemonFactory(object):
         #                better make this raise Exception including message
         return b_status, error_text
 
+    def wait_for_daemon_ready(self, ready_fd, storlet_name):
+        """
+        Wait for the daemon to report that it is ready
+
+        :param ready_fd: read end of the pipe given to the daemon
+        :param storlet_name: Storlet name we are checking the daemon for
+        :returns: True if the daemon is ready, False if it exited before
+                  getting ready, and None if it did not report anything
+                  in time
+        """
+        rlist, _, _ = select.select([ready_fd], [], [],
+                                    self.DAEMON_READY_TIMEOUT)
+        if not rlist:
+            self.logger.info('{0} did not report readiness in {1} seconds'.
+                             format(storlet_name, self.DAEMON_READY_TIMEOUT))
+            return None
+        return os.read(ready_fd, 128) == 'OK'
+
+    def record_start_latency(self, latency):
+        """
+        Add the time a daemon took to get ready to the histogram
+
+        :param latency: seconds from the spawn to the readiness
+        """
+        for i, bound in enumerate(self.START_LATENCY_BUCKETS):
+            if latency <= bound:
+                self.start_latency_histogram[i] += 1
+                break
+        else:
+            self.start_latency_histogram[-1] += 1
+
+    def get_factory_status(self):
+        """
+        Get statistics about the daemons started by the factory
+
+        :returns: (Status (True), JSON encoded statistics)
+        """
+        histogram = [[bound, count] for bound, count in
+                     zip(self.START_LATENCY_BUCKETS + [None],
+                         self.start_latency_histogram)]
+        status = dict(self.start_stats)
+        status['start_latency_histogram'] = histogram
+        status['daemons'] = len(self.storlet_name_to_pid)
+        return True, json.dumps(status)
+
     def wait_for_daemon_to_initialize(self, storlet_name):
         """
         Send a Ping service datagram. Validate that
         Daemon response is correct. Give up after the
-        predefined number of attempts (5)
+        predefined number of attempts
 
         :param storlet_name: Storlet name we are checking the daemon for
         :returns: daemon status (True, False)
@@ -206,7 +364,7 @@ class DaemonFactory(object):
                 if ret >= 0:
                     if os.read(read_fd, 128) == 'OK':
                         return True
-                    time.sleep(1)
+                time.sleep(self.PING_INTERVAL)
             else:
                 return False
         finally:
@@ -231,9 +389,12 @@ class DaemonFactory(object):
         :returns: (Status, Description text of possible error)
         """
         if daemon_language.lower() in ['java']:
-            pargs = self.get_jvm_args(
-                daemon_language, storlet_path, storlet_name,
-                pool_size, uds_path, log_level, container_id)
+            # get_jvm_args sets the environment of the JVM in os.environ
+            with self._spawn_lock:
+                pargs = self.get_jvm_args(
+                    daemon_language, storlet_path, storlet_name,
+                    pool_size, uds_path, log_level, container_id)
+                env = dict(os.environ)
         else:
             error_txt = 'Got unsupported daemon language: %s' % daemon_language
             self.logger.error(error_txt)
@@ -247,12 +408,22 @@ class DaemonFactory(object):
                           format(storlet_name))
         b_status, _ = self.get_process_status_by_name(storlet_name)
         if b_status:
+            self.start_stats['warm'] += 1
             error_text = '{0} is already running'.format(storlet_name)
             self.logger.debug(error_text)
         else:
             self.logger.debug('{0} is not running. About to spawn process'.
                               format(storlet_name))
-            b_status, error_text = self.spawn_subprocess(pargs)
+            start = time.time()
+            b_status, error_text = self.spawn_subprocess(pargs, env)
+            elapsed = time.time() - start
+            self.start_stats['cold'] += 1
+            self.start_stats['cold_time'] += elapsed
+            self.logger.info('Spawning {0} took {1:.3f} seconds '
+                             '(cold starts: {2}, warm starts: {3})'.
+                             format(storlet_name, elapsed,
+                                    self.start_stats['cold'],
+                                    self.start_stats['warm']))
 
         return b_status, error_text
 
@@ -399,6 +570,24 @@ class DaemonFactory(object):
             b_status = True
         return b_status
 
+    @contextmanager
+    def storlet_lock(self, storlet_name):
+        """
+        Context manager serializing the commands about a storlet
+
+        :param storlet_name: Storlet name, None for the commands which are
+                             not about a storlet
+        """
+        if storlet_name is None:
+            yield
+            return
+        with self._storlet_locks_lock:
+            lock = self.storlet_locks.get(storlet_name)
+            if lock is None:
+                lock = self.storlet_locks[storlet_name] = threading.Lock()
+        with lock:
+            yield
+
     def dispatch_command(self, dtg, container_id):
         """
         Parse datagram. React on the request.
@@ -410,12 +599,55 @@ class DaemonFactory(object):
                   (Status, Descrion text of possible error,
                    Whether we need to continue operation)
         """
+        return self.dispatch(dtg.command, dtg.params, container_id)
+
+    def dispatch(self, command, prms, container_id):
+        """
+        React on a command
+
+        :param command: The command to process
+        :param prms: The parameters of the command
+        :param container_id: container id
+
+        :returns: The same tuple as dispatch_command
+        """
+        self.logger.debug("Received command {0}".format(command))
+
+        storlet_name = prms.get('storlet_name') if prms else None
+        with self.storlet_lock(storlet_name):
+            return self._dispatch_command(command, prms, container_id)
+
+    def dispatch_batch(self, prms, container_id):
+        """
+        React on the commands of a batch, in order
+
+        :param prms: The parameters of the batch command
+        :param container_id: container id
+
+        :returns: list of SBusServiceReply, one per command of the batch
+        """
+        replies = []
+        for sub_command in (prms or {}).get('commands', []):
+            command = sub_command.get('command')
+            if command in (SBUS_CMD_BATCH, SBUS_CMD_HALT,
+                           SBUS_CMD_STOP_DAEMONS):
+                replies.append(SBusServiceReply(
+                    False, '{0} can not be batched'.format(command)))
+                continue
+            try:
+                b_status, error_text, _ = self.dispatch(
+                    command, sub_command.get('params'), container_id)
+            except Exception:
+                self.logger.exception('Failed to process command %s' %
+                                      command)
+                b_status, error_text = False, 'Failed to process command'
+            replies.append(SBusServiceReply(b_status, error_text))
+        return replies
+
+    def _dispatch_command(self, command, prms, container_id):
         b_status = False
         error_text = ''
         b_iterate = True
-        command = dtg.command
-        prms = dtg.params
-        self.logger.debug("Received command {0}".format(command))
 
         # TODO(takashi): refactor this
         if command == SBUS_CMD_START_DAEMON:
@@ -435,8 +667,12 @@ class DaemonFactory(object):
                 self.process_kill(prms['storlet_name'])
         elif command == SBUS_CMD_DAEMON_STATUS:
             self.logger.debug('Do SBUS_CMD_DAEMON_STATUS')
-            b_status, error_text = \
-                self.get_process_status_by_name(prms['storlet_name'])
+            if prms and prms.get('storlet_name'):
+                b_status, error_text = \
+                    self.get_process_status_by_name(prms['storlet_name'])
+            else:
+                # Without storlet name, report the status of the factory
+                b_status, error_text = self.get_factory_status()
         elif command == SBUS_CMD_STOP_DAEMONS:
             self.logger.debug('Do SBUS_CMD_STOP_DAEMONS')
             b_status, error_text = self.process_kill_all()
@@ -451,7 +687,7 @@ class DaemonFactory(object):
             error_text = 'OK'
         else:
             b_status = False
-            error_text = "got unknown command %d" % command
+            error_text = "got unknown command %s" % command
             self.logger.error(error_text)
 
         self.logger.debug('Done')
@@ -473,51 +709,112 @@ class DaemonFactory(object):
             self.logger.error("Failed to create SBus. exiting.")
             return EXIT_FAILURE
 
-        b_iterate = True
-        b_status = True
-        error_text = ''
+        # Wait with a timeout, so that a stop request is noticed even when
+        # no command comes
+        poller = SBusPoller()
+        if poller.create() < 0 or poller.add(fd) < 0:
+            self.logger.error("Failed to create SBus poller. exiting.")
+            poller.close()
+            return EXIT_FAILURE
 
-        while b_iterate:
-            rc = sbus.listen(fd)
-            if rc < 0:
-                self.logger.error("Failed to wait on SBus. exiting.")
-                return EXIT_FAILURE
-            self.logger.debug("Wait returned")
-
-            dtg = sbus.receive(fd)
-            # TODO(eranr):
-            # Should we really be exitting here.
-            # If so should we exit the container altogether, so
-            # that it gets restarted?
-            if dtg is None:
-                self.logger.error("Failed to receive message. Exitting.")
-                return EXIT_FAILURE
-
-            outfd = dtg.get_service_out_fd()
-            if outfd is None:
-                self.logger.error("Received message does not have outfd."
-                                  " continuing.")
-                continue
+        b_iterate = True
+        pool = WorkerPool(self.num_workers)
 
-            self.logger.debug("Received outfd %d" % outfd)
-            with os.fdopen(outfd, 'w') as outfile:
-                b_status, error_text, b_iterate = \
-                    self.dispatch_command(dtg, container_id)
-                self.log_and_report(outfile, b_status, error_text)
+        try:
+            while b_iterate:
+                ready = poller.wait(self.POLL_INTERVAL)
+                if ready is None:
+                    self.logger.error("Failed to wait on SBus. exiting.")
+                    return EXIT_FAILURE
+                if self._stop_event.is_set():
+                    self.logger.info("Stop requested")
+                    pool.drain()
+                    self.shutdown_all_processes()
+                    break
+                if not ready:
+                    continue
+
+                dtg = sbus.receive(fd)
+                # TODO(eranr):
+                # Should we really be exitting here.
+                # If so should we exit the container altogether, so
+                # that it gets restarted?
+                if dtg is None:
+                    self.logger.error("Failed to receive message. Exitting.")
+                    return EXIT_FAILURE
+
+                outfd = dtg.get_service_out_fd()
+                if outfd is None:
+                    self.logger.error("Received message does not have outfd."
+                                      " continuing.")
+                    continue
+
+                self.logger.debug("Received outfd %d" % outfd)
+                if dtg.command in (SBUS_CMD_HALT, SBUS_CMD_STOP_DAEMONS):
+                    # Let the commands in progress complete first
+                    pool.drain()
+                    b_iterate = self.process_command(dtg, outfd,
+                                                     container_id)
+                else:
+                    pool.submit(self.process_command, dtg, outfd,
+                                container_id)
+        finally:
+            pool.close()
+            poller.close()
 
         # We left the main loop for some reason. Terminating.
         self.logger.debug('Leaving main loop')
         return EXIT_SUCCESS
 
-    def log_and_report(self, outfile, b_status, error_text):
+    def stop(self):
+        """
+        Request the main loop to stop the daemons and return, within
+        POLL_INTERVAL seconds
+        """
+        self._stop_event.set()
+
+    def process_command(self, dtg, outfd, container_id):
+        """
+        Process a command, and report the result back
+
+        :param dtg: Datagram to process
+        :param outfd: File descriptor to report the result to
+        :param container_id: container id
+        :returns: Whether we need to continue operation
+        """
+        with os.fdopen(outfd, 'w') as outfile:
+            replies = None
+            try:
+                if dtg.command == SBUS_CMD_BATCH:
+                    replies = self.dispatch_batch(dtg.params, container_id)
+                    b_status = all(reply.status for reply in replies)
+                    error_text = '{0} commands processed'.format(
+                        len(replies))
+                    b_iterate = True
+                else:
+                    b_status, error_text, b_iterate = \
+                        self.dispatch_command(dtg, container_id)
+            except Exception:
+                self.logger.exception('Failed to process command %s' %
+                                      dtg.command)
+                b_status, error_text, b_iterate = \
+                    False, 'Failed to process command', True
+            self.log_and_report(outfile, b_status, error_text, replies)
+        return b_iterate
+
+    def log_and_report(self, outfile, b_status, error_text, replies=None):
         """
         Send result result description message back to swift middleware
 
         :param outfile : Output channel to send the message to
         :param b_status : Flag, whether the operation was successful
         :param error_text: The result description
+        :param replies: The replies of the commands of a batch
         """
-        answer = str(b_status) + ': ' + error_text
+        # The binary framing is not advertised until the decoding of the
+        # Java storlet daemons is tested, and shown to be faster
+        answer = SBusServiceReply(b_status, error_text, replies,
+                                  framing=SBUS_FRAMING_JSON).serialize()
         self.logger.debug(' Just processed command')
         self.logger.debug(' Going to answer: %s' % answer)
         try:
@@ -589,7 +886,7 @@ def main(argv):
     # Initialize logger
     logger = start_logger("daemon_factory", log_level, container_id)
     logger.debug("Daemon factory started")
-    SBus.start_logger("DEBUG", container_id=container_id)
+    SBus.start_logger(log_level.upper(), container_id=container_id)
 
     # Impersonate the swift user
     pw = pwd.getpwnam('swift')
@@ -598,6 +895,7 @@ def main(argv):
 
     # create an instance of daemon_factory
     factory = DaemonFactory(pipe_path, logger)
+    signal.signal(signal.SIGTERM, lambda signum, frame: factory.stop())
 
     # Start the main loop
     return factory.main_loop(container_id)
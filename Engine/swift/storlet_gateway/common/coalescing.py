@@ -0,0 +1,298 @@
+# Copyright (c) 2015, 2016 OpenStack Foundation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import eventlet
+from eventlet.event import Event
+
+from storlet_gateway.common.exceptions import StorletConfigError
+
+
+def _skip(data_iter, offset):
+    """
+    Iterate over data, but its first offset bytes
+    """
+    try:
+        for chunk in data_iter:
+            if offset >= len(chunk):
+                offset -= len(chunk)
+                continue
+            if offset:
+                chunk = chunk[offset:]
+                offset = 0
+            yield chunk
+    finally:
+        close = getattr(data_iter, 'close', None)
+        if close:
+            close()
+
+
+class _Consumer(object):
+    """
+    A request reading the output of a shared invocation
+    """
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+        # Index of the next chunk to read, and number of bytes read
+        self.position = 0
+        self.offset = 0
+        self.detached = False
+
+
+class _SharedInvocation(object):
+    """
+    An invocation whose output is read by several requests
+
+    A greenthread reads the output into a buffer, which the requests read
+    at their own pace. The chunks are dropped once all the requests read
+    them, and requests can only join the invocation as long as its first
+    chunk is buffered.
+    """
+
+    def __init__(self, coalescer, key):
+        self.coalescer = coalescer
+        self.key = key
+        # Sent with True once the invocation started, False if it failed
+        self.ready = Event()
+        self.user_metadata = None
+        self.chunks = []
+        # Index of the first buffered chunk, and size of the buffered chunks
+        self.base = 0
+        self.buffered = 0
+        self.consumers = []
+        self.done = False
+        self.error = None
+        # Replaced at each notification
+        self._data = Event()
+        self._space = Event()
+
+    @property
+    def joinable(self):
+        return not self.done and self.base == 0
+
+    def join(self, fallback):
+        """
+        Read the output of the invocation
+
+        :param fallback: callable running an invocation for the request
+                         alone, and returning its data iterator
+        :returns: (user metadata, data iterator) tuple, or None when the
+                  invocation can not be joined
+        """
+        if not self.ready.wait() or not self.joinable:
+            return None
+        consumer = _Consumer(fallback)
+        self.consumers.append(consumer)
+        return self.user_metadata, self._iter(consumer)
+
+    def start(self, user_metadata, data_iter):
+        self.user_metadata = user_metadata
+        self.ready.send(True)
+        eventlet.spawn_n(self._produce, data_iter)
+
+    def fail(self):
+        self.done = True
+        self.coalescer._remove(self)
+        self.ready.send(False)
+
+    def _notify(self, name):
+        event = getattr(self, name)
+        setattr(self, name, Event())
+        event.send()
+
+    def _trim(self):
+        """
+        Drop the chunks read by all the requests
+        """
+        if self.consumers:
+            low = min(consumer.position for consumer in self.consumers)
+        else:
+            low = self.base + len(self.chunks)
+        if low > self.base:
+            for chunk in self.chunks[:low - self.base]:
+                self.buffered -= len(chunk)
+            del self.chunks[:low - self.base]
+            self.base = low
+            self._notify('_space')
+
+    def _detach_slowest(self):
+        """
+        Detach the requests which did not read the oldest buffered chunk
+        onto their own invocation
+
+        The requests are only detached when others are stalled by them.
+        Otherwise the slowest requests are the only ones, and the
+        invocation just goes on at their pace.
+        """
+        positions = [consumer.position for consumer in self.consumers]
+        low = min(positions)
+        if max(positions) == low:
+            return
+        for consumer in list(self.consumers):
+            if consumer.position == low:
+                consumer.detached = True
+                self.consumers.remove(consumer)
+                self.coalescer.stats['detached'] += 1
+        self._notify('_data')
+        self._trim()
+
+    def _produce(self, data_iter):
+        try:
+            for chunk in data_iter:
+                self.chunks.append(chunk)
+                self.buffered += len(chunk)
+                self._notify('_data')
+                while (self.buffered > self.coalescer.buffer_size and
+                       self.consumers):
+                    freed = False
+                    with eventlet.Timeout(self.coalescer.detach_timeout,
+                                          False):
+                        self._space.wait()
+                        freed = True
+                    if not freed:
+                        self._detach_slowest()
+                if not self.consumers:
+                    # All the requests went away or were detached
+                    break
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self.coalescer._remove(self)
+            close = getattr(data_iter, 'close', None)
+            if close:
+                close()
+            self._notify('_data')
+
+    def _iter(self, consumer):
+        try:
+            while not consumer.detached:
+                index = consumer.position - self.base
+                if index < len(self.chunks):
+                    chunk = self.chunks[index]
+                    consumer.position += 1
+                    consumer.offset += len(chunk)
+                    self._trim()
+                    yield chunk
+                elif self.done:
+                    if self.error:
+                        raise self.error
+                    return
+                else:
+                    self._data.wait()
+        finally:
+            if consumer in self.consumers:
+                self.consumers.remove(consumer)
+                self._trim()
+
+        # The request was too slow, so that it goes on with its own
+        # invocation, from where it stopped
+        for chunk in _skip(consumer.fallback(), consumer.offset):
+            yield chunk
+
+
+class InvocationCoalescer(object):
+    """
+    Shares an invocation between the concurrent identical requests
+
+    The requests with the same key, that is with the same input object,
+    storlet, parameters and range, read the output of a single invocation.
+    The output is buffered up to buffer_size bytes for the slower requests.
+    A request which does not read the buffered output within detach_timeout
+    seconds is detached onto its own invocation, rather than stalling the
+    others. A request which stalls no other one is never detached.
+    """
+
+    def __init__(self, buffer_size=1048576, detach_timeout=1.0):
+        """
+        :param buffer_size: maximum size in bytes of the buffered output
+        :param detach_timeout: seconds to wait for a slow request before
+                               detaching it
+        """
+        self.buffer_size = buffer_size
+        self.detach_timeout = detach_timeout
+        self.invocations = {}
+        self.stats = {'invocations': 0, 'coalesced': 0, 'detached': 0}
+
+    def _remove(self, shared):
+        if self.invocations.get(shared.key) is shared:
+            del self.invocations[shared.key]
+
+    def invoke(self, key, invoke, fallback):
+        """
+        Run an invocation, or join an identical one
+
+        :param key: key of the invocation output
+        :param invoke: callable running the invocation, and returning its
+                       (user metadata, data iterator) tuple
+        :param fallback: callable running an invocation for the request
+                         alone, and returning its data iterator
+        :returns: (user metadata, data iterator) tuple
+        """
+        shared = self.invocations.get(key)
+        if shared is not None:
+            result = shared.join(fallback)
+            if result is not None:
+                self.stats['coalesced'] += 1
+                return result
+
+        # The identical invocation, if any, failed or went too far to be
+        # joined, so that this one replaces it
+        shared = self.invocations[key] = _SharedInvocation(self, key)
+        self.stats['invocations'] += 1
+        try:
+            user_metadata, data_iter = invoke()
+        except Exception:
+            shared.fail()
+            raise
+        shared.start(user_metadata, data_iter)
+        return shared.join(fallback)
+
+
+# The coalescers are shared by the handlers of a process
+_coalescers = {}
+
+
+def get_invocation_coalescer(conf):
+    """
+    Get the invocation coalescer of the process
+
+    The coalescer is given by the following configuration values:
+    - storlet_coalescing_buffer_size: maximum size in bytes of the output
+      buffered for the slower requests, 0 to disable the coalescing
+    - storlet_coalescing_detach_timeout: seconds to wait for a slow request
+      before detaching it onto its own invocation
+
+    :param conf: gateway conf dict
+    :returns: InvocationCoalescer instance, or None when disabled
+    :raises StorletConfigError: when the configuration is invalid
+    """
+    try:
+        buffer_size = int(conf.get('storlet_coalescing_buffer_size',
+                                   1048576))
+        detach_timeout = float(conf.get('storlet_coalescing_detach_timeout',
+                                        1.0))
+    except ValueError as e:
+        raise StorletConfigError('Invalid coalescing configuration: %s' % e)
+    if buffer_size <= 0:
+        return None
+    if detach_timeout <= 0:
+        raise StorletConfigError('storlet_coalescing_detach_timeout must be '
+                                 'positive')
+
+    key = (buffer_size, detach_timeout)
+    if key not in _coalescers:
+        _coalescers[key] = InvocationCoalescer(buffer_size, detach_timeout)
+    return _coalescers[key]
@@ -24,6 +24,10 @@ class StorletTimeout(Timeout, StorletRuntimeException):
     pass
 
 
+class StorletSendError(StorletRuntimeException):
+    pass
+
+
 class StorletConfigError(Exception):
     pass
 
@@ -0,0 +1,185 @@
+# Copyright (c) 2015, 2016 OpenStack Foundation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import eventlet
+from eventlet.queue import Full, LightQueue
+
+from storlet_gateway.common.exceptions import StorletConfigError
+
+
+class _LogUpload(object):
+    """
+    A log upload waiting in the queue
+    """
+
+    def __init__(self, file_manager, obj_name, log_path, offset, logger):
+        self.file_manager = file_manager
+        self.obj_name = obj_name
+        self.log_path = log_path
+        self.offset = offset
+        self.logger = logger
+        # Number of failed attempts
+        self.failures = 0
+
+
+class StorletLogUploader(object):
+    """
+    Uploads the storlet logs into Swift off the request path
+
+    The uploads are queued in a bounded queue, and done by a background
+    greenthread. The uploads into the same log object are coalesced while
+    they are waiting, that is the log file is uploaded once with the logs of
+    all the invocations. Failed uploads are queued again once their retry
+    is due, so that they do not delay the others, and uploads are dropped
+    when the queue is full. The stats dictionary counts the uploads.
+    """
+
+    def __init__(self, queue_size=100, retries=3, retry_interval=1.0):
+        """
+        :param queue_size: maximum number of uploads waiting
+        :param retries: number of retries of a failed upload
+        :param retry_interval: seconds to wait before the first retry, the
+                               next ones waiting longer
+        """
+        self.queue = LightQueue(queue_size)
+        self.retries = retries
+        self.retry_interval = retry_interval
+        # Uploads waiting in the queue, by (log path, object name)
+        self.pending = {}
+        self.stats = {'queued': 0, 'coalesced': 0, 'dropped': 0,
+                      'uploaded': 0, 'failed': 0}
+        self._worker = None
+
+    def submit(self, file_manager, obj_name, log_path, offset=0,
+               logger=None):
+        """
+        Queue the upload of a log file
+
+        :param file_manager: FileManager used to put the log object
+        :param obj_name: name of the log object
+        :param log_path: path to the log file
+        :param offset: offset in the log file of the data to upload
+        :param logger: logger to report the failures to
+        :returns: False if the upload was dropped because the queue is full
+        """
+        upload = _LogUpload(file_manager, obj_name, log_path, offset, logger)
+        key = (log_path, obj_name)
+        if key in self.pending:
+            # The waiting upload will take the new logs as well
+            self.pending[key] = upload
+            self.stats['coalesced'] += 1
+            return True
+
+        try:
+            self.queue.put_nowait(key)
+        except Full:
+            self.stats['dropped'] += 1
+            if logger:
+                logger.warning('Log upload queue is full, dropping the '
+                               'upload of %s' % obj_name)
+            return False
+        self.pending[key] = upload
+        self.stats['queued'] += 1
+
+        if self._worker is None:
+            self._worker = eventlet.spawn(self._run)
+        return True
+
+    def _run(self):
+        while True:
+            key = self.queue.get()
+            self.upload(self.pending.pop(key))
+
+    def upload(self, upload):
+        """
+        Upload a log file
+
+        A failed upload is queued again after retry_interval seconds, the
+        next retries waiting longer.
+
+        :param upload: _LogUpload instance
+        :returns: True if the log was uploaded
+        """
+        try:
+            with open(upload.log_path, 'r') as logfile:
+                logfile.seek(upload.offset)
+                upload.file_manager.put_log(upload.obj_name, logfile)
+        except Exception:
+            upload.failures += 1
+            if upload.failures <= self.retries:
+                eventlet.spawn_after(self.retry_interval * upload.failures,
+                                     self._retry, upload)
+            else:
+                self._fail(upload, 'Failed to upload log %s after %d '
+                                   'retries' % (upload.obj_name,
+                                                self.retries))
+            return False
+        self.stats['uploaded'] += 1
+        return True
+
+    def _retry(self, upload):
+        """
+        Queue a failed upload again
+        """
+        key = (upload.log_path, upload.obj_name)
+        if key in self.pending:
+            # The waiting upload will take the logs of this one as well
+            self.stats['coalesced'] += 1
+            return
+
+        try:
+            self.queue.put_nowait(key)
+        except Full:
+            self._fail(upload, 'Log upload queue is full, dropping the '
+                               'retry of %s' % upload.obj_name)
+            return
+        self.pending[key] = upload
+
+    def _fail(self, upload, message):
+        self.stats['failed'] += 1
+        if upload.logger:
+            upload.logger.error(message)
+
+
+# The uploaders are shared by the gateways of a process
+_log_uploaders = {}
+
+
+def get_log_uploader(conf):
+    """
+    Get the log uploader of the process
+
+    The uploader is given by the following configuration values:
+    - storlet_log_upload_queue_size: maximum number of uploads waiting
+    - storlet_log_upload_retries: number of retries of a failed upload
+
+    :param conf: gateway conf dict
+    :returns: StorletLogUploader instance
+    :raises StorletConfigError: when the configuration is invalid
+    """
+    try:
+        queue_size = int(conf.get('storlet_log_upload_queue_size', 100))
+        retries = int(conf.get('storlet_log_upload_retries', 3))
+    except ValueError as e:
+        raise StorletConfigError('Invalid log upload configuration: %s' % e)
+    if queue_size <= 0 or retries < 0:
+        raise StorletConfigError('storlet_log_upload_queue_size must be '
+                                 'positive and storlet_log_upload_retries '
+                                 'can not be negative')
+
+    key = (queue_size, retries)
+    if key not in _log_uploaders:
+        _log_uploaders[key] = StorletLogUploader(queue_size, retries)
+    return _log_uploaders[key]
@@ -0,0 +1,313 @@
+# Copyright (c) 2015, 2016 OpenStack Foundation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+import eventlet
+from eventlet import tpool
+
+from storlet_gateway.common.exceptions import StorletConfigError
+
+DATA_SUFFIX = '.data'
+META_SUFFIX = '.meta'
+TEMP_PREFIX = '.tmp'
+
+
+def output_cache_key(path, etag, timestamp, storlet, storlet_timestamp,
+                     params, storlet_range=None):
+    """
+    Build the key of a storlet output
+
+    :param path: path of the input object
+    :param etag: ETag of the input object
+    :param timestamp: X-Timestamp of the input object, which a POST of its
+                      metadata changes
+    :param storlet: name of the storlet object
+    :param storlet_timestamp: X-Timestamp of the storlet object
+    :param params: dict of the invocation parameters
+    :param storlet_range: value of X-Storlet-Range, if any
+    :returns: the key, as an hexadecimal digest
+    """
+    canonical = json.dumps([path, etag.strip('"'), timestamp, storlet,
+                            storlet_timestamp, sorted(params.items()),
+                            storlet_range])
+    return hashlib.md5(canonical).hexdigest()
+
+
+class StorletOutputCache(object):
+    """
+    Keeps the outputs of the deterministic storlets on a local disk
+
+    The output of an invocation is written to the cache while it is sent to
+    the client, and is only kept once it was entirely sent. The outputs are
+    evicted in least recently used order, so that the cache does not grow
+    beyond max_size bytes. The cache directory is scanned at start, and
+    again every rescan_interval seconds, so that the outputs written by the
+    other processes sharing the directory, or before a restart, are
+    accounted for and evicted as well. The temporary files left by the
+    writers which died are removed by the scans. The scans run in a
+    background greenthread, which lists the directory in a native thread
+    so that the requests are not blocked meanwhile.
+    """
+
+    def __init__(self, cache_dir, max_size, chunk_size=65536,
+                 rescan_interval=60, temp_max_age=3600):
+        """
+        :param cache_dir: directory keeping the outputs
+        :param max_size: maximum size in bytes of the kept outputs
+        :param chunk_size: size of the chunks the outputs are read by
+        :param rescan_interval: seconds between the scans of the directory
+        :param temp_max_age: seconds after which a temporary file is
+                             considered to be left by a dead writer
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.rescan_interval = rescan_interval
+        self.temp_max_age = temp_max_age
+        # Sizes of the outputs by key, in least recently used order
+        self._sizes = OrderedDict()
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0}
+        # The running scan, and the outputs used or evicted since it began
+        self._scanner = None
+        self._changed = set()
+        self._last_scan = 0
+        self._start_scan()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.cache_dir, key + suffix)
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _start_scan(self):
+        if self._scanner is None:
+            self._last_scan = time.time()
+            self._changed = set()
+            self._scanner = eventlet.spawn(self._scan)
+
+    def _scan(self):
+        """
+        Account for the outputs on disk, in their last use order
+        """
+        try:
+            outputs = tpool.execute(self._list_outputs)
+        finally:
+            self._scanner = None
+
+        # The outputs used or evicted during the scan are accounted for as
+        # they are now
+        sizes = OrderedDict((key, size) for _, key, size in outputs
+                            if key not in self._changed)
+        for key, size in self._sizes.items():
+            if key in self._changed:
+                sizes[key] = size
+        self._sizes = sizes
+        self.size = sum(sizes.values())
+        self._evict()
+
+    def _list_outputs(self):
+        """
+        List the outputs in the cache directory, and remove the stale
+        temporary files
+
+        :returns: list of (last use, key, size), in last use order
+        """
+        now = time.time()
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            names = []
+
+        outputs = []
+        for name in names:
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if name.startswith(TEMP_PREFIX):
+                if stat.st_mtime + self.temp_max_age < now:
+                    self._unlink(path)
+            elif name.endswith(DATA_SUFFIX):
+                outputs.append((max(stat.st_atime, stat.st_mtime),
+                                name[:-len(DATA_SUFFIX)], stat.st_size))
+            elif name.endswith(META_SUFFIX):
+                # The metadata is stored right before the data
+                key = name[:-len(META_SUFFIX)]
+                if stat.st_mtime + self.temp_max_age < now and \
+                        key + DATA_SUFFIX not in names:
+                    self._unlink(path)
+        outputs.sort()
+        return outputs
+
+    def _evict(self):
+        while self.size > self.max_size and self._sizes:
+            evicted_key, evicted_size = self._sizes.popitem(last=False)
+            self.size -= evicted_size
+            self._unlink(self._path(evicted_key, DATA_SUFFIX))
+            self._unlink(self._path(evicted_key, META_SUFFIX))
+            self._changed.add(evicted_key)
+            self.stats['evicted'] += 1
+
+    def _forget(self, key):
+        self.size -= self._sizes.pop(key, 0)
+        self._changed.add(key)
+
+    def _remember(self, key, size):
+        self._forget(key)
+        self._sizes[key] = size
+        self.size += size
+        self._evict()
+
+    def get(self, key):
+        """
+        Get a cached output
+
+        :param key: key of the output, given by output_cache_key
+        :returns: (user metadata, data iterator) tuple, or None on miss
+        """
+        try:
+            with open(self._path(key, META_SUFFIX), 'r') as meta_file:
+                user_metadata = json.load(meta_file)
+            data_file = open(self._path(key, DATA_SUFFIX), 'rb')
+        except (IOError, OSError, ValueError):
+            self._forget(key)
+            self.stats['misses'] += 1
+            return None
+
+        # The last use is kept on disk for the scans
+        try:
+            os.utime(self._path(key, DATA_SUFFIX), None)
+        except OSError:
+            pass
+        self._remember(key, os.fstat(data_file.fileno()).st_size)
+        self.stats['hits'] += 1
+        return user_metadata, self._iter_file(data_file)
+
+    def _iter_file(self, data_file):
+        try:
+            while True:
+                chunk = data_file.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            data_file.close()
+
+    def _open_temp_file(self):
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX,
+                                             dir=self.cache_dir)
+        except (IOError, OSError):
+            return None, None
+        return os.fdopen(fd, 'wb'), temp_path
+
+    def tee(self, key, user_metadata, data_iter):
+        """
+        Pass an output through, while writing it to the cache
+
+        :param key: key of the output, given by output_cache_key
+        :param user_metadata: user metadata of the output
+        :param data_iter: iterator over the output data
+        :returns: iterator over the output data
+        """
+        # The temporary file is only created once the output is read, so
+        # that the finally clause always removes it
+        temp_file, temp_path = self._open_temp_file()
+        size = 0
+        complete = False
+        try:
+            for chunk in data_iter:
+                if temp_file:
+                    size += len(chunk)
+                    if size > self.max_size:
+                        # The output would evict all the others
+                        temp_file.close()
+                        temp_file = None
+                    else:
+                        temp_file.write(chunk)
+                yield chunk
+            complete = temp_file is not None
+        finally:
+            if temp_file:
+                temp_file.close()
+            if complete:
+                self._store(key, user_metadata, temp_path, size)
+            elif temp_path:
+                self._unlink(temp_path)
+            close = getattr(data_iter, 'close', None)
+            if close:
+                close()
+
+    def _store(self, key, user_metadata, temp_path, size):
+        try:
+            fd, meta_path = tempfile.mkstemp(prefix=TEMP_PREFIX,
+                                             dir=self.cache_dir)
+            with os.fdopen(fd, 'w') as meta_file:
+                json.dump(user_metadata or {}, meta_file)
+            os.rename(meta_path, self._path(key, META_SUFFIX))
+            os.rename(temp_path, self._path(key, DATA_SUFFIX))
+        except (IOError, OSError):
+            self._unlink(temp_path)
+            return
+        self.stats['stored'] += 1
+        self._remember(key, size)
+        if self._last_scan + self.rescan_interval <= time.time():
+            self._start_scan()
+
+
+# The output caches are shared by the handlers of a process
+_output_caches = {}
+
+
+def get_output_cache(conf):
+    """
+    Get the output cache of the process
+
+    The cache is given by the following configuration values:
+    - storlet_output_cache_dir: directory keeping the outputs, empty
+      (default) to disable the cache
+    - storlet_output_cache_size: maximum size in bytes of the kept outputs
+
+    :param conf: gateway conf dict
+    :returns: StorletOutputCache instance, or None when disabled
+    :raises StorletConfigError: when the configuration is invalid
+    """
+    cache_dir = conf.get('storlet_output_cache_dir')
+    if not cache_dir:
+        return None
+    try:
+        max_size = int(conf.get('storlet_output_cache_size', 1073741824))
+    except ValueError as e:
+        raise StorletConfigError('Invalid output cache size: %s' % e)
+    if max_size <= 0:
+        raise StorletConfigError('storlet_output_cache_size must be positive')
+
+    key = (cache_dir, max_size)
+    if key not in _output_caches:
+        _output_caches[key] = StorletOutputCache(cache_dir, max_size)
+    return _output_caches[key]
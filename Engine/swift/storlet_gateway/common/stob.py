@@ -13,23 +13,52 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import copy
+import io
 import os
 import select
+from collections import MutableMapping
 from storlet_gateway.common.exceptions import StorletTimeout
+from storlet_gateway.common.streaming import FixedChunkSize
 
 
 class FileDescriptorIterator(object):
-    def __init__(self, obj_data, timeout, cancel_func):
+    """
+    File like iterator over a file descriptor
+
+    Data read ahead of the caller, e.g. by readline, is kept in a reusable
+    bytearray, self._buf[self._start:self._end], which is filled in place
+    with readinto. Reads going past an empty buffer return the data as read
+    from the file descriptor, without copying it into the buffer.
+    """
+
+    def __init__(self, obj_data, timeout, cancel_func, chunk_size=64 * 1024,
+                 chunk_policy=None):
+        """
+        :param obj_data: file descriptor to read from
+        :param timeout: timeout for each read
+        :param cancel_func: function called when a read times out
+        :param chunk_size: size of the chunks returned by the iteration,
+                           and initial size of the read ahead buffer
+        :param chunk_policy: optional chunk size policy, such as
+                             AdaptiveChunkSize, overriding chunk_size
+        """
         self.closed = False
         self.obj_data = obj_data
         self.timeout = timeout
         self.cancel_func = cancel_func
-        self.buf = b''
+        self.chunk_policy = chunk_policy or FixedChunkSize(chunk_size)
+        self._buf = bytearray(self.chunk_size)
+        self._start = 0
+        self._end = 0
+        self._reader = None
 
     def __iter__(self):
         return self
 
+    @property
+    def chunk_size(self):
+        return self.chunk_policy.chunk_size
+
     def read_with_timeout(self, size):
         try:
             with StorletTimeout(self.timeout):
@@ -44,60 +73,152 @@ class FileDescriptorIterator(object):
             raise
         return chunk
 
-    def next(self, size=64 * 1024):
-        if len(self.buf) < size:
+    def _readinto_with_timeout(self, view):
+        if self._reader is None:
+            self._reader = io.FileIO(self.obj_data, 'rb', closefd=False)
+        try:
+            with StorletTimeout(self.timeout):
+                read = self._reader.readinto(view)
+        except StorletTimeout:
+            if self.cancel_func:
+                self.cancel_func()
+            self.close()
+            raise
+        except Exception:
+            self.close()
+            raise
+        return read or 0
+
+    @property
+    def _buffered(self):
+        return self._end - self._start
+
+    def _reserve(self, size):
+        """
+        Make room in the buffer for size bytes after the buffered data
+        """
+        if len(self._buf) - self._end >= size:
+            return
+        buffered = self._buffered
+        if self._start:
+            # Move the buffered data to the beginning of the buffer
+            self._buf[:buffered] = \
+                memoryview(self._buf)[self._start:self._end].tobytes()
+            self._start = 0
+            self._end = buffered
+        if len(self._buf) < buffered + size:
+            self._buf.extend(bytearray(buffered + size - len(self._buf)))
+
+    def _fill(self, size):
+        """
+        Read up to size bytes from the file descriptor into the buffer
+
+        :returns: number of bytes read, 0 at the end of the file
+        :raises StopIteration: when the file descriptor is not ready
+        """
+        r, w, e = select.select([self.obj_data], [], [], self.timeout)
+        if len(r) == 0:
+            self.close()
+
+        if self.obj_data not in r:
+            raise StopIteration('Stopped iterator ex')
+
+        self._reserve(size)
+        view = memoryview(self._buf)[self._end:self._end + size]
+        try:
+            read = self._readinto_with_timeout(view)
+        finally:
+            # The buffer can not be resized while the view is alive
+            del view
+        self._end += read
+        return read
+
+    def _consume(self, size):
+        """
+        Take size bytes out of the buffer
+        """
+        end = self._start + size
+        data = memoryview(self._buf)[self._start:end].tobytes()
+        self._start = end
+        if self._start == self._end:
+            self._start = self._end = 0
+        return data
+
+    def next(self, size=None):
+        adapt = size is None
+        if adapt:
+            size = self.chunk_size
+
+        if self._start == self._end:
             r, w, e = select.select([self.obj_data], [], [], self.timeout)
             if len(r) == 0:
                 self.close()
 
-            if self.obj_data in r:
-                self.buf += self.read_with_timeout(size - len(self.buf))
-                if self.buf == b'':
-                    raise StopIteration('Stopped iterator ex')
-            else:
+            if self.obj_data not in r:
                 raise StopIteration('Stopped iterator ex')
 
-        if len(self.buf) > size:
-            data = self.buf[:size]
-            self.buf = self.buf[size:]
-        else:
-            data = self.buf
-            self.buf = b''
-        return data
+            data = self.read_with_timeout(size)
+            if data == b'':
+                raise StopIteration('Stopped iterator ex')
+            if adapt:
+                self.chunk_policy.update(size, len(data))
+            return data
+
+        if self._buffered < size:
+            self._fill(size - self._buffered)
+
+        return self._consume(min(size, self._buffered))
 
     def _close_check(self):
         if self.closed:
             raise ValueError('I/O operation on closed file')
 
-    def read(self, size=64 * 1024):
+    def read(self, size=None):
         self._close_check()
         return self.next(size)
 
     def readline(self, size=-1):
         self._close_check()
 
-        # read data into self.buf if there is not enough data
-        while b'\n' not in self.buf and \
-              (size < 0 or len(self.buf) < size):
-            if size < 0:
-                chunk = self.read()
+        if size < 0:
+            newline = self._buf.find(b'\n', self._start, self._end)
+            if newline >= 0:
+                # The whole line is already buffered
+                start = self._start
+                self._start = newline + 1
+                return memoryview(self._buf)[start:self._start].tobytes()
+
+        # read data into self._buf until it contains a whole line, or
+        # enough data
+        scanned = self._start
+        while True:
+            newline = self._buf.find(b'\n', scanned, self._end)
+            if newline >= 0:
+                length = newline + 1 - self._start
+                break
+            length = self._buffered
+            if size >= 0 and length >= size:
+                break
+            if size >= 0:
+                read = self._fill(size - length)
+            elif length < len(self._buf):
+                # Fill the buffer up, it grows only for long lines
+                read = self._fill(len(self._buf) - length)
             else:
-                chunk = self.read(size - len(self.buf))
-            if not chunk:
+                read = self._fill(self.chunk_size)
+            if not read:
                 break
-            self.buf += chunk
+            # Only the new data needs to be scanned. _fill may have moved
+            # the buffered data.
+            scanned = self._end - read
 
-        # Retrieve one line from buf
-        data, sep, rest = self.buf.partition(b'\n')
-        data += sep
-        self.buf = rest
+        if size >= 0:
+            length = min(length, size)
 
-        # cut out size from retrieved line
-        if size >= 0 and len(data) > size:
-            self.buf = data[size:] + self.buf
-            data = data[:size]
+        if not length:
+            raise StopIteration('Stopped iterator ex')
 
-        return data
+        return self._consume(length)
 
     def readlines(self, sizehint=-1):
         self._close_check()
@@ -121,6 +242,7 @@ class FileDescriptorIterator(object):
             return
         os.close(self.obj_data)
         self.closed = True
+        self._reader = None
 
     def __del__(self):
         self.close()
@@ -128,7 +250,7 @@ class FileDescriptorIterator(object):
 
 class StorletData(object):
     def __init__(self, user_metadata, data_iter=None, data_fd=None,
-                 timeout=10, cancel=None):
+                 timeout=10, cancel=None, chunk_policy=None):
         if data_iter is None and data_fd is None:
             raise ValueError('Either of data_iter or data_fd should not be '
                              'None')
@@ -139,12 +261,14 @@ class StorletData(object):
         self._data_iter = data_iter
         self.timeout = timeout
         self.cancel = cancel
+        self.chunk_policy = chunk_policy
 
     @property
     def data_iter(self):
         if self._data_iter is None:
             self._data_iter = FileDescriptorIterator(
-                self.data_fd, self.timeout, self.cancel)
+                self.data_fd, self.timeout, self.cancel,
+                chunk_policy=self.chunk_policy)
         return self._data_iter
 
     @property
@@ -152,6 +276,66 @@ class StorletData(object):
         return self.data_fd is not None
 
 
+class StorletParams(MutableMapping):
+    """
+    Copy-on-write view of the parameters of a storlet invocation
+
+    The given parameters, e.g. the query parameters of the swob request, are
+    only copied when the invocation changes them. The copy is shallow, that
+    is the values are expected to be immutable, such as strings.
+    """
+
+    def __init__(self, params=None):
+        """
+        :param params: dict of the parameters, which is never changed
+        """
+        if params is None:
+            params = {}
+        elif not isinstance(params, dict):
+            params = dict(params)
+        self._params = params
+        self._owned = False
+
+    def _own(self):
+        if not self._owned:
+            self._params = dict(self._params)
+            self._owned = True
+
+    def __getitem__(self, key):
+        return self._params[key]
+
+    def __setitem__(self, key, value):
+        self._own()
+        self._params[key] = value
+
+    def __delitem__(self, key):
+        self._own()
+        del self._params[key]
+
+    def __contains__(self, key):
+        return key in self._params
+
+    def __iter__(self):
+        return iter(self._params)
+
+    def __len__(self):
+        return len(self._params)
+
+    def get(self, key, default=None):
+        return self._params.get(key, default)
+
+    def __repr__(self):
+        return repr(self._params)
+
+    def as_dict(self):
+        """
+        :returns: the parameters as a dict, which is serialized into the
+                  datagrams as it is. It is not a copy, and must not be
+                  changed.
+        """
+        return self._params
+
+
 class StorletRequest(StorletData):
     def __init__(self, storlet_id, params, user_metadata,
                  data_iter=None, data_fd=None, options=None,
@@ -159,7 +343,7 @@ class StorletRequest(StorletData):
         super(StorletRequest, self).__init__(
             user_metadata, data_iter, data_fd, timeout, cancel)
         self.storlet_id = storlet_id
-        self.params = copy.deepcopy(params)
+        self.params = StorletParams(params)
         if options is None:
             self.options = {}
         else:
@@ -168,6 +352,9 @@ class StorletRequest(StorletData):
 
 class StorletResponse(StorletData):
     def __init__(self, user_metadata, data_iter=None, data_fd=None,
-                 timeout=10, cancel=None):
+                 timeout=10, cancel=None, chunk_policy=None):
         super(StorletResponse, self).__init__(
-            user_metadata, data_iter, data_fd, timeout, cancel)
+            user_metadata, data_iter, data_fd, timeout, cancel, chunk_policy)
+        # InvocationTimer of the invocation, when its timings are to be
+        # reported to the client
+        self.timing = None
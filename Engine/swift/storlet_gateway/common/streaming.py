@@ -0,0 +1,200 @@
+# Copyright (c) 2015, 2016 OpenStack Foundation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl
+import time
+
+from storlet_gateway.common.exceptions import StorletConfigError
+
+# fcntl commands to get and set the pipe capacity (linux specific)
+F_SETPIPE_SZ = 1031
+F_GETPIPE_SZ = 1032
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_CHUNK_SIZE = 1024 * 1024
+
+
+def set_pipe_size(fd, size):
+    """
+    Set the capacity of a pipe
+
+    :param fd: file descriptor of either end of the pipe
+    :param size: requested capacity in bytes
+    :returns: True if the capacity was set
+    """
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except (IOError, OSError):
+        # e.g. size is above /proc/sys/fs/pipe-max-size
+        return False
+    return True
+
+
+class _MemoryMonitor(object):
+    """
+    Reads the available memory from /proc/meminfo, at most once per interval
+    """
+
+    def __init__(self, interval=1.0, meminfo='/proc/meminfo'):
+        self.interval = interval
+        self.meminfo = meminfo
+        self._checked = 0
+        self._ratio = 1.0
+
+    def _read_ratio(self):
+        values = {}
+        try:
+            with open(self.meminfo) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in ('MemTotal', 'MemAvailable'):
+                        values[key] = int(value.split()[0])
+        except (IOError, OSError, ValueError, IndexError):
+            return 1.0
+        if values.get('MemTotal') and 'MemAvailable' in values:
+            return float(values['MemAvailable']) / values['MemTotal']
+        return 1.0
+
+    def available_ratio(self):
+        now = time.time()
+        if now - self._checked >= self.interval:
+            self._checked = now
+            self._ratio = self._read_ratio()
+        return self._ratio
+
+
+memory_monitor = _MemoryMonitor()
+
+
+class FixedChunkSize(object):
+    """
+    Chunk size policy using the same chunk size for the whole stream
+    """
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+
+    def update(self, requested, read):
+        """
+        Update the chunk size from the result of the last read
+
+        :param requested: size requested to the last read
+        :param read: size actually read
+        """
+        pass
+
+
+class AdaptiveChunkSize(FixedChunkSize):
+    """
+    Chunk size policy adapting the chunk size to the stream
+
+    The chunk size doubles while the reads return full chunks, that is while
+    the producer keeps the pipe full, up to max_chunk_size. It is halved when
+    the reads return less than half a chunk, and gets back to min_chunk_size
+    while the available memory is below low_memory_ratio of the total.
+    """
+
+    def __init__(self, min_chunk_size, max_chunk_size, low_memory_ratio,
+                 monitor=None):
+        super(AdaptiveChunkSize, self).__init__(min_chunk_size)
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.low_memory_ratio = low_memory_ratio
+        self.monitor = monitor or memory_monitor
+
+    def update(self, requested, read):
+        if self.monitor.available_ratio() < self.low_memory_ratio:
+            self.chunk_size = self.min_chunk_size
+        elif read >= requested:
+            self.chunk_size = min(self.chunk_size * 2, self.max_chunk_size)
+        elif read < requested // 2:
+            self.chunk_size = max(self.chunk_size // 2, self.min_chunk_size)
+
+
+class StreamingPolicy(object):
+    """
+    Gateway wide policy about the chunks and pipes used to stream data from
+    and to storlets
+
+    The policy is given by the following configuration values:
+    - storlet_chunk_mode: 'fixed' (default) or 'adaptive'
+    - storlet_chunk_size: the (minimum, in adaptive mode) chunk size
+    - storlet_max_chunk_size: the maximum chunk size in adaptive mode
+    - storlet_low_memory_ratio: the ratio of available memory under which
+      the adaptive mode uses the minimum chunk size
+    - storlet_pipe_size: the capacity of the pipes to the storlet, 0 to keep
+      the system default
+    """
+
+    def __init__(self, conf):
+        """
+        :param conf: gateway conf dict
+        :raises StorletConfigError: when the configuration is invalid
+        """
+        self.mode = conf.get('storlet_chunk_mode', 'fixed')
+        if self.mode not in ('fixed', 'adaptive'):
+            raise StorletConfigError(
+                'storlet_chunk_mode must be either fixed or adaptive '
+                'but is %s' % self.mode)
+        try:
+            self.chunk_size = int(conf.get('storlet_chunk_size',
+                                           DEFAULT_CHUNK_SIZE))
+            self.max_chunk_size = int(conf.get('storlet_max_chunk_size',
+                                               DEFAULT_MAX_CHUNK_SIZE))
+            self.low_memory_ratio = float(conf.get('storlet_low_memory_ratio',
+                                                   0.1))
+            self.pipe_size = int(conf.get('storlet_pipe_size', 0))
+        except ValueError as e:
+            raise StorletConfigError('Invalid streaming configuration: %s' %
+                                     e)
+        if self.chunk_size <= 0:
+            raise StorletConfigError('storlet_chunk_size must be positive')
+        self.max_chunk_size = max(self.max_chunk_size, self.chunk_size)
+
+    def create_chunk_policy(self):
+        """
+        Create the chunk size policy for one stream
+
+        :returns: FixedChunkSize or AdaptiveChunkSize instance
+        """
+        if self.mode == 'adaptive':
+            return AdaptiveChunkSize(self.chunk_size, self.max_chunk_size,
+                                     self.low_memory_ratio)
+        return FixedChunkSize(self.chunk_size)
+
+    def apply_pipe_size(self, fd):
+        """
+        Apply the configured capacity to a pipe
+
+        :param fd: file descriptor of either end of the pipe
+        """
+        if self.pipe_size > 0:
+            set_pipe_size(fd, self.pipe_size)
+
+    def iter_reader(self, read):
+        """
+        Iterate over the chunks returned by a read function
+
+        :param read: function reading up to the given size, and returning an
+                     empty string at the end of the data
+        """
+        chunk_policy = self.create_chunk_policy()
+        while True:
+            size = chunk_policy.chunk_size
+            chunk = read(size)
+            if not chunk:
+                return
+            chunk_policy.update(size, len(chunk))
+            yield chunk
@@ -0,0 +1,226 @@
+# Copyright (c) 2015, 2016 OpenStack Foundation.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import re
+import socket
+import time
+from contextlib import contextmanager
+
+from storlet_gateway.common.exceptions import StorletConfigError
+
+# Phases of a storlet invocation, in the order they happen
+PHASES = ['update_container', 'activate_daemon', 'invoke', 'read_metadata',
+          'first_byte', 'upload_logs']
+
+# Upper bounds (seconds) of the histogram buckets, the last bucket counting
+# the slower phases
+DEFAULT_TIMING_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+
+
+class TimingEmitter(object):
+    """
+    Receives the duration of each phase of the storlet invocations
+    """
+
+    def emit(self, scope, storlet, phase, seconds):
+        """
+        :param scope: scope of the sandbox
+        :param storlet: main class of the storlet
+        :param phase: name of the phase
+        :param seconds: duration of the phase
+        """
+        raise NotImplementedError()
+
+
+class StatsdTimingEmitter(TimingEmitter):
+    """
+    Sends the durations as statsd timers, named
+    <prefix>.<scope>.<storlet>.<phase>
+    """
+
+    def __init__(self, host, port=8125, prefix='storlets'):
+        self.addr = (host, port)
+        self.prefix = prefix
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    @staticmethod
+    def _sanitize(name):
+        # statsd splits the metric names on dots
+        return re.sub(r'[^\w-]', '_', name)
+
+    def emit(self, scope, storlet, phase, seconds):
+        names = [self.prefix] if self.prefix else []
+        names.extend(self._sanitize(name or '_')
+                     for name in (scope, storlet, phase))
+        packet = '%s:%.3f|ms' % ('.'.join(names), seconds * 1000)
+        try:
+            self._sock.sendto(packet, self.addr)
+        except (IOError, OSError):
+            # Metrics are best effort, they never fail an invocation
+            pass
+
+
+class TimingHistogram(TimingEmitter):
+    """
+    Keeps a histogram of the durations per (scope, storlet, phase) in
+    memory, to be exported by the process
+    """
+
+    def __init__(self, buckets=None):
+        self.buckets = list(buckets or DEFAULT_TIMING_BUCKETS)
+        self._histograms = {}
+
+    def emit(self, scope, storlet, phase, seconds):
+        key = (scope, storlet, phase)
+        hist = self._histograms.get(key)
+        if hist is None:
+            hist = self._histograms[key] = \
+                {'counts': [0] * (len(self.buckets) + 1),
+                 'count': 0, 'sum': 0.0}
+        hist['counts'][bisect.bisect_left(self.buckets, seconds)] += 1
+        hist['count'] += 1
+        hist['sum'] += seconds
+
+    def export(self):
+        """
+        :returns: dict mapping (scope, storlet, phase) to the bucket counts,
+                  the number and the sum of the durations
+        """
+        return dict((key, {'counts': list(hist['counts']),
+                           'count': hist['count'], 'sum': hist['sum']})
+                    for key, hist in self._histograms.items())
+
+    def reset(self):
+        self._histograms.clear()
+
+
+timing_histogram = TimingHistogram()
+
+# The statsd emitters are shared by the gateways of a process
+_statsd_emitters = {}
+
+
+class InvocationTimer(object):
+    """
+    Times the phases of one storlet invocation, and forwards their durations
+    to the emitters
+    """
+
+    def __init__(self, scope, storlet, emitters=None):
+        """
+        :param scope: scope of the sandbox
+        :param storlet: main class of the storlet
+        :param emitters: list of TimingEmitter instances
+        """
+        self.scope = scope
+        self.storlet = storlet
+        self.emitters = emitters or []
+        self.totals = {}
+        self._start = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager timing a phase, even when it fails
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def record(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+        for emitter in self.emitters:
+            emitter.emit(self.scope, self.storlet, name, seconds)
+
+    def finish(self):
+        """
+        Record the total duration of the invocation
+        """
+        self.record('total', time.time() - self._start)
+
+    def format_header(self):
+        """
+        :returns: the durations in milliseconds, as reported in the
+                  X-Storlet-Timing header, e.g. 'invoke=1.234, total=5.678'
+        """
+        names = [name for name in PHASES if name in self.totals]
+        names.extend(sorted(name for name in self.totals
+                            if name not in PHASES and name != 'total'))
+        if 'total' in self.totals:
+            names.append('total')
+        return ', '.join('%s=%.3f' % (name, self.totals[name] * 1000)
+                         for name in names)
+
+
+class TimingPolicy(object):
+    """
+    Gateway wide policy about the emitters of the invocation timings
+
+    The policy is given by the following configuration values:
+    - storlet_timing_emitters: comma separated list of statsd and histogram,
+      empty (default) to only report the timings in X-Storlet-Timing
+    - storlet_timing_statsd_host, storlet_timing_statsd_port and
+      storlet_timing_statsd_prefix: where to send the statsd timers
+    """
+
+    def __init__(self, conf):
+        """
+        :param conf: gateway conf dict
+        :raises StorletConfigError: when the configuration is invalid
+        """
+        names = [name.strip() for name
+                 in conf.get('storlet_timing_emitters', '').split(',')
+                 if name.strip()]
+        self.emitters = []
+        for name in names:
+            if name == 'histogram':
+                self.emitters.append(timing_histogram)
+            elif name == 'statsd':
+                self.emitters.append(self._get_statsd_emitter(conf))
+            else:
+                raise StorletConfigError(
+                    'storlet_timing_emitters must be statsd or histogram '
+                    'but is %s' % name)
+
+    @staticmethod
+    def _get_statsd_emitter(conf):
+        host = conf.get('storlet_timing_statsd_host')
+        if not host:
+            raise StorletConfigError(
+                'storlet_timing_statsd_host is required by the statsd '
+                'emitter')
+        try:
+            port = int(conf.get('storlet_timing_statsd_port', 8125))
+        except ValueError as e:
+            raise StorletConfigError('Invalid statsd port: %s' % e)
+        prefix = conf.get('storlet_timing_statsd_prefix', 'storlets')
+
+        key = (host, port, prefix)
+        if key not in _statsd_emitters:
+            _statsd_emitters[key] = StatsdTimingEmitter(host, port, prefix)
+        return _statsd_emitters[key]
+
+    def create_timer(self, scope, storlet):
+        """
+        Create the timer of one invocation
+
+        :param scope: scope of the sandbox
+        :param storlet: main class of the storlet
+        :returns: InvocationTimer instance
+        """
+        return InvocationTimer(scope, storlet, self.emitters)
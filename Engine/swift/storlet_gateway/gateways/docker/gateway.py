@@ -15,9 +15,19 @@ Limitations under the License.
 
 import os
 import shutil
+import tempfile
+import time
+from contextlib import contextmanager
 
-from storlet_gateway.common.exceptions import StorletConfigError
+from eventlet.semaphore import Semaphore
+from swift.common.utils import config_true_value
+
+from storlet_gateway.common.exceptions import StorletConfigError, \
+    StorletRuntimeException, StorletSendError
+from storlet_gateway.common.log_upload import get_log_uploader
 from storlet_gateway.common.stob import StorletRequest
+from storlet_gateway.common.streaming import StreamingPolicy
+from storlet_gateway.common.timing import TimingPolicy
 from storlet_gateway.gateways.base import StorletGatewayBase
 from storlet_gateway.gateways.docker.runtime import RunTimePaths, \
     RunTimeSandbox, StorletInvocationProtocol
@@ -26,6 +36,117 @@ from storlet_gateway.gateways.docker.runtime import RunTimePaths, \
 CONDITIONAL_KEYS = ['IF_MATCH', 'IF_NONE_MATCH', 'IF_MODIFIED_SINCE',
                     'IF_UNMODIFIED_SINCE']
 
+
+class StorletCacheManifest(object):
+    """
+    Remembers which version of each storlet and dependency is already
+    deployed, that is up-to-date in the host cache and in the Docker container
+
+    The deployed versions are keyed by (scope, storlet_main, object name), so
+    that a deployed object can be found without checking the file system.
+    The stats dictionary counts hits and misses.
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def is_deployed(self, scope, storlet_main, obj_name, version):
+        """
+        Check if the object is deployed
+
+        :param scope: scope of the sandbox
+        :param storlet_main: main class of the storlet using the object
+        :param obj_name: name of the storlet or dependency object
+        :param version: version of the object, such as a tuple of its
+                        timestamp and size
+        :returns: True if the given version of the object is deployed
+        """
+        key = (scope, storlet_main, obj_name)
+        if key in self._versions and self._versions[key] == version:
+            self.stats['hits'] += 1
+            return True
+        self.stats['misses'] += 1
+        return False
+
+    def set_deployed(self, scope, storlet_main, obj_name, version):
+        """
+        Record that the object is deployed
+
+        :param scope: scope of the sandbox
+        :param storlet_main: main class of the storlet using the object
+        :param obj_name: name of the storlet or dependency object
+        :param version: version of the object
+        """
+        self._versions[(scope, storlet_main, obj_name)] = version
+
+    def invalidate(self, scope, storlet_main=None):
+        """
+        Forget the objects deployed for a storlet, or for a whole scope
+
+        :param scope: scope of the sandbox
+        :param storlet_main: main class of the storlet, None for all the
+                             storlets of the scope
+        """
+        for key in self._versions.keys():
+            if key[0] == scope and \
+                    (storlet_main is None or key[1] == storlet_main):
+                self._versions.pop(key, None)
+
+
+storlet_cache_manifest = StorletCacheManifest()
+
+# The semaphores of the keys being processed, with their number of users
+_single_flight_locks = {}
+
+
+@contextmanager
+def _single_flight(key):
+    """
+    Context manager serializing the greenthreads working on the same key
+
+    :param key: the key to work on
+    """
+    entry = _single_flight_locks.get(key)
+    if entry is None:
+        entry = _single_flight_locks[key] = [Semaphore(), 0]
+    entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _single_flight_locks[key]
+
+
+def _deploy_file(src, dst):
+    """
+    Atomically deploy src at dst
+
+    A hard link is used when src and dst are on the same file system,
+    and a copy otherwise. Both of them keep the permissions and the
+    modification time of src.
+
+    :param src: path to the source file
+    :param dst: path to the destination file
+    """
+    dst_dir, dst_name = os.path.split(dst)
+    tmp_path = os.path.join(dst_dir, '.%s.%d' % (dst_name, os.getpid()))
+    if os.path.lexists(tmp_path):
+        os.unlink(tmp_path)
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            # copy2 also copies the permissions
+            shutil.copy2(src, tmp_path)
+        os.rename(tmp_path, dst)
+    except Exception:
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
 """---------------------------------------------------------------------------
 The Storlet Gateway API
 The API is made of:
@@ -58,6 +179,7 @@ class DockerStorletRequest(StorletRequest):
             storlet_id, params, user_metadata, data_iter, data_fd,
             options=options)
         self.generate_log = self.options.get('generate_log', False)
+        self.report_timing = self.options.get('report_timing', False)
 
         # TODO(takashi): Some of following parameters should be defined common
         #                parameters for StorletRequest
@@ -87,6 +209,16 @@ class StorletGatewayDocker(StorletGatewayBase):
         # TODO(eranr): Add sconf defaults, and get rid of validate_conf below
         self.storlet_timeout = int(self.sconf['storlet_timeout'])
         self.paths = RunTimePaths(scope, sconf)
+        self.streaming_policy = StreamingPolicy(sconf)
+        self.timing_policy = TimingPolicy(sconf)
+        self.log_uploader = get_log_uploader(sconf)
+        # Upload the logs of each invocation into its own object, rather
+        # than the whole log file into <storlet>.log
+        self.log_per_invocation = config_true_value(
+            sconf.get('storlet_log_per_invocation', 'false'))
+        # The sandbox is built at the first invocation, and then used by all
+        # the invocations of the gateway
+        self._run_time_sbox = None
 
     @classmethod
     def validate_storlet_registration(cls, params, name):
@@ -121,26 +253,74 @@ class StorletGatewayDocker(StorletGatewayBase):
                 raise ValueError('Mandatory parameter is missing'
                                  ': {0}'.format(md))
 
+    def _get_sandbox(self):
+        if self._run_time_sbox is None:
+            self._run_time_sbox = RunTimeSandbox(self.scope, self.sconf,
+                                                 self.logger)
+        return self._run_time_sbox
+
     def invocation_flow(self, sreq):
-        run_time_sbox = RunTimeSandbox(self.scope, self.sconf, self.logger)
-        docker_updated = self.update_docker_container_from_cache(sreq)
-        run_time_sbox.activate_storlet_daemon(sreq, docker_updated)
+        timer = self.timing_policy.create_timer(self.scope, sreq.storlet_main)
+        run_time_sbox = self._get_sandbox()
+        with timer.phase('update_container'):
+            docker_updated = self.update_docker_container_from_cache(sreq)
+        with timer.phase('activate_daemon'):
+            status_cached = \
+                run_time_sbox.activate_storlet_daemon(sreq, docker_updated)
         self._add_system_params(sreq)
 
-        slog_path = self.paths.slog_path(sreq.storlet_main)
-        storlet_pipe_path = self.paths.host_storlet_pipe(sreq.storlet_main)
+        sprotocol = self._create_protocol(sreq, run_time_sbox, timer)
+        log_path = sprotocol.storlet_logger.full_path
+        log_offset = self._get_log_size(log_path)
 
-        sprotocol = StorletInvocationProtocol(sreq,
-                                              storlet_pipe_path,
-                                              slog_path,
-                                              self.storlet_timeout)
-
-        sresp = sprotocol.communicate()
+        try:
+            try:
+                sresp = sprotocol.communicate()
+            except StorletSendError:
+                if not status_cached:
+                    raise
+                # The daemon known to be running from the status cache,
+                # which is per process, may have died meanwhile. Nothing
+                # was sent to it yet, so that it can be activated and
+                # invoked again.
+                self.logger.debug('Failed to send to storlet daemon %s, '
+                                  'activating it again' % sreq.storlet_main)
+                run_time_sbox.invalidate_daemon_status(sreq.storlet_main)
+                with timer.phase('activate_daemon'):
+                    run_time_sbox.activate_storlet_daemon(sreq, False)
+                sprotocol = self._create_protocol(sreq, run_time_sbox, timer)
+                sresp = sprotocol.communicate()
+        except StorletRuntimeException:
+            # The daemon may be dead or stuck (StorletTimeout is also a
+            # StorletRuntimeException), so that its status should be checked
+            # with the daemon factory at the next invocation
+            run_time_sbox.invalidate_daemon_status(sreq.storlet_main)
+            # Check the deployed files again as well, in case they were
+            # damaged
+            storlet_cache_manifest.invalidate(self.scope, sreq.storlet_main)
+            raise
 
-        self._upload_storlet_logs(slog_path, sreq)
+        if sreq.generate_log:
+            with timer.phase('upload_logs'):
+                self._upload_storlet_logs(log_path, sreq, log_offset)
 
+        timer.finish()
+        if sreq.report_timing:
+            sresp.timing = timer
         return sresp
 
+    def _create_protocol(self, sreq, run_time_sbox, timer):
+        slog_path = self.paths.slog_path(sreq.storlet_main)
+        storlet_pipe_path = self.paths.host_storlet_pipe(sreq.storlet_main)
+        return StorletInvocationProtocol(sreq,
+                                         storlet_pipe_path,
+                                         slog_path,
+                                         self.storlet_timeout,
+                                         run_time_sbox.sbus_client,
+                                         self.streaming_policy,
+                                         run_time_sbox.get_framing(),
+                                         timer)
+
     def _add_system_params(self, sreq):
         """
         Adds Storlet engine specific parameters to the invocation
@@ -153,12 +333,28 @@ class StorletGatewayDocker(StorletGatewayBase):
         sreq.params['storlet_execution_path'] = self. \
             paths.sbox_storlet_exec(sreq.options['storlet_main'])
 
-    def _upload_storlet_logs(self, slog_path, sreq):
+    def _get_log_size(self, log_path):
+        try:
+            return os.path.getsize(log_path)
+        except OSError:
+            return 0
+
+    def _upload_storlet_logs(self, log_path, sreq, offset=0):
+        """
+        Queue the upload of the storlet log, which is done in background
+
+        :param log_path: path to the log file of the storlet
+        :param offset: size of the log file before the invocation
+        """
         if sreq.generate_log:
-            with open(slog_path, 'r') as logfile:
-                storlet_name = sreq.storlet_id.split('-')[0]
+            storlet_name = sreq.storlet_id.split('-')[0]
+            if self.log_per_invocation:
+                log_obj_name = '%s-%.6f.log' % (storlet_name, time.time())
+            else:
                 log_obj_name = '%s.log' % storlet_name
-                sreq.file_manager.put_log(log_obj_name, logfile)
+                offset = 0
+            self.log_uploader.submit(sreq.file_manager, log_obj_name,
+                                     log_path, offset, self.logger)
 
     def bring_from_cache(self, obj_name, sreq, is_storlet):
         """
@@ -192,41 +388,15 @@ class StorletGatewayDocker(StorletGatewayBase):
         # e.g. a concrete storlet or dependency we need to bring/update
         cache_target_path = os.path.join(cache_dir, obj_name)
 
-        # Determine if we need to update the cache for cache_target_path
-        # We default for no
-        update_cache = False
-
-        # If it does not exist in cache, we obviously need to bring
-        if not os.path.isfile(cache_target_path):
-            update_cache = True
-        elif is_storlet:
-            # The cache_target_path exists, we test if it is up-to-date
-            # with the metadata we got.
-            # We mention that this is currenlty applicable for storlets
-            # only, and not for dependencies.
-            # This will change when we will head dependencies as well
-            fstat = os.stat(cache_target_path)
-            storlet_or_size = long(sreq.options['storlet_content_length'])
-            storlet_or_time = float(sreq.options['storlet_x_timestamp'])
-            b_storlet_size_changed = fstat.st_size != storlet_or_size
-            b_storlet_file_updated = float(fstat.st_mtime) < storlet_or_time
-            if b_storlet_size_changed or b_storlet_file_updated:
-                update_cache = True
-
-        if update_cache:
-            # If the cache needs to be updated, then get on with it
-            # bring the object from storge
-            data_iter, perm = get_func(obj_name)
-
-            # TODO(takashi): Do not directly write to target path
-            with open(cache_target_path, 'w') as fn:
-                for data in data_iter:
-                    fn.write(data)
-
-            if not is_storlet:
-                if not perm:
-                    perm = '0600'
-                os.chmod(cache_target_path, int(perm, 8))
+        if self._is_cache_outdated(cache_target_path, sreq, is_storlet):
+            # Concurrent requests may find the same outdated object. Only
+            # the first one brings it from storage, and the others wait for
+            # it and check the cache again.
+            with _single_flight(cache_target_path):
+                if self._is_cache_outdated(cache_target_path, sreq,
+                                           is_storlet):
+                    self._bring_to_cache(get_func, obj_name,
+                                         cache_target_path, is_storlet)
 
         # The node's local cache is now updated.
         # We now verify if we need to update the
@@ -254,12 +424,96 @@ class StorletGatewayDocker(StorletGatewayBase):
                 update_docker = True
 
         if update_docker:
-            # need to copy from cache to docker
-            # copy2 also copies the permissions
-            shutil.copy2(cache_target_path, docker_target_path)
+            _deploy_file(cache_target_path, docker_target_path)
 
+        storlet_cache_manifest.set_deployed(
+            self.scope, sreq.storlet_main, obj_name,
+            self._get_object_version(sreq, is_storlet))
         return update_docker
 
+    def _is_cache_outdated(self, cache_target_path, sreq, is_storlet):
+        """
+        Determine if we need to update the cache for cache_target_path
+
+        :params cache_target_path: path to the object in the host cache
+        :params is_storlet: True if the object is a storlet object
+                            False if the object is a dependency object
+        :returns: True if the cache needs to be updated
+        """
+        # If it does not exist in cache, we obviously need to bring
+        if not os.path.isfile(cache_target_path):
+            return True
+        elif is_storlet:
+            # The cache_target_path exists, we test if it is up-to-date
+            # with the metadata we got.
+            # We mention that this is currenlty applicable for storlets
+            # only, and not for dependencies.
+            # This will change when we will head dependencies as well
+            fstat = os.stat(cache_target_path)
+            storlet_or_size = long(sreq.options['storlet_content_length'])
+            storlet_or_time = float(sreq.options['storlet_x_timestamp'])
+            b_storlet_size_changed = fstat.st_size != storlet_or_size
+            b_storlet_file_updated = float(fstat.st_mtime) < storlet_or_time
+            if b_storlet_size_changed or b_storlet_file_updated:
+                return True
+        return False
+
+    def _bring_to_cache(self, get_func, obj_name, cache_target_path,
+                        is_storlet):
+        """
+        Bring the object from storage into the host cache
+
+        The object is written into a temporary file first, so that the
+        cache never holds a partially written object.
+
+        :params get_func: file manager method to get the object
+        :params obj_name: name of the object
+        :params cache_target_path: path to the object in the host cache
+        :params is_storlet: True if the object is a storlet object
+                            False if the object is a dependency object
+        """
+        data_iter, perm = get_func(obj_name)
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(cache_target_path), prefix='.%s.' % obj_name)
+        try:
+            with os.fdopen(fd, 'w') as fn:
+                for data in data_iter:
+                    fn.write(data)
+
+            if is_storlet:
+                # mkstemp creates the file as readable by the owner only
+                perm = '0644'
+            elif not perm:
+                perm = '0600'
+            os.chmod(tmp_path, int(perm, 8))
+
+            os.rename(tmp_path, cache_target_path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def _get_object_version(self, sreq, is_storlet):
+        """
+        Get the version of the storlet or the dependency object to run
+
+        :param is_storlet: True if the object is a storlet object
+                           False if the object is a dependency object
+        :returns: version to be recorded in the cache manifest
+        """
+        if is_storlet:
+            return (sreq.options['storlet_x_timestamp'],
+                    sreq.options['storlet_content_length'])
+        # We do not get the metadata of dependencies, so that a dependency
+        # is considered up-to-date as long as it exists, as in
+        # bring_from_cache
+        return None
+
+    def _is_deployed(self, obj_name, sreq, is_storlet):
+        return storlet_cache_manifest.is_deployed(
+            self.scope, sreq.storlet_main, obj_name,
+            self._get_object_version(sreq, is_storlet))
+
     def update_docker_container_from_cache(self, sreq):
         """
         Iterates over the storlet name and its dependencies appearing
@@ -270,6 +524,15 @@ class StorletGatewayDocker(StorletGatewayBase):
 
         :returns: True if the Docker container was updated
         """
+        # The objects already deployed in the current version do not need
+        # any check on the file system
+        targets = [(sreq.storlet_id, True)]
+        targets.extend([(dep, False) for dep in sreq.dependencies])
+        targets = [(obj_name, is_storlet) for obj_name, is_storlet in targets
+                   if not self._is_deployed(obj_name, sreq, is_storlet)]
+        if not targets:
+            return False
+
         # where at the host side, reside the storlet containers
         storlet_path = self.paths.host_storlet_prefix()
         if not os.path.exists(storlet_path):
@@ -281,11 +544,8 @@ class StorletGatewayDocker(StorletGatewayBase):
         # updated within the Docker container
         docker_updated = False
 
-        updated = self.bring_from_cache(sreq.storlet_id, sreq, True)
-        docker_updated = docker_updated or updated
-
-        for dep in sreq.dependencies:
-            updated = self.bring_from_cache(dep, sreq, False)
+        for obj_name, is_storlet in targets:
+            updated = self.bring_from_cache(obj_name, sreq, is_storlet)
             docker_updated = docker_updated or updated
 
         return docker_updated
@@ -22,12 +22,16 @@ import time
 
 import eventlet
 import json
+from collections import OrderedDict
 from contextlib import contextmanager
 
 from swift.common.constraints import MAX_META_OVERALL_SIZE
+from swift.common.utils import config_true_value
 
 from SBusPythonFacade.SBus import SBus
-from SBusPythonFacade.SBusDatagram import ClientSBusOutDatagram
+from SBusPythonFacade.SBusClient import SBusClient
+from SBusPythonFacade.SBusDatagram import ClientSBusOutDatagram, \
+    SBUS_FRAMING_BINARY, SBUS_FRAMING_JSON
 from SBusPythonFacade.SBusFileDescription import SBUS_FD_INPUT_OBJECT, \
     SBUS_FD_LOGGER, SBUS_FD_OUTPUT_OBJECT, SBUS_FD_OUTPUT_OBJECT_METADATA, \
     SBUS_FD_OUTPUT_TASK_ID
@@ -35,9 +39,11 @@ from SBusPythonFacade.SBusStorletCommand import SBUS_CMD_CANCEL, \
     SBUS_CMD_DAEMON_STATUS, SBUS_CMD_EXECUTE, SBUS_CMD_PING, \
     SBUS_CMD_START_DAEMON, SBUS_CMD_STOP_DAEMON
 from storlet_gateway.common.exceptions import StorletRuntimeException, \
-    StorletTimeout
+    StorletSendError, StorletTimeout
 from storlet_gateway.common.logger import StorletLogger
 from storlet_gateway.common.stob import StorletResponse
+from storlet_gateway.common.streaming import StreamingPolicy
+from storlet_gateway.common.timing import InvocationTimer
 
 eventlet.monkey_patch()
 
@@ -55,6 +61,204 @@ def _open_pipe():
         os.close(write_fd)
 
 
+# SBus clients kept per scope, so that the sockets and reply pipes used to
+# talk with a sandbox survive the request which created them. They are kept
+# in least recently used order, and closed when evicted.
+_sbus_clients = OrderedDict()
+
+
+def get_sbus_client(scope, max_clients=100):
+    """
+    Get the SBus client shared by all the requests of a scope
+
+    :param scope: scope of the sandbox
+    :param max_clients: maximum number of clients kept, the least recently
+                        used ones being closed
+    :returns: SBusClient instance
+    """
+    client = _sbus_clients.pop(scope, None)
+    if client is None:
+        client = SBusClient()
+    _sbus_clients[scope] = client
+    while len(_sbus_clients) > max_clients:
+        _, evicted = _sbus_clients.popitem(last=False)
+        evicted.close()
+    return client
+
+
+class DaemonStatusCache(object):
+    """
+    Remembers the storlet daemons known to be running
+
+    Entries are keyed by (scope, storlet_main) and expire after a time to
+    live, so that a daemon which died without us noticing is checked with
+    the daemon factory again at some point.
+    The stats dictionary counts hits and misses.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def is_running(self, scope, storlet_main):
+        """
+        Check if the storlet daemon is known to be running
+
+        :param scope: scope of the sandbox
+        :param storlet_main: main class of the storlet
+        :returns: True if the daemon is running for sure
+        """
+        if self.is_cached(scope, storlet_main):
+            self.stats['hits'] += 1
+            return True
+        self.stats['misses'] += 1
+        return False
+
+    def is_cached(self, scope, storlet_main):
+        """
+        Check if the storlet daemon is known to be running, without counting
+        it in the stats
+
+        :param scope: scope of the sandbox
+        :param storlet_main: main class of the storlet
+        :returns: True if the daemon is running for sure
+        """
+        expire = self._entries.get((scope, storlet_main))
+        return expire is not None and expire > time.time()
+
+    def set_running(self, scope, storlet_main, ttl):
+        """
+        Record that the storlet daemon is running
+
+        :param scope: scope of the sandbox
+        :param storlet_main: main class of the storlet
+        :param ttl: seconds during which the record can be trusted
+        """
+        if ttl > 0:
+            self._entries[(scope, storlet_main)] = time.time() + ttl
+
+    def invalidate(self, scope, storlet_main=None):
+        """
+        Forget a storlet daemon, or all the daemons of a scope
+
+        :param scope: scope of the sandbox
+        :param storlet_main: main class of the storlet, None for all the
+                             daemons of the scope
+        """
+        if storlet_main is not None:
+            self._entries.pop((scope, storlet_main), None)
+            return
+        for key in self._entries.keys():
+            if key[0] == scope:
+                self._entries.pop(key, None)
+
+    @property
+    def hit_rate(self):
+        total = self.stats['hits'] + self.stats['misses']
+        if not total:
+            return 0.0
+        return float(self.stats['hits']) / total
+
+
+daemon_status_cache = DaemonStatusCache()
+
+
+class RecentStorlets(object):
+    """
+    Remembers the storlets recently activated in each scope
+
+    For each scope, up to max_storlets storlets are kept with the class path
+    their daemon was started with, most recently activated first, so that
+    their daemons can be started again once the sandbox is restarted.
+    """
+
+    def __init__(self, max_storlets=5):
+        self.max_storlets = max_storlets
+        self._storlets = {}
+
+    def record(self, scope, storlet_main, class_path):
+        """
+        Record the activation of a storlet
+
+        :param scope: scope of the sandbox
+        :param storlet_main: main class of the storlet
+        :param class_path: class path of the storlet daemon
+        """
+        storlets = self._storlets.setdefault(scope, [])
+        for i, (main, _) in enumerate(storlets):
+            if main == storlet_main:
+                del storlets[i]
+                break
+        storlets.insert(0, (storlet_main, class_path))
+        del storlets[self.max_storlets:]
+
+    def get(self, scope):
+        """
+        Get the storlets recently activated in a scope
+
+        :param scope: scope of the sandbox
+        :returns: list of (storlet_main, class_path), most recent first
+        """
+        return list(self._storlets.get(scope, []))
+
+    def forget(self, scope, storlet_main=None):
+        """
+        Forget a storlet, or all the storlets of a scope
+
+        :param scope: scope of the sandbox
+        :param storlet_main: main class of the storlet, None for all the
+                             storlets of the scope
+        """
+        if storlet_main is None:
+            self._storlets.pop(scope, None)
+            return
+        self._storlets[scope] = [
+            (main, class_path)
+            for main, class_path in self._storlets.get(scope, [])
+            if main != storlet_main]
+
+
+recent_storlets = RecentStorlets()
+
+
+class ActivationStats(object):
+    """
+    Latency of the storlet daemon activations
+
+    Cold activations are the ones which had to start the storlet daemon, and
+    warm activations the ones which found it running already. Daemons started
+    in advance by the prewarm are counted in 'prewarmed'.
+    """
+
+    def __init__(self):
+        self.stats = {'cold': 0, 'cold_time': 0.0, 'cold_max': 0.0,
+                      'warm': 0, 'warm_time': 0.0, 'warm_max': 0.0,
+                      'prewarmed': 0}
+
+    def record(self, kind, elapsed):
+        """
+        Record an activation
+
+        :param kind: either 'cold' or 'warm'
+        :param elapsed: seconds spent in the activation
+        """
+        self.stats[kind] += 1
+        self.stats[kind + '_time'] += elapsed
+        self.stats[kind + '_max'] = max(self.stats[kind + '_max'], elapsed)
+
+    def average(self, kind):
+        """
+        :param kind: either 'cold' or 'warm'
+        :returns: average seconds spent in the activations of the kind
+        """
+        if not self.stats[kind]:
+            return 0.0
+        return self.stats[kind + '_time'] / self.stats[kind]
+
+
+activation_stats = ActivationStats()
+
+
 """---------------------------------------------------------------------------
 Sandbox API
 """
@@ -225,35 +429,60 @@ class RunTimeSandbox(object):
             int(conf.get('storlet_daemon_thread_pool_size', 5))
         self.storlet_daemon_debug_level = \
             conf.get('storlet_daemon_debug_level', 'TRACE')
+        self.daemon_status_cache_ttl = \
+            float(conf.get('daemon_status_cache_ttl', 10))
+        # Storlets whose daemons are started as soon as the sandbox is
+        # restarted, in addition to the ones recently used in the scope
+        self.prewarm_storlets = \
+            [main.strip() for main in
+             conf.get('prewarm_storlets', '').split(',') if main.strip()]
+        self.prewarm_recent_storlets = \
+            config_true_value(conf.get('prewarm_recent_storlets', 'true'))
 
         # TODO(change logger's route if possible)
         self.logger = logger
 
-    def _parse_sandbox_factory_answer(self, str_answer):
-        two_tokens = str_answer.split(':', 1)
-        b_success = False
-        if two_tokens[0] == 'True':
-            b_success = True
-        return b_success, two_tokens[1]
-
-    def ping(self):
-        pipe_path = self.paths.host_factory_pipe()
+        self.sbus_client_pool_size = \
+            int(conf.get('sbus_client_pool_size', 100))
+        # The binary framing is used with the sandboxes which support it
+        # when enabled
+        if config_true_value(conf.get('sbus_binary_framing', 'false')):
+            self.sbus_max_framing = SBUS_FRAMING_BINARY
+        else:
+            self.sbus_max_framing = SBUS_FRAMING_JSON
 
-        with _open_pipe() as (read_fd, write_fd):
-            dtg = ClientSBusOutDatagram.create_service_datagram(
-                SBUS_CMD_PING,
-                write_fd)
-            rc = SBus.send(pipe_path, dtg)
-            if (rc < 0):
-                return -1
+    @property
+    def sbus_client(self):
+        """
+        The SBus client of the scope, taken from the shared clients at each
+        use, so that a client closed on eviction is not used anymore
+        """
+        client = get_sbus_client(self.scope, self.sbus_client_pool_size)
+        client.max_framing = self.sbus_max_framing
+        return client
 
-            reply = os.read(read_fd, 10)
+    @staticmethod
+    def _get_reply_code(reply):
+        """
+        Get the status code of a daemon factory reply
 
-        res, error_txt = self._parse_sandbox_factory_answer(reply)
-        if res is True:
+        :param reply: SBusServiceReply instance, or None if the command
+                      failed to send
+        :returns: 1 on success, 0 on failure, and -1 when the command failed
+                  to send
+        """
+        if reply is None:
+            return -1
+        if reply.status is True:
             return 1
         return 0
 
+    def ping(self):
+        pipe_path = self.paths.host_factory_pipe()
+
+        reply = self.sbus_client.call(pipe_path, SBUS_CMD_PING)
+        return self._get_reply_code(reply)
+
     def wait(self):
         """
         Wait while scope's sandbox is starting
@@ -280,6 +509,8 @@ class RunTimeSandbox(object):
         Restarts the scope's sandbox
 
         """
+        # All the daemons are gone with the old container
+        self.invalidate_daemon_status()
         self.paths.create_host_pipe_prefix()
 
         docker_container_name = '%s_%s' % (self.docker_image_name_prefix,
@@ -302,6 +533,7 @@ class RunTimeSandbox(object):
         ret = subprocess.call(cmd)
         if ret == 0:
             self.wait()
+            self._spawn_prewarm()
             return
 
         # We were unable to start docker container from the tenant image.
@@ -324,11 +556,90 @@ class RunTimeSandbox(object):
 
         subprocess.call(cmd)
         self.wait()
+        self._spawn_prewarm()
 
-    def start_storlet_daemon(self, spath, storlet_id):
+    def _get_prewarm_targets(self):
         """
-        Start SDaemon process in the scope's sandbox
+        Get the storlets whose daemons should be started in advance
+
+        :returns: list of (storlet_main, class_path)
+        """
+        targets = []
+        if self.prewarm_recent_storlets:
+            targets.extend(recent_storlets.get(self.scope))
+        known = set(main for main, _ in targets)
+        for storlet_main in self.prewarm_storlets:
+            if storlet_main in known:
+                continue
+            # The storlet and its dependencies are deployed into the same
+            # directory, which is mounted in the sandbox
+            storlet_dir = self.paths.host_storlet(storlet_main)
+            try:
+                files = sorted(os.listdir(storlet_dir))
+            except OSError:
+                self.logger.info('Storlet %s to prewarm is not deployed in '
+                                 '%s' % (storlet_main, self.scope))
+                continue
+            if not files:
+                continue
+            class_path = ':'.join(
+                os.path.join(self.paths.sbox_storlet_exec(storlet_main), f)
+                for f in files)
+            targets.append((storlet_main, class_path))
+        return targets
+
+    def _spawn_prewarm(self):
+        """
+        Start the prewarm in a green thread, so that the request which caused
+        the restart does not wait for it
+        """
+        targets = self._get_prewarm_targets()
+        if targets:
+            eventlet.spawn_n(self.prewarm_storlet_daemons, targets)
+
+    def prewarm_storlet_daemons(self, targets):
+        """
+        Start the storlet daemons before they get invoked
+
+        :param targets: list of (storlet_main, class_path)
+        :returns: number of the daemons started
+        """
+        targets = [(storlet_main, class_path)
+                   for storlet_main, class_path in targets
+                   if not daemon_status_cache.is_cached(self.scope,
+                                                        storlet_main)]
+        started = 0
+        if not targets:
+            return started
+        codes = self.start_storlet_daemons(
+            [(class_path, storlet_main)
+             for storlet_main, class_path in targets])
+        if codes == -1:
+            codes = [-1] * len(targets)
+        for (storlet_main, _), code in zip(targets, codes):
+            if code != 1:
+                self.logger.info('Failed to prewarm storlet daemon %s in %s' %
+                                 (storlet_main, self.scope))
+                continue
+            daemon_status_cache.set_running(self.scope, storlet_main,
+                                            self.daemon_status_cache_ttl)
+            activation_stats.stats['prewarmed'] += 1
+            started += 1
+        self.logger.debug('Prewarmed %d storlet daemons in %s' %
+                          (started, self.scope))
+        return started
+
+    def invalidate_daemon_status(self, storlet_id=None):
+        """
+        Forget the cached status of a storlet daemon, so that it is asked to
+        the daemon factory on the next activation
+
+        :param storlet_id: storlet main class, None for all the daemons of
+                           the scope
         """
+        daemon_status_cache.invalidate(self.scope, storlet_id)
+
+    def _get_start_params(self, spath, storlet_id):
         prms = {}
         prms['daemon_language'] = 'java'
         prms['storlet_path'] = spath
@@ -336,71 +647,133 @@ class RunTimeSandbox(object):
         prms['uds_path'] = self.paths.sbox_storlet_pipe(storlet_id)
         prms['log_level'] = self.storlet_daemon_debug_level
         prms['pool_size'] = self.storlet_daemon_thread_pool_size
+        return prms
 
-        with _open_pipe() as (read_fd, write_fd):
-            dtg = ClientSBusOutDatagram.create_service_datagram(
-                SBUS_CMD_START_DAEMON,
-                write_fd,
-                prms)
+    def start_storlet_daemon(self, spath, storlet_id):
+        """
+        Start SDaemon process in the scope's sandbox
+        """
+        prms = self._get_start_params(spath, storlet_id)
+        pipe_path = self.paths.host_factory_pipe()
+        reply = self.sbus_client.call(pipe_path, SBUS_CMD_START_DAEMON, prms)
+        # TODO(takashi): Why we should rond rc into -1?
+        return self._get_reply_code(reply)
 
-            pipe_path = self.paths.host_factory_pipe()
-            rc = SBus.send(pipe_path, dtg)
-            # TODO(takashi): Why we should rond rc into -1?
-            if (rc < 0):
-                return -1
-            reply = os.read(read_fd, 10)
+    def start_storlet_daemons(self, targets):
+        """
+        Start several SDaemon processes in the scope's sandbox, in one round
+        trip with the daemon factory
 
-        res, error_txt = self._parse_sandbox_factory_answer(reply)
-        if res is True:
-            return 1
-        return 0
+        :param targets: list of (spath, storlet_id)
+        :returns: list of the status codes of each start, or -1 when the
+                  command failed to send
+        """
+        commands = [(SBUS_CMD_START_DAEMON,
+                     self._get_start_params(spath, storlet_id))
+                    for spath, storlet_id in targets]
+        pipe_path = self.paths.host_factory_pipe()
+        replies = self.sbus_client.call_batch(pipe_path, commands)
+        if replies is None:
+            return -1
+        return [self._get_reply_code(reply) for reply in replies]
 
     def stop_storlet_daemon(self, storlet_id):
         """
         Stop SDaemon process in the scope's sandbox
         """
-        with _open_pipe() as (read_fd, write_fd):
-            dtg = ClientSBusOutDatagram.create_service_datagram(
-                SBUS_CMD_STOP_DAEMON,
-                write_fd,
-                {'storlet_name': storlet_id})
-            pipe_path = self.paths.host_factory_pipe()
-            rc = SBus.send(pipe_path, dtg)
-            if (rc < 0):
-                self.logger.info("Failed to send status command to %s %s" %
-                                 (self.scope, storlet_id))
-                return -1
-
-            reply = os.read(read_fd, 10)
-
-        res, error_txt = self._parse_sandbox_factory_answer(reply)
-        if res is True:
-            return 1
-        return 0
+        self.invalidate_daemon_status(storlet_id)
+        pipe_path = self.paths.host_factory_pipe()
+        reply = self.sbus_client.call(pipe_path, SBUS_CMD_STOP_DAEMON,
+                                      {'storlet_name': storlet_id})
+        if reply is None:
+            self.logger.info("Failed to send status command to %s %s" %
+                             (self.scope, storlet_id))
+        return self._get_reply_code(reply)
 
     def get_storlet_daemon_status(self, storlet_id):
         """
         Get the status of SDaemon process in the scope's sandbox
         """
-        with _open_pipe() as (read_fd, write_fd):
-            dtg = ClientSBusOutDatagram.create_service_datagram(
-                SBUS_CMD_DAEMON_STATUS,
-                write_fd,
-                {'storlet_name': storlet_id})
-            pipe_path = self.paths.host_factory_pipe()
-            rc = SBus.send(pipe_path, dtg)
-            if (rc < 0):
-                self.logger.info("Failed to send status command to %s %s" %
-                                 (self.scope, storlet_id))
-                return -1
-            reply = os.read(read_fd, 10)
+        pipe_path = self.paths.host_factory_pipe()
+        reply = self.sbus_client.call(pipe_path, SBUS_CMD_DAEMON_STATUS,
+                                      {'storlet_name': storlet_id})
+        if reply is None:
+            self.logger.info("Failed to send status command to %s %s" %
+                             (self.scope, storlet_id))
+        return self._get_reply_code(reply)
+
+    def get_storlet_daemons_status(self, storlet_ids):
+        """
+        Get the status of several SDaemon processes in the scope's sandbox,
+        in one round trip with the daemon factory
 
-        res, error_txt = self._parse_sandbox_factory_answer(reply)
-        if res is True:
-            return 1
-        return 0
+        :param storlet_ids: list of storlet main classes
+        :returns: dict mapping each storlet to its status code, or -1 when
+                  the command failed to send
+        """
+        commands = [(SBUS_CMD_DAEMON_STATUS, {'storlet_name': storlet_id})
+                    for storlet_id in storlet_ids]
+        pipe_path = self.paths.host_factory_pipe()
+        replies = self.sbus_client.call_batch(pipe_path, commands)
+        if replies is None:
+            self.logger.info("Failed to send status command to %s" %
+                             self.scope)
+            return -1
+        return dict((storlet_id, self._get_reply_code(reply))
+                    for storlet_id, reply in zip(storlet_ids, replies))
+
+    def get_factory_status(self):
+        """
+        Get the statistics of the daemon factory in the scope's sandbox, such
+        as the histogram of the daemon start latency
+
+        :returns: dict of the statistics, or None when they are not available
+        """
+        pipe_path = self.paths.host_factory_pipe()
+        reply = self.sbus_client.call(pipe_path, SBUS_CMD_DAEMON_STATUS)
+        if reply is None or reply.status is not True:
+            return None
+        try:
+            return json.loads(reply.message)
+        except ValueError:
+            return None
+
+    def get_framing(self):
+        """
+        Get the framing of the datagrams sent to the storlet daemons
+
+        The daemons support the framing advertised by the daemon factory
+        that started them.
+
+        :returns: SBUS_FRAMING_JSON or SBUS_FRAMING_BINARY
+        """
+        return self.sbus_client.get_framing(self.paths.host_factory_pipe())
 
     def activate_storlet_daemon(self, sreq, cache_updated=True):
+        """
+        Make sure that the storlet daemon is running
+
+        :param sreq: StorletRequest instance
+        :param cache_updated: True if the storlet files were just updated
+        :returns: True if the daemon is only known to be running from the
+                  daemon status cache, without asking the daemon factory
+        """
+        start = time.time()
+        class_path = \
+            '/home/swift/%s/%s' % (sreq.storlet_main, sreq.storlet_id)
+        for dep in sreq.dependencies:
+            class_path = '%s:/home/swift/%s/%s' % \
+                         (class_path, sreq.storlet_main, dep)
+        recent_storlets.record(self.scope, sreq.storlet_main, class_path)
+
+        if cache_updated:
+            self.invalidate_daemon_status(sreq.storlet_main)
+        elif daemon_status_cache.is_running(self.scope, sreq.storlet_main):
+            # The daemon was running a moment ago, no need to ask the
+            # daemon factory again
+            activation_stats.record('warm', time.time() - start)
+            return True
+
         storlet_daemon_status = \
             self.get_storlet_daemon_status(sreq.storlet_main)
         if (storlet_daemon_status == -1):
@@ -433,12 +806,6 @@ class RunTimeSandbox(object):
 
         if (storlet_daemon_status == 0):
             self.logger.debug('Going to start storlet daemon!')
-            class_path = \
-                '/home/swift/%s/%s' % (sreq.storlet_main, sreq.storlet_id)
-            for dep in sreq.dependencies:
-                class_path = '%s:/home/swift/%s/%s' % \
-                             (class_path, sreq.storlet_main, dep)
-
             daemon_status = \
                 self.start_storlet_daemon(class_path, sreq.storlet_main)
 
@@ -449,6 +816,22 @@ class RunTimeSandbox(object):
             else:
                 self.logger.debug('Daemon started')
 
+        daemon_status_cache.set_running(self.scope, sreq.storlet_main,
+                                        self.daemon_status_cache_ttl)
+        if storlet_daemon_status == 0:
+            activation_stats.record('cold', time.time() - start)
+        else:
+            activation_stats.record('warm', time.time() - start)
+        self.logger.debug('Daemon status cache hit rate: %.2f, '
+                          'cold activations: %d (avg %.3fs), '
+                          'warm activations: %d (avg %.3fs)' %
+                          (daemon_status_cache.hit_rate,
+                           activation_stats.stats['cold'],
+                           activation_stats.average('cold'),
+                           activation_stats.stats['warm'],
+                           activation_stats.average('warm')))
+        return False
+
 """---------------------------------------------------------------------------
 Storlet Daemon API
 StorletInvocationProtocol
@@ -545,7 +928,9 @@ class StorletInvocationProtocol(object):
         """
         if not self.srequest.has_fd:
             self._input_data_read_fd, self._input_data_write_fd = os.pipe()
+            self.streaming_policy.apply_pipe_size(self._input_data_write_fd)
         self.data_read_fd, self.data_write_fd = os.pipe()
+        self.streaming_policy.apply_pipe_size(self.data_write_fd)
         self.execution_str_read_fd, self.execution_str_write_fd = os.pipe()
         self.metadata_read_fd, self.metadata_write_fd = os.pipe()
 
@@ -576,7 +961,8 @@ class StorletInvocationProtocol(object):
                 SBUS_CMD_CANCEL,
                 write_fd,
                 None,
-                self.task_id)
+                self.task_id,
+                self.framing)
             rc = SBus.send(self.storlet_pipe_path, dtg)
             if (rc < 0):
                 raise StorletRuntimeException('Failed to cancel task')
@@ -588,20 +974,42 @@ class StorletInvocationProtocol(object):
             SBUS_CMD_EXECUTE,
             self.remote_fds,
             self.remote_fds_metadata,
-            self.srequest.params)
-        rc = SBus.send(self.storlet_pipe_path, dtg)
+            self.srequest.params.as_dict(),
+            framing=self.framing)
+        if self.sbus_client:
+            rc = self.sbus_client.send(self.storlet_pipe_path, dtg)
+        else:
+            rc = SBus.send(self.storlet_pipe_path, dtg)
 
         if (rc < 0):
-            raise StorletRuntimeException("Failed to send execute command")
+            raise StorletSendError("Failed to send execute command")
 
         self._wait_for_read_with_timeout(self.execution_str_read_fd)
         self.task_id = os.read(self.execution_str_read_fd, 10)
         os.close(self.execution_str_read_fd)
 
     def __init__(self, srequest, storlet_pipe_path, storlet_logger_path,
-                 timeout):
+                 timeout, sbus_client=None, streaming_policy=None,
+                 framing=SBUS_FRAMING_JSON, timer=None):
+        """
+        :param srequest: StorletRequest instance
+        :param storlet_pipe_path: path to the storlet daemon SBus
+        :param storlet_logger_path: path to the storlet log directory
+        :param timeout: timeout for storlet execution
+        :param sbus_client: optional SBusClient used to send the execute
+                            command over a pooled socket
+        :param streaming_policy: optional StreamingPolicy about the chunks
+                                 and pipes used to stream data
+        :param framing: framing of the datagrams sent to the storlet daemon
+        :param timer: optional InvocationTimer recording the phases of the
+                      invocation
+        """
         self.srequest = srequest
         self.storlet_pipe_path = storlet_pipe_path
+        self.sbus_client = sbus_client
+        self.streaming_policy = streaming_policy or StreamingPolicy({})
+        self.framing = framing
+        self.timer = timer or InvocationTimer(None, None)
         self.storlet_logger_path = storlet_logger_path
         self.storlet_logger = StorletLogger(self.storlet_logger_path,
                                             'storlet_invoke')
@@ -681,7 +1089,8 @@ class StorletInvocationProtocol(object):
         try:
             with self.storlet_logger.activate(),\
                 self._activate_invocation_descriptors():
-                self._invoke()
+                with self.timer.phase('invoke'):
+                    self._invoke()
 
             if not self.srequest.has_fd:
                 self._wait_for_write_with_timeout(self._input_data_write_fd)
@@ -696,11 +1105,15 @@ class StorletInvocationProtocol(object):
                 #    of the Storlet writer.
                 eventlet.spawn_n(self._write_input_data)
 
-            out_md = self._read_metadata()
-            self._wait_for_read_with_timeout(self.data_read_fd)
+            with self.timer.phase('read_metadata'):
+                out_md = self._read_metadata()
+            with self.timer.phase('first_byte'):
+                self._wait_for_read_with_timeout(self.data_read_fd)
 
+            chunk_policy = self.streaming_policy.create_chunk_policy()
             return StorletResponse(out_md, data_fd=self.data_read_fd,
-                                   cancel=self._cancel)
+                                   cancel=self._cancel,
+                                   chunk_policy=chunk_policy)
         except Exception:
             self._close_local_side_descriptors()
             if not self.srequest.has_fd:
@@ -13,13 +13,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
 import urllib
+from collections import OrderedDict
 from swift.common.internal_client import InternalClient
-from swift.common.swob import HTTPBadRequest, Response, Range
-from swift.common.utils import config_true_value
+from swift.common.swob import HTTPBadRequest, HTTPNotModified, Response, \
+    Range
+from swift.common.utils import close_if_possible, config_true_value
 
-from storlet_gateway.common.exceptions import FileManagementError
+from storlet_gateway.common.coalescing import get_invocation_coalescer
+from storlet_gateway.common.exceptions import FileManagementError, \
+    StorletRuntimeException
 from storlet_gateway.common.file_manager import FileManager
+from storlet_gateway.common.output_cache import get_output_cache, \
+    output_cache_key
+from storlet_gateway.common.streaming import StreamingPolicy
 
 
 class NotStorletRequest(Exception):
@@ -30,10 +38,149 @@ class NotStorletExecution(NotStorletRequest):
     pass
 
 
+# X-Storlet-* headers which are not passed as invocation options
+NON_OPTION_HEADERS = ['X-Storlet-Range', 'X-Storlet-Generate-Log',
+                      'X-Storlet-Timing']
+
+
+class ClassifiedHeaders(object):
+    """
+    Headers split, in a single pass, into the groups used by the storlet
+    handlers:
+
+    - user_metadata: X-Object-Meta-* headers but the storlet ones, by
+      metadata key
+    - storlet_metadata: X-Object-Meta-Storlet-* headers, by parameter name
+    - options: X-Storlet-* headers but NON_OPTION_HEADERS, by option name
+    - parameters: values of the X-Storlet-Parameter* headers
+    - storlet_keys: headers to remove before storing an object
+    - storlet_range: value of X-Storlet-Range, parsed on demand into
+      storlet_ranges
+    """
+
+    def __init__(self, headers):
+        self.user_metadata = {}
+        self.storlet_metadata = {}
+        self.options = {}
+        self.parameters = []
+        self.storlet_keys = []
+        for key, value in headers.items():
+            if key.startswith('X-Object-Meta-Storlet'):
+                name = key[len('X-Object-Meta-Storlet-'):]
+                self.storlet_metadata[name] = value
+                self.storlet_keys.append(key)
+            elif key.startswith('X-Object-Meta-'):
+                self.user_metadata[key[len('X-Object-Meta-'):]] = value
+            elif key.startswith('X-Storlet-'):
+                self.storlet_keys.append(key)
+                if key not in NON_OPTION_HEADERS:
+                    name = key[len('X-Storlet-'):].lower().replace('-', '_')
+                    self.options['storlet_' + name] = value
+                if key.lower().startswith('x-storlet-parameter'):
+                    self.parameters.append(value)
+            elif key == 'X-Run-Storlet':
+                self.storlet_keys.append(key)
+        self.storlet_range = headers.get('X-Storlet-Range')
+        self._storlet_ranges = None
+
+    @property
+    def storlet_ranges(self):
+        """
+        :returns: list of the (start, end) ranges of X-Storlet-Range, None
+                  without X-Storlet-Range
+        """
+        if self._storlet_ranges is None and self.storlet_range is not None:
+            self._storlet_ranges = Range(self.storlet_range).ranges
+        return self._storlet_ranges
+
+
+# The InternalClient instances shared by the requests of the process, by
+# (config file, request tries). Building one loads a whole proxy pipeline.
+_internal_clients = {}
+
+
+def get_internal_client(conf_file, request_tries=1):
+    """
+    Get the InternalClient of the process for a config file, which is built
+    at the first call
+
+    :param conf_file: path to the internal client config file
+    :param request_tries: number of tries of each request
+    :returns: InternalClient instance
+    """
+    key = (conf_file, request_tries)
+    client = _internal_clients.get(key)
+    if client is None:
+        client = _internal_clients[key] = \
+            InternalClient(conf_file, 'SA', request_tries)
+    return client
+
+
+class StorletGatewayRegistry(object):
+    """
+    Keeps the gateways of the process by scope, so that the handlers borrow
+    them rather than building one per request
+
+    The gateways, and the sandboxes they use, are built at the first request
+    of their scope, so that they can keep state between the requests. They
+    are evicted when they are idle for idle_timeout seconds, and the least
+    recently used ones when there are more than max_gateways. The gateways
+    are shared by the concurrent requests of their scope, and thus must not
+    keep any per request state.
+    """
+
+    def __init__(self, gateway_class, conf, logger, max_gateways=100,
+                 idle_timeout=600):
+        """
+        :param gateway_class: class of the gateways
+        :param conf: gateway conf dict
+        :param logger: logger given to the gateways
+        :param max_gateways: maximum number of gateways kept
+        :param idle_timeout: seconds after which an unused gateway is evicted
+        """
+        self.gateway_class = gateway_class
+        self.conf = conf
+        self.logger = logger
+        self.max_gateways = max_gateways
+        self.idle_timeout = idle_timeout
+        # (last use, gateway) by scope, in least recently used order
+        self._gateways = OrderedDict()
+        self.stats = {'created': 0, 'reused': 0, 'evicted': 0}
+
+    def _evict_idle(self, now):
+        for scope, (last_used, _) in list(self._gateways.items()):
+            if last_used + self.idle_timeout > now:
+                break
+            del self._gateways[scope]
+            self.stats['evicted'] += 1
+
+    def get(self, scope):
+        """
+        Borrow the gateway of a scope
+
+        :param scope: scope of the sandbox
+        :returns: gateway instance
+        """
+        now = time.time()
+        self._evict_idle(now)
+        entry = self._gateways.pop(scope, None)
+        if entry is None:
+            gateway = self.gateway_class(self.conf, self.logger, scope)
+            self.stats['created'] += 1
+        else:
+            gateway = entry[1]
+            self.stats['reused'] += 1
+        self._gateways[scope] = (now, gateway)
+        while len(self._gateways) > self.max_gateways:
+            self._gateways.popitem(last=False)
+            self.stats['evicted'] += 1
+        return gateway
+
+
 class SwiftFileManager(FileManager):
 
     def __init__(self, account, storlet_container, dependency_container,
-                 log_container, conf_file, logger):
+                 log_container, conf_file, logger, request_tries=1):
         super(SwiftFileManager, self).__init__()
         self.account = account
         self.storlet_container = storlet_container
@@ -41,10 +188,11 @@ class SwiftFileManager(FileManager):
         self.log_container = log_container
         self.conf_file = conf_file
         self.logger = logger
+        self.request_tries = request_tries
 
     @property
     def client(self):
-        return InternalClient(self.conf_file, 'SA', 1)
+        return get_internal_client(self.conf_file, self.request_tries)
 
     def _get_object(self, container, obj, headers=None):
         """
@@ -71,7 +219,8 @@ class SwiftFileManager(FileManager):
         """
         self.logger.debug('PUT object %s/%s/%s to swift' %
                           (self.account, container, obj))
-        self.client.upload_object(fobj, self.account, container, headers)
+        self.client.upload_object(fobj, self.account, container, obj,
+                                  headers)
 
     def get_storlet(self, name):
         self.logger.debug('get storlet file %s from swift' % name)
@@ -125,6 +274,7 @@ def _request_instance_property():
 
     def setter(self, request):
         self._request = request
+        self._classified_request_headers = None
         try:
             self._extract_vaco()
         except ValueError:
@@ -140,12 +290,14 @@ class StorletBaseHandler(object):
     """
     request = _request_instance_property()
 
-    def __init__(self, request, conf, app, logger):
+    def __init__(self, request, conf, app, logger, gateway_registry=None):
         """
         :param request: swob.Request instance
         :param conf: gatway conf dict
         :param app: wsgi Application
         :param logger: logger instance
+        :param gateway_registry: StorletGatewayRegistry to borrow the gateway
+                                 from, None to build one for the request
         """
         self.reseller_prefix = conf.get('reseller_prefix', 'AUTH')
         self.request = request
@@ -158,16 +310,45 @@ class StorletBaseHandler(object):
         self.storlet_dependency = conf.get('storlet_dependency', 'dependency')
         self.log_container = conf.get('storlet_logcontainer', 'storletlog')
         self.client_conf_file = '/etc/swift/storlet-proxy-server.conf'
+        self.client_request_tries = \
+            int(conf.get('internal_client_request_tries', 1))
+        self.streaming_policy = StreamingPolicy(conf)
+        self.gateway_registry = gateway_registry
+        self.output_cache = get_output_cache(conf)
+        self.coalescer = get_invocation_coalescer(conf)
 
     def _setup_gateway(self):
         """
         Setup gateway instance
 
         """
-        self.gateway = self.gateway_class(
-            self.conf, self.logger, self.scope)
+        if self.gateway_registry:
+            self.gateway = self.gateway_registry.get(self.scope)
+        else:
+            self.gateway = self.gateway_class(
+                self.conf, self.logger, self.scope)
         self._update_storlet_parameters_from_headers()
 
+    def _classify_headers(self, headers):
+        """
+        Classify headers, once for the request headers as long as they are
+        not changed by the handler
+
+        :param headers: request or response headers
+        :returns: ClassifiedHeaders instance, which must not be changed
+        """
+        if headers is not self.request.headers:
+            return ClassifiedHeaders(headers)
+        if self._classified_request_headers is None:
+            self._classified_request_headers = ClassifiedHeaders(headers)
+        return self._classified_request_headers
+
+    def _request_headers_changed(self):
+        """
+        Forget the classification of the request headers after changing them
+        """
+        self._classified_request_headers = None
+
     def _extract_vaco(self):
         """
         Set version, account, container, obj vars from self._parse_vaco result
@@ -240,15 +421,16 @@ class StorletBaseHandler(object):
 
     @property
     def is_storlet_range_request(self):
-        return 'X-Storlet-Range' in self.request.headers
+        return self._classify_headers(
+            self.request.headers).storlet_range is not None
 
     @property
     def is_storlet_multiple_range_request(self):
         if not self.is_storlet_range_request:
             return False
 
-        r = self.request.headers['X-Storlet-Range']
-        return len(Range(r).ranges) > 1
+        return len(self._classify_headers(
+            self.request.headers).storlet_ranges) > 1
 
     def _has_run_on_proxy_header(self):
         """
@@ -301,18 +483,19 @@ class StorletBaseHandler(object):
 
         """
         parameters = {}
-        for param in self.request.headers:
-            if param.lower().startswith('x-storlet-parameter'):
-                keyvalue = self.request.headers[param]
-                keyvalue = urllib.unquote(keyvalue)
-                [key, value] = keyvalue.split(':')
-                parameters[key] = value
+        for keyvalue in self._classify_headers(
+                self.request.headers).parameters:
+            keyvalue = urllib.unquote(keyvalue)
+            [key, value] = keyvalue.split(':')
+            parameters[key] = value
         self.request.params.update(parameters)
 
     def _set_metadata_in_headers(self, headers, user_metadata):
         if user_metadata:
             for key, val in user_metadata.iteritems():
                 headers['X-Object-Meta-%s' % key] = val
+            if headers is self.request.headers:
+                self._request_headers_changed()
 
     def _call_gateway(self, resp):
         """
@@ -330,7 +513,37 @@ class StorletBaseHandler(object):
         :param resp: swob.Response instance
         :return: processed reponse
         """
-        sresp = self._call_gateway(resp)
+        output_key = self._get_output_key(resp)
+        # The logs are only generated by an actual invocation
+        generate_log = config_true_value(
+            self.request.headers.get('X-Storlet-Generate-Log'))
+        if_none_match = self.request.if_none_match
+        if output_key and not generate_log and if_none_match and \
+                output_key in if_none_match:
+            # The client already has the output
+            close_if_possible(resp.app_iter)
+            return HTTPNotModified(request=self.request,
+                                   headers={'Etag': output_key})
+
+        shared_key = None if generate_log else output_key
+        cached = None
+        if shared_key and self.output_cache:
+            cached = self.output_cache.get(shared_key)
+
+        timing = None
+        if cached:
+            # The storlet is not invoked, so that its input is not needed
+            close_if_possible(resp.app_iter)
+            self.logger.debug('Serving the output of %s from cache' %
+                              self.request.headers['X-Run-Storlet'])
+            user_metadata, data_iter = cached
+        elif shared_key and self.coalescer:
+            user_metadata, data_iter, timing = \
+                self._coalesce_storlet(resp, shared_key)
+        else:
+            sresp, data_iter = self._invoke_storlet(resp, shared_key)
+            user_metadata = sresp.user_metadata
+            timing = getattr(sresp, 'timing', None)
 
         new_headers = resp.headers.copy()
 
@@ -347,32 +560,134 @@ class StorletBaseHandler(object):
             new_headers['Storlet-Input-Range'] = resp.headers['Content-Range']
             new_headers.pop('Content-Range')
 
-        self._set_metadata_in_headers(new_headers, sresp.user_metadata)
+        # The ETag of the input object does not describe the output
+        if output_key:
+            new_headers['Etag'] = output_key
+        else:
+            new_headers.pop('Etag', None)
+
+        self._set_metadata_in_headers(new_headers, user_metadata)
+
+        if timing is not None:
+            new_headers['X-Storlet-Timing'] = timing.format_header()
 
-        return Response(headers=new_headers, app_iter=sresp.data_iter,
+        return Response(headers=new_headers, app_iter=data_iter,
                         reuqest=self.request)
 
-    def _get_user_metadata(self, headers):
-        metadata = {}
-        for key in headers:
-            if key.startswith('X-Object-Meta-Storlet'):
-                pass
-            elif key.startswith('X-Object-Meta-'):
-                short_key = key[len('X-Object-Meta-'):]
-                metadata[short_key] = headers[key]
-        return metadata
+    def _invoke_storlet(self, resp, output_key=None):
+        """
+        Invoke the storlet, keeping its output in the output cache
 
-    def _get_storlet_invocation_options(self, req):
-        options = dict()
+        :param resp: swob.Response instance of the input object
+        :param output_key: key of the output, None when it is not cached
+        :returns: (StorletResponse, data iterator) tuple
+        """
+        sresp = self._call_gateway(resp)
+        data_iter = sresp.data_iter
+        if output_key and self.output_cache:
+            data_iter = self.output_cache.tee(output_key, sresp.user_metadata,
+                                              data_iter)
+        return sresp, data_iter
 
-        filtered_key = ['X-Storlet-Range', 'X-Storlet-Generate-Log']
+    def _get_input_again(self, resp):
+        """
+        Get the input object again, for an invocation of the request alone
+
+        :param resp: swob.Response instance of the first input object
+        :returns: swob.Response instance of the input object
+        :raises StorletRuntimeException: when the input object changed
+        """
+        new_resp = self.request.get_response(self.app)
+        if not new_resp.is_success or \
+                self._get_input_version(new_resp) != \
+                self._get_input_version(resp):
+            close_if_possible(new_resp.app_iter)
+            raise StorletRuntimeException('The input object changed')
+        return new_resp
+
+    def _coalesce_storlet(self, resp, output_key):
+        """
+        Invoke the storlet, or share the identical invocation of a
+        concurrent request
+
+        :param resp: swob.Response instance of the input object
+        :param output_key: key of the output
+        :returns: (user metadata, data iterator, timing) tuple, timing being
+                  None when the invocation is shared
+        """
+        # The input object is read by the invocation of this request, if
+        # any. Otherwise it is kept in case this request is detached from
+        # the shared invocation.
+        sresps = []
+
+        def invoke():
+            sresp, data_iter = self._invoke_storlet(resp, output_key)
+            sresps.append(sresp)
+            return sresp.user_metadata, data_iter
+
+        def fallback():
+            if sresps:
+                input_resp = self._get_input_again(resp)
+            else:
+                sresps.append(None)
+                input_resp = resp
+            return self._call_gateway(input_resp).data_iter
+
+        def close_input(data_iter):
+            try:
+                for chunk in data_iter:
+                    yield chunk
+            finally:
+                if not sresps:
+                    close_if_possible(resp.app_iter)
+
+        user_metadata, data_iter = \
+            self.coalescer.invoke(output_key, invoke, fallback)
+        timing = getattr(sresps[0], 'timing', None) if sresps else None
+        return user_metadata, close_input(data_iter), timing
+
+    def _get_input_version(self, resp):
+        """
+        Get the version of the input object, given by its data and by its
+        metadata, which the storlets are also given
+
+        :param resp: swob.Response instance of the input object
+        :returns: (ETag, timestamp) tuple, with None for the missing values
+        """
+        timestamp = resp.headers.get('X-Timestamp') or \
+            resp.headers.get('Last-Modified')
+        return resp.headers.get('Etag'), timestamp
 
-        for key in req.headers:
-            prefix = 'X-Storlet-'
-            if key.startswith(prefix) and key not in filtered_key:
-                new_key = 'storlet_' + \
-                    key[len(prefix):].lower().replace('-', '_')
-                options[new_key] = req.headers.get(key)
+    def _get_output_key(self, resp):
+        """
+        Get the key of the storlet output, which is its ETag, the key in the
+        output cache and the key of the coalesced invocations
+
+        Only the outputs of the storlets registered with
+        X-Object-Meta-Storlet-Cacheable: true are keyed, as they must be
+        given by the input object, the storlet version and the parameters.
+
+        :param resp: swob.Response instance of the input object
+        :returns: the key, or None when the output is not deterministic
+        """
+        classified = self._classify_headers(self.request.headers)
+        if not config_true_value(classified.options.get('storlet_cacheable')):
+            return None
+        etag, timestamp = self._get_input_version(resp)
+        storlet_timestamp = classified.options.get('storlet_x_timestamp')
+        if not etag or not timestamp or not storlet_timestamp:
+            return None
+
+        path = '/'.join([self.account, self.container, self.obj])
+        return output_cache_key(
+            path, etag, timestamp, self.request.headers['X-Run-Storlet'],
+            storlet_timestamp, self.request.params, classified.storlet_range)
+
+    def _get_user_metadata(self, headers):
+        return dict(self._classify_headers(headers).user_metadata)
+
+    def _get_storlet_invocation_options(self, req):
+        options = dict(self._classify_headers(req.headers).options)
 
         scope = self.account
         if scope.rfind(':') > 0:
@@ -381,11 +696,14 @@ class StorletBaseHandler(object):
 
         options['generate_log'] = \
             config_true_value(req.headers.get('X-Storlet-Generate-Log'))
+        options['report_timing'] = \
+            config_true_value(req.headers.get('X-Storlet-Timing'))
 
         options['file_manager'] = \
             SwiftFileManager(self.account, self.storlet_container,
                              self.storlet_dependency, self.log_container,
-                             self.client_conf_file, self.logger)
+                             self.client_conf_file, self.logger,
+                             self.client_request_tries)
 
         return options
 
@@ -14,16 +14,16 @@
 # limitations under the License.
 
 from swift.common.swob import HTTPMethodNotAllowed, \
-    HTTPRequestedRangeNotSatisfiable, Range
+    HTTPRequestedRangeNotSatisfiable
 from swift.common.utils import public
 from storlet_middleware.handlers.base import StorletBaseHandler, \
     NotStorletRequest
 
 
 class StorletObjectHandler(StorletBaseHandler):
-    def __init__(self, request, conf, app, logger):
+    def __init__(self, request, conf, app, logger, gateway_registry=None):
         super(StorletObjectHandler, self).__init__(
-            request, conf, app, logger)
+            request, conf, app, logger, gateway_registry)
         # object need the gateway module only execution
         if (self.is_storlet_execution):
             self._setup_gateway()
@@ -53,9 +53,9 @@ class StorletObjectHandler(StorletBaseHandler):
         # with keepling zero copy
         if self.is_storlet_range_request and \
                 not self.is_storlet_multiple_range_request:
-            srange = Range(req.headers['X-Storlet-Range'])
-            options['range_start'] = srange.ranges[0][0]
-            options['range_end'] = srange.ranges[0][1]
+            srange = self._classify_headers(req.headers).storlet_ranges[0]
+            options['range_start'] = srange[0]
+            options['range_end'] = srange[1]
 
         return options
 
@@ -13,6 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import time
+from collections import OrderedDict
 from six.moves.urllib.parse import quote
 try:
     # We need to import copy helper functions from copy middleware
@@ -27,7 +30,9 @@ except ImportError:
         check_destination_header
 from swift.common.swob import HTTPBadRequest, HTTPUnauthorized, \
     HTTPMethodNotAllowed, HTTPPreconditionFailed
-from swift.common.utils import config_true_value, public, FileLikeIter
+from swift.common.memcached import MemcacheConnectionError
+from swift.common.utils import cache_from_env, config_true_value, public, \
+    FileLikeIter
 from swift.common.wsgi import make_subrequest
 from swift.proxy.controllers.base import get_account_info
 from storlet_middleware.handlers.base import StorletBaseHandler, \
@@ -38,17 +43,166 @@ CONDITIONAL_KEYS = ['IF_MATCH', 'IF_NONE_MATCH', 'IF_MODIFIED_SINCE',
                     'IF_UNMODIFIED_SINCE']
 
 
+class StorletVerificationCache(object):
+    """
+    Caches the results of the storlet access verifications, so that the
+    proxy does not HEAD the storlet object for every invocation
+
+    The entries are keyed by (account, storlet object, auth identity), and
+    expire after ttl seconds. They can be shared with the other proxy
+    processes through memcache, where a generation number per storlet
+    object allows to invalidate the entries of all the identities at once.
+    The stats dictionary counts the hits, that is the HEAD requests saved.
+    """
+
+    def __init__(self, ttl=10, max_entries=1000):
+        """
+        :param ttl: seconds during which a verification is reused
+        :param max_entries: maximum number of entries kept in the process
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    @staticmethod
+    def _memcache_prefix(account, storlet):
+        return 'storlet_verification/%s/%s' % (account, storlet)
+
+    def _get_generation(self, memcache, account, storlet):
+        if not memcache:
+            return None
+        prefix = self._memcache_prefix(account, storlet)
+        return memcache.get(prefix + '/generation') or 0
+
+    def _memcache_key(self, account, storlet, identity, generation):
+        prefix = self._memcache_prefix(account, storlet)
+        return '%s/%s/%s' % (prefix, generation, identity)
+
+    def get(self, account, storlet, identity, memcache=None):
+        """
+        Get the storlet parameters of a previous verification
+
+        The entries kept in the process are only used as long as the
+        generation of the storlet object in memcache did not change, so
+        that an invalidation by another process applies to them as well.
+
+        :param account: account of the storlet
+        :param storlet: name of the storlet object
+        :param identity: auth identity which was verified
+        :param memcache: MemcacheRing shared by the proxies, or None
+        :returns: dict of storlet parameters, or None on miss
+        """
+        key = (account, storlet, identity)
+        generation = self._get_generation(memcache, account, storlet)
+        params = None
+        entry = self._entries.pop(key, None)
+        if entry and entry[0] > time.time() and entry[2] == generation:
+            # Keep the entries in least recently used order
+            self._entries[key] = entry
+            params = entry[1]
+        elif memcache:
+            params = memcache.get(
+                self._memcache_key(account, storlet, identity, generation))
+
+        if params is None:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return dict(params)
+
+    def put(self, account, storlet, identity, params, memcache=None):
+        """
+        Keep the storlet parameters of a successful verification
+
+        :param account: account of the storlet
+        :param storlet: name of the storlet object
+        :param identity: auth identity which was verified
+        :param params: dict of storlet parameters
+        :param memcache: MemcacheRing shared by the proxies, or None
+        """
+        key = (account, storlet, identity)
+        generation = self._get_generation(memcache, account, storlet)
+        self._entries.pop(key, None)
+        self._entries[key] = (time.time() + self.ttl, dict(params),
+                              generation)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        if memcache:
+            memcache.set(
+                self._memcache_key(account, storlet, identity, generation),
+                params, time=self.ttl)
+
+    def invalidate(self, account, storlet, memcache=None):
+        """
+        Drop the verifications of a storlet object, for all the identities
+
+        :param account: account of the storlet
+        :param storlet: name of the storlet object
+        :param memcache: MemcacheRing shared by the proxies, or None
+        """
+        for key in [key for key in self._entries
+                    if key[:2] == (account, storlet)]:
+            del self._entries[key]
+        self.stats['invalidations'] += 1
+        if memcache:
+            try:
+                memcache.incr(
+                    self._memcache_prefix(account, storlet) + '/generation')
+            except MemcacheConnectionError:
+                # The shared entries will expire with their ttl
+                pass
+
+
+# The verification caches are shared by the handlers of a process
+_verification_caches = {}
+
+
+def get_verification_cache(conf):
+    """
+    Get the verification cache of the process
+
+    The cache is given by the following configuration values:
+    - storlet_verification_cache_ttl: seconds during which a verification
+      is reused, 0 to verify the access at every invocation
+    - storlet_verification_cache_size: maximum number of verifications kept
+      in the process
+
+    :param conf: middleware conf dict
+    :returns: StorletVerificationCache instance, or None when disabled
+    """
+    ttl = float(conf.get('storlet_verification_cache_ttl', 10))
+    max_entries = int(conf.get('storlet_verification_cache_size', 1000))
+    if ttl <= 0 or max_entries <= 0:
+        return None
+
+    key = (ttl, max_entries)
+    if key not in _verification_caches:
+        _verification_caches[key] = \
+            StorletVerificationCache(ttl, max_entries)
+    return _verification_caches[key]
+
+
 class StorletProxyHandler(StorletBaseHandler):
-    def __init__(self, request, conf, app, logger):
+    def __init__(self, request, conf, app, logger, gateway_registry=None):
         super(StorletProxyHandler, self).__init__(
-            request, conf, app, logger)
+            request, conf, app, logger, gateway_registry)
         self.storlet_containers = [self.storlet_container,
                                    self.storlet_dependency]
+        self.verification_cache = get_verification_cache(conf)
+        self.verification_memcache = config_true_value(
+            conf.get('storlet_verification_cache_memcache', False))
 
         if not self.is_storlet_request:
             # This is not storlet-related request, so pass it
             raise NotStorletRequest()
 
+        if self.is_storlet_object_delete:
+            # The deletion is passed, and only followed by the invalidation
+            # of the cached verifications, whether storlets are enabled or
+            # not at the account
+            return
+
         # In proxy server, storlet handler validate if storlet enabled
         # at the account, anyway
         account_meta = get_account_info(self.request.environ,
@@ -63,7 +217,8 @@ class StorletProxyHandler(StorletBaseHandler):
         if self.is_storlet_object_update:
             # TODO(takashi): We have to validate metadata in COPY case
             self._validate_registration(self.request)
-            raise NotStorletExecution()
+            if not self.invalidates_verifications:
+                raise NotStorletExecution()
         else:
             # if self.is_storlet_execution
             self._setup_gateway()
@@ -88,13 +243,32 @@ class StorletProxyHandler(StorletBaseHandler):
 
     @property
     def is_storlet_request(self):
-        return self.is_storlet_execution or self.is_storlet_object_update
+        return (self.is_storlet_execution or self.is_storlet_object_update or
+                (self.is_storlet_object_delete and
+                 self.invalidates_verifications))
 
     @property
     def is_storlet_object_update(self):
         return (self.container in self.storlet_containers and self.obj
                 and self.request.method in ['PUT', 'POST'])
 
+    @property
+    def is_storlet_object_delete(self):
+        return (self.container == self.storlet_container and self.obj
+                and self.request.method == 'DELETE'
+                and not self.is_storlet_execution)
+
+    @property
+    def invalidates_verifications(self):
+        """
+        Whether the request changes a storlet object, so that the cached
+        verifications of the access to it are invalidated
+
+        :return: Whether the cached verifications are invalidated
+        """
+        return bool(self.verification_cache and
+                    self.container == self.storlet_container)
+
     @property
     def is_put_copy_request(self):
         return 'X-Copy-From' in self.request.headers
@@ -105,11 +279,7 @@ class StorletProxyHandler(StorletBaseHandler):
 
         :returns: dict of storlet parameters
         """
-        params = dict()
-        for key in headers:
-            if key.startswith('X-Object-Meta-Storlet'):
-                params[key[len('X-Object-Meta-Storlet-'):]] = headers[key]
-        return params
+        return dict(self._classify_headers(headers).storlet_metadata)
 
     def _validate_registration(self, req):
         """
@@ -134,16 +304,49 @@ class StorletProxyHandler(StorletBaseHandler):
             self.logger.exception('Bad parameter')
             raise HTTPBadRequest(e.message)
 
+    def _get_memcache(self):
+        if not self.verification_memcache:
+            return None
+        return cache_from_env(self.request.environ, allow_none=True)
+
+    def _get_auth_identity(self):
+        """
+        Get the identity the access to the storlet is verified for
+
+        :returns: digest of the auth token, or None when there is no token
+        """
+        auth_token = self.request.headers.get('X-Auth-Token')
+        if not auth_token:
+            return None
+        return hashlib.md5(auth_token).hexdigest()
+
     def verify_access_to_storlet(self):
         """
         Verify access to the storlet object
 
+        The result of a successful verification is cached for a short
+        time, per auth identity.
+
         :return: storlet parameters
         :raises HTTPUnauthorized: If it fails to verify access
         """
         sobj = self.request.headers.get('X-Run-Storlet')
         spath = '/'.join(['', self.api_version, self.account,
                           self.storlet_container, sobj])
+
+        identity = None
+        if self.verification_cache:
+            identity = self._get_auth_identity()
+        memcache = self._get_memcache()
+        if identity:
+            params = self.verification_cache.get(
+                self.account, sobj, identity, memcache)
+            if params is not None:
+                self.logger.debug(
+                    'Verified access to %s from cache (%d HEAD requests '
+                    'saved)' % (spath, self.verification_cache.stats['hits']))
+                return params
+
         self.logger.debug('Verify access to %s' % spath)
 
         new_env = dict(self.request.environ)
@@ -169,9 +372,28 @@ class StorletProxyHandler(StorletBaseHandler):
         params = self._parse_storlet_params(resp.headers)
         for key in ['Content-Length', 'X-Timestamp']:
             params[key] = resp.headers[key]
+        if identity:
+            self.verification_cache.put(
+                self.account, sobj, identity, params, memcache)
         return params
 
+    def handle_storlet_object_change(self):
+        """
+        Pass a change of a storlet object, and invalidate the cached
+        verifications of the access to the storlet once it succeeded
+
+        :return: swob.Response instance
+        """
+        resp = self.request.get_response(self.app)
+        if resp.is_success:
+            self.verification_cache.invalidate(
+                self.account, self.obj, self._get_memcache())
+        return resp
+
     def handle_request(self):
+        if self.is_storlet_object_update or self.is_storlet_object_delete:
+            return self.handle_storlet_object_change()
+
         if hasattr(self, self.request.method):
             try:
                 handler = getattr(self, self.request.method)
@@ -195,8 +417,11 @@ class StorletProxyHandler(StorletBaseHandler):
 
         :param params: paramegers to be augmented to request
         """
+        # Only the storlet object tells whether its output can be cached
+        self.request.headers.pop('X-Storlet-Cacheable', None)
         for key, val in params.iteritems():
             self.request.headers['X-Storlet-' + key] = val
+        self._request_headers_changed()
 
     @public
     def GET(self):
@@ -280,11 +505,10 @@ class StorletProxyHandler(StorletBaseHandler):
         return self.request.get_response(self.app)
 
     def _remove_storlet_headers(self, headers):
-        for key in headers.keys():
-            if (key.startswith('X-Storlet-') or
-                    key.startswith('X-Object-Meta-Storlet') or
-                    key == 'X-Run-Storlet'):
-                headers.pop(key)
+        for key in self._classify_headers(headers).storlet_keys:
+            headers.pop(key)
+        if headers is self.request.headers:
+            self._request_headers_changed()
 
     def base_handle_copy_request(self, src_container, src_obj,
                                  dest_container, dest_object):
@@ -334,9 +558,8 @@ class StorletProxyHandler(StorletBaseHandler):
             return self.base_handle_copy_request(src_container, src_obj,
                                                  dest_container, dest_object)
 
-        # TODO(takashi): chunk size should be configurable
         reader = self.request.environ['wsgi.input'].read
-        body_iter = iter(lambda: reader(65536), '')
+        body_iter = self.streaming_policy.iter_reader(reader)
         sreq = self._build_storlet_request(
             self.request, self.request.headers, body_iter)
 
@@ -18,7 +18,8 @@ from swift.common.utils import config_true_value, get_logger, \
     register_swift_info
 from storlet_gateway.common.exceptions import StorletRuntimeException, \
     StorletTimeout
-from storlet_middleware.handlers.base import NotStorletRequest
+from storlet_middleware.handlers.base import NotStorletRequest, \
+    StorletGatewayRegistry
 from storlet_middleware.handlers import StorletProxyHandler, \
     StorletObjectHandler
 
@@ -31,6 +32,13 @@ class StorletHandlerMiddleware(object):
         self.exec_server = storlet_conf.get('execution_server')
         self.handler_class = self._get_handler(self.exec_server)
         self.gateway_conf = storlet_conf
+        # The gateways are kept between the requests, by scope
+        self.gateway_registry = None
+        if storlet_conf.get('storlet_gateway_registry_size', 0) > 0:
+            self.gateway_registry = StorletGatewayRegistry(
+                storlet_conf['gateway_module'], storlet_conf, self.logger,
+                storlet_conf['storlet_gateway_registry_size'],
+                storlet_conf.get('storlet_gateway_idle_timeout', 600))
 
     def _get_handler(self, exec_server):
         """
@@ -53,7 +61,8 @@ class StorletHandlerMiddleware(object):
     def __call__(self, req):
         try:
             request_handler = self.handler_class(
-                req, self.gateway_conf, self.app, self.logger)
+                req, self.gateway_conf, self.app, self.logger,
+                self.gateway_registry)
             self.logger.debug('storlet_handler call in %s: with %s/%s/%s' %
                               (self.exec_server, request_handler.account,
                                request_handler.container, request_handler.obj))
@@ -100,6 +109,18 @@ def filter_factory(global_conf, **local_conf):
     storlet_conf['storlet_execute_on_proxy_only'] = \
         config_true_value(conf.get('storlet_execute_on_proxy_only', 'false'))
     storlet_conf['reseller_prefix'] = conf.get('reseller_prefix', 'AUTH')
+    storlet_conf['internal_client_request_tries'] = \
+        int(conf.get('internal_client_request_tries', 1))
+    storlet_conf['storlet_gateway_registry_size'] = \
+        int(conf.get('storlet_gateway_registry_size', 100))
+    storlet_conf['storlet_gateway_idle_timeout'] = \
+        float(conf.get('storlet_gateway_idle_timeout', 600))
+    storlet_conf['storlet_verification_cache_ttl'] = \
+        float(conf.get('storlet_verification_cache_ttl', 10))
+    storlet_conf['storlet_verification_cache_size'] = \
+        int(conf.get('storlet_verification_cache_size', 1000))
+    storlet_conf['storlet_verification_cache_memcache'] = config_true_value(
+        conf.get('storlet_verification_cache_memcache', 'false'))
 
     module_name = conf.get('storlet_gateway_module', '')
     mo = module_name[:module_name.rfind(':')]
@@ -0,0 +1,201 @@
+# Copyright (c) 2015-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from SBusPythonFacade import SBus as sbus_module
+from SBusPythonFacade.SBus import SBus
+from SBusPythonFacade.SBus import SBusPoller
+from SBusPythonFacade.SBusDatagram import ClientSBusOutDatagram
+from SBusPythonFacade.SBusFileDescription import SBUS_FD_INPUT_OBJECT
+from SBusPythonFacade.SBusStorletCommand import SBUS_CMD_EXECUTE, \
+    SBUS_CMD_PING
+
+
+class TestSBus(unittest.TestCase):
+
+    def setUp(self):
+        self.native = mock.MagicMock()
+        self.patcher = mock.patch('SBusPythonFacade.SBus._sbus', self.native)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        SBus.USE_NATIVE = True
+
+    def test_send_native(self):
+        self.native.send.return_value = 10
+        self.native.send_on.return_value = 11
+        dtg = ClientSBusOutDatagram.create_service_datagram(SBUS_CMD_PING, 4)
+        self.assertEqual(10, SBus.send('path', dtg))
+        self.native.send.assert_called_once_with(
+            'path', [4], dtg.serialized_md, dtg.serialized_cmd_params)
+        self.assertEqual(11, SBus.send_on(3, dtg))
+        self.native.send_on.assert_called_once_with(
+            3, [4], dtg.serialized_md, dtg.serialized_cmd_params)
+
+        # No metadata is sent without fds
+        dtg = ClientSBusOutDatagram(SBUS_CMD_PING, [], [])
+        SBus.send('path', dtg)
+        self.assertEqual(
+            mock.call('path', [], None, dtg.serialized_cmd_params),
+            self.native.send.call_args)
+
+    def test_receive_native(self):
+        self.native.create.return_value = 3
+        sbus = SBus()
+        self.assertEqual(3, sbus.create('path'))
+        self.native.recv.return_value = (
+            [5], json.dumps([{'storlets': {'type': 'SBUS_FD_LOGGER'},
+                              'storage': {}}]),
+            json.dumps({'command': SBUS_CMD_EXECUTE}))
+        dtg = sbus.receive(3)
+        self.native.recv.assert_called_once_with(3)
+        self.assertEqual([5], dtg.fds)
+        self.assertEqual(SBUS_CMD_EXECUTE, dtg.command)
+
+        self.native.recv.return_value = None
+        self.assertIsNone(sbus.receive(3))
+
+    def test_ctypes_fallback(self):
+        SBus.USE_NATIVE = False
+        with mock.patch.object(SBus, '_get_backend') as _get_backend:
+            _get_backend.return_value.sbus_connect.return_value = 7
+            self.assertEqual(7, SBus.connect('path'))
+        self.assertFalse(self.native.connect.called)
+
+
+class TestSBusTransport(unittest.TestCase):
+    """
+    Round trips through the built C-library, when it is installed
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fds = []
+
+    def tearDown(self):
+        for fd in self.fds:
+            os.close(fd)
+        shutil.rmtree(self.tmp_dir)
+        SBus.USE_NATIVE = True
+
+    def _round_trip(self, dtg):
+        path = os.path.join(self.tmp_dir, 'sbus')
+        sbus = SBus()
+        handle = sbus.create(path)
+        self.assertLessEqual(0, handle)
+        self.fds.append(handle)
+        sock = SBus.connect(path)
+        self.assertLessEqual(0, sock)
+        self.fds.append(sock)
+
+        self.assertLessEqual(0, SBus.send_on(sock, dtg))
+        self.assertLessEqual(0, sbus.listen(handle))
+        received = sbus.receive(handle)
+        self.assertIsNotNone(received)
+        self.fds.extend(received.fds)
+        return received
+
+    def _assert_large_round_trip(self):
+        read_fd, write_fd = os.pipe()
+        self.fds.extend([read_fd, write_fd])
+        md = [{'storlets': {'type': SBUS_FD_INPUT_OBJECT}, 'storage': {}}]
+        # Larger than a datagram, so that the message is sent in the large
+        # message mode
+        params = {'key': 'x' * 18944}
+        received = self._round_trip(
+            ClientSBusOutDatagram(SBUS_CMD_EXECUTE, [write_fd], md, params))
+
+        self.assertEqual(SBUS_CMD_EXECUTE, received.command)
+        self.assertEqual(params, received.params)
+        self.assertEqual(md, received.metadata)
+        self.assertEqual(1, received.num_fds)
+        # The received descriptor is the write end of the pipe
+        os.write(received.fds[0], 'data')
+        self.assertEqual('data', os.read(read_fd, 4))
+
+    def test_large_message_ctypes(self):
+        if not os.path.exists(SBus.SBUS_SO_NAME):
+            self.skipTest('The C-library is not installed')
+        SBus.USE_NATIVE = False
+        self._assert_large_round_trip()
+
+    def test_large_message_native(self):
+        if sbus_module._sbus is None:
+            self.skipTest('The native facade is not built')
+        self._assert_large_round_trip()
+
+
+class TestSBusPoller(unittest.TestCase):
+
+    def setUp(self):
+        self.native = mock.MagicMock()
+        self.patcher = mock.patch('SBusPythonFacade.SBus._sbus', self.native)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        SBus.USE_NATIVE = True
+
+    def test_wait_native(self):
+        self.native.poll_create.return_value = 8
+        self.native.poll_add.return_value = 0
+        self.native.poll_wait.return_value = [3]
+        poller = SBusPoller()
+        self.assertEqual(8, poller.create())
+        self.assertEqual(0, poller.add(3))
+        self.native.poll_add.assert_called_once_with(8, 3)
+
+        self.assertEqual([3], poller.wait(0.5))
+        self.native.poll_wait.assert_called_once_with(8, 500)
+        poller.wait()
+        self.assertEqual(mock.call(8, -1), self.native.poll_wait.call_args)
+
+        poller.close()
+        poller.close()
+        self.native.poll_close.assert_called_once_with(8)
+
+    def test_wait_ctypes(self):
+        SBus.USE_NATIVE = False
+
+        def poll_wait(poll, handles, max_events, timeout_ms):
+            handles[0] = 3
+            handles[1] = 4
+            return 2
+
+        with mock.patch.object(SBus, '_get_backend') as _get_backend:
+            back = _get_backend.return_value
+            back.sbus_poll_create.return_value = 8
+            back.sbus_poll_wait.side_effect = poll_wait
+            poller = SBusPoller()
+            poller.create()
+            self.assertEqual([3, 4], poller.wait(1))
+
+            back.sbus_poll_wait.side_effect = None
+            back.sbus_poll_wait.return_value = 0
+            self.assertEqual([], poller.wait(1))
+            back.sbus_poll_wait.return_value = -1
+            self.assertIsNone(poller.wait(1))
+        self.assertFalse(self.native.poll_wait.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
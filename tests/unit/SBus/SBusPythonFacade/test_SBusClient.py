@@ -0,0 +1,306 @@
+# Copyright (c) 2015-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import unittest
+from contextlib import contextmanager
+
+from SBusPythonFacade.SBusClient import SBusClient
+from SBusPythonFacade.SBusDatagram import SBusServiceReply, \
+    SBUS_FRAMING_BINARY, SBUS_FRAMING_JSON
+from SBusPythonFacade.SBusStorletCommand import SBUS_CMD_BATCH, \
+    SBUS_CMD_DAEMON_STATUS, SBUS_CMD_PING
+
+
+class FakeSBus(object):
+    """
+    Fake of the socket related SBus methods
+
+    :param send_results: results of the successive send_on calls, 0 by
+                         default
+    """
+    def __init__(self, send_results=None):
+        self.send_results = list(send_results or [])
+        self.next_sock = 100
+        self.connected = []
+        self.sent = []
+        self.closed = []
+
+    def connect(self, path):
+        sock = self.next_sock
+        self.next_sock += 1
+        self.connected.append((path, sock))
+        return sock
+
+    def send_on(self, sock, datagram):
+        self.sent.append((sock, datagram))
+        if self.send_results:
+            return self.send_results.pop(0)
+        return 0
+
+    def close(self, fd):
+        self.closed.append(fd)
+
+
+@contextmanager
+def _mock_sbus(fake):
+    with mock.patch('SBusPythonFacade.SBusClient.SBus.connect',
+                    fake.connect), \
+        mock.patch('SBusPythonFacade.SBusClient.SBus.send_on',
+                   fake.send_on), \
+        mock.patch('SBusPythonFacade.SBusClient.os.close', fake.close):
+        yield
+
+
+class TestSBusServiceReply(unittest.TestCase):
+
+    def test_serialize(self):
+        reply = SBusServiceReply(
+            True, 'done', [SBusServiceReply(True, 'OK'),
+                           SBusServiceReply(False, 'error')])
+        serialized = reply.serialize()
+        self.assertTrue(serialized.endswith('\n'))
+        self.assertTrue(SBusServiceReply.is_complete(serialized))
+        self.assertFalse(SBusServiceReply.is_complete(serialized[:-1]))
+        parsed = SBusServiceReply.parse(serialized)
+        self.assertTrue(parsed.status)
+        self.assertEqual('done', parsed.message)
+        self.assertFalse(parsed.legacy)
+        self.assertEqual([(True, 'OK'), (False, 'error')],
+                         [(sub.status, sub.message)
+                          for sub in parsed.replies])
+
+    def test_parse_legacy(self):
+        reply = SBusServiceReply.parse('True: message')
+        self.assertTrue(reply.status)
+        self.assertEqual('message', reply.message)
+        self.assertTrue(reply.legacy)
+        self.assertIsNone(reply.replies)
+        self.assertTrue(SBusServiceReply.is_complete('True: message'))
+
+        reply = SBusServiceReply.parse('False:message')
+        self.assertFalse(reply.status)
+        self.assertEqual('message', reply.message)
+
+        for malformed in ('garbage', '[1, 2]\n', '{"status"\n'):
+            with self.assertRaises(ValueError):
+                SBusServiceReply.parse(malformed)
+
+
+class TestSBusClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = SBusClient(max_idle=2)
+        self.fake = FakeSBus()
+
+    def test_send_reuses_socket(self):
+        with _mock_sbus(self.fake):
+            for _ in range(3):
+                self.assertEqual(0, self.client.send('path', 'dtg'))
+        self.assertEqual([('path', 100)], self.fake.connected)
+        self.assertEqual([100, 100, 100],
+                         [sock for sock, _ in self.fake.sent])
+        self.assertEqual(1, self.client.stats['sockets_created'])
+        self.assertEqual(2, self.client.stats['sockets_reused'])
+        self.assertEqual([], self.fake.closed)
+
+    def test_send_per_path(self):
+        with _mock_sbus(self.fake):
+            self.client.send('path1', 'dtg')
+            self.client.send('path2', 'dtg')
+            self.client.send('path1', 'dtg')
+        self.assertEqual([('path1', 100), ('path2', 101)],
+                         self.fake.connected)
+        self.assertEqual([100, 101, 100],
+                         [sock for sock, _ in self.fake.sent])
+
+    def test_send_retries_on_stale_socket(self):
+        with _mock_sbus(self.fake):
+            self.client.send('path', 'dtg')
+            self.fake.send_results = [-1, 0]
+            self.assertEqual(0, self.client.send('path', 'dtg'))
+        self.assertEqual([('path', 100), ('path', 101)],
+                         self.fake.connected)
+        self.assertEqual([100], self.fake.closed)
+
+    def test_send_fails(self):
+        # A failure on a fresh socket is not retried
+        self.fake.send_results = [-1]
+        with _mock_sbus(self.fake):
+            self.assertEqual(-1, self.client.send('path', 'dtg'))
+        self.assertEqual(1, len(self.fake.sent))
+        self.assertEqual([100], self.fake.closed)
+
+        # The retry on a fresh socket fails as well
+        with _mock_sbus(self.fake):
+            self.client.send('path', 'dtg')
+            self.fake.send_results = [-1, -1]
+            self.assertEqual(-1, self.client.send('path', 'dtg'))
+        self.assertEqual([100, 101, 102], self.fake.closed)
+
+    def test_reply_pipe(self):
+        with mock.patch('SBusPythonFacade.SBusClient.os.pipe') as _pipe:
+            _pipe.return_value = (3, 4)
+            with self.client.reply_pipe() as fds:
+                self.assertEqual((3, 4), fds)
+            with self.client.reply_pipe() as fds:
+                self.assertEqual((3, 4), fds)
+            self.assertEqual(1, _pipe.call_count)
+        self.assertEqual(1, self.client.stats['pipes_created'])
+        self.assertEqual(1, self.client.stats['pipes_reused'])
+
+    def test_reply_pipe_closed_on_error(self):
+        with _mock_sbus(self.fake), \
+            mock.patch('SBusPythonFacade.SBusClient.os.pipe') as _pipe:
+            _pipe.return_value = (3, 4)
+            with self.assertRaises(ValueError):
+                with self.client.reply_pipe():
+                    raise ValueError()
+        self.assertEqual([3, 4], self.fake.closed)
+        self.assertEqual([], self.client._pipes)
+
+    def test_call(self):
+        with _mock_sbus(self.fake), \
+            mock.patch('SBusPythonFacade.SBusClient.os.pipe') as _pipe, \
+            mock.patch('SBusPythonFacade.SBusClient.os.read') as _read:
+            _pipe.return_value = (3, 4)
+            _read.return_value = 'True: OK'
+            reply = self.client.call('path', SBUS_CMD_PING)
+            self.assertTrue(reply.status)
+            self.assertEqual('OK', reply.message)
+            _read.assert_called_once_with(3, SBusClient.REPLY_SIZE)
+            sock, dtg = self.fake.sent[0]
+            self.assertEqual([4], dtg.fds)
+
+            self.fake.send_results = [-1, -1]
+            self.assertIsNone(self.client.call('path', SBUS_CMD_PING))
+            self.assertEqual(1, _pipe.call_count)
+
+    def test_call_structured_reply(self):
+        serialized = SBusServiceReply(False, 'x' * 5000).serialize()
+        with _mock_sbus(self.fake), \
+            mock.patch('SBusPythonFacade.SBusClient.os.pipe') as _pipe, \
+            mock.patch('SBusPythonFacade.SBusClient.os.read') as _read:
+            _pipe.return_value = (3, 4)
+            # A long reply is read until its end
+            _read.side_effect = [serialized[:4096], serialized[4096:]]
+            reply = self.client.call('path', SBUS_CMD_PING)
+            self.assertFalse(reply.status)
+            self.assertEqual('x' * 5000, reply.message)
+
+            _read.side_effect = ['garbage']
+            reply = self.client.call('path', SBUS_CMD_PING)
+            self.assertFalse(reply.status)
+
+    def test_call_batch(self):
+        commands = [(SBUS_CMD_DAEMON_STATUS, {'storlet_name': 'storlet1'}),
+                    (SBUS_CMD_DAEMON_STATUS, {'storlet_name': 'storlet2'})]
+        batch_reply = SBusServiceReply(
+            False, '', [SBusServiceReply(True, 'running'),
+                        SBusServiceReply(False, 'not running')]).serialize()
+        with _mock_sbus(self.fake), \
+            mock.patch('SBusPythonFacade.SBusClient.os.pipe') as _pipe, \
+            mock.patch('SBusPythonFacade.SBusClient.os.read') as _read:
+            _pipe.return_value = (3, 4)
+            # The commands are sent one by one to a server side which has
+            # not shown that it supports batches yet
+            _read.side_effect = ['True: running', 'False: not running']
+            replies = self.client.call_batch('path', commands)
+            self.assertEqual([True, False],
+                             [reply.status for reply in replies])
+            self.assertEqual(2, len(self.fake.sent))
+
+            _read.side_effect = [SBusServiceReply(True, 'OK').serialize(),
+                                 batch_reply]
+            self.client.call('path', SBUS_CMD_PING)
+            replies = self.client.call_batch('path', commands)
+            self.assertEqual([(True, 'running'), (False, 'not running')],
+                             [(reply.status, reply.message)
+                              for reply in replies])
+            self.assertEqual(4, len(self.fake.sent))
+            dtg = self.fake.sent[-1][1]
+            self.assertIn(SBUS_CMD_BATCH, dtg.serialized_cmd_params)
+
+            self.fake.send_results = [-1, -1]
+            self.assertIsNone(self.client.call_batch('path', commands))
+
+    def test_framing(self):
+        with _mock_sbus(self.fake), \
+            mock.patch('SBusPythonFacade.SBusClient.os.pipe') as _pipe, \
+            mock.patch('SBusPythonFacade.SBusClient.os.read') as _read:
+            _pipe.return_value = (3, 4)
+            self.client.max_framing = SBUS_FRAMING_BINARY
+            self.assertEqual(SBUS_FRAMING_JSON,
+                             self.client.get_framing('path'))
+
+            # The server side advertises the binary framing
+            _read.return_value = SBusServiceReply(
+                True, 'OK', framing=SBUS_FRAMING_BINARY).serialize()
+            self.client.call('path', SBUS_CMD_PING)
+            self.assertEqual(SBUS_FRAMING_JSON, self.fake.sent[0][1].framing)
+            self.assertEqual(SBUS_FRAMING_BINARY,
+                             self.client.get_framing('path'))
+            self.client.call('path', SBUS_CMD_PING)
+            self.assertEqual(SBUS_FRAMING_BINARY,
+                             self.fake.sent[1][1].framing)
+            self.assertEqual(SBUS_FRAMING_JSON,
+                             self.client.get_framing('other'))
+
+            # A framing newer than ours is not used
+            _read.return_value = SBusServiceReply(
+                True, 'OK', framing=SBUS_FRAMING_BINARY + 1).serialize()
+            self.client.call('path', SBUS_CMD_PING)
+            self.assertEqual(SBUS_FRAMING_BINARY,
+                             self.client.get_framing('path'))
+
+            # Nor with older server sides
+            _read.return_value = 'True: OK'
+            self.client.call('path', SBUS_CMD_PING)
+            self.assertEqual(SBUS_FRAMING_JSON,
+                             self.client.get_framing('path'))
+
+            # Nor unless enabled
+            _read.return_value = SBusServiceReply(
+                True, 'OK', framing=SBUS_FRAMING_BINARY).serialize()
+            self.client.call('path', SBUS_CMD_PING)
+            self.client.max_framing = SBUS_FRAMING_JSON
+            self.assertEqual(SBUS_FRAMING_JSON,
+                             self.client.get_framing('path'))
+
+    def test_close(self):
+        with _mock_sbus(self.fake), \
+            mock.patch('SBusPythonFacade.SBusClient.os.pipe') as _pipe:
+            _pipe.return_value = (3, 4)
+            self.client.send('path', 'dtg')
+            with self.client.reply_pipe():
+                pass
+            self.client.close()
+        self.assertEqual([100, 3, 4], self.fake.closed)
+
+    def test_close_in_use(self):
+        with _mock_sbus(self.fake), \
+            mock.patch('SBusPythonFacade.SBusClient.os.pipe') as _pipe:
+            _pipe.return_value = (3, 4)
+            with self.client.reply_pipe():
+                self.client.close()
+                self.assertEqual([], self.fake.closed)
+            self.client.send('path', 'dtg')
+        # The pipe in use and the new socket are not kept
+        self.assertEqual([3, 4, 100], self.fake.closed)
+        self.assertEqual([], self.client._pipes)
+
+
+if __name__ == '__main__':
+    unittest.main()
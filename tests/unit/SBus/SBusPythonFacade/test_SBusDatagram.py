@@ -0,0 +1,93 @@
+# Copyright (c) 2015-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+
+from SBusPythonFacade.SBusDatagram import ClientSBusOutDatagram, \
+    ServerSBusInDatagram, SBUS_FRAMING_BINARY, SBUS_FRAMING_JSON, \
+    decode_binary_md, decode_binary_params, encode_binary_params
+from SBusPythonFacade.SBusFileDescription import SBUS_FD_INPUT_OBJECT, \
+    SBUS_FD_LOGGER
+from SBusPythonFacade.SBusStorletCommand import SBUS_CMD_EXECUTE
+
+
+class TestSBusDatagram(unittest.TestCase):
+
+    def setUp(self):
+        self.md = [{'storlets': {'type': SBUS_FD_INPUT_OBJECT,
+                                 'start': '1', 'end': '10'},
+                    'storage': {'X-Object-Meta-Key': u'value \xe9',
+                                'Content-Length': '10'}},
+                   {'storlets': {'type': SBUS_FD_LOGGER},
+                    'storage': {}}]
+        self.params = {'param1': 'value1', 'param2': u'\xe9',
+                       'count': 3, 'list': ['a', 1]}
+
+    def _round_trip(self, framing):
+        dtg = ClientSBusOutDatagram(SBUS_CMD_EXECUTE, [3, 4], self.md,
+                                    self.params, 'task', framing)
+        return ServerSBusInDatagram(dtg.fds, dtg.serialized_md,
+                                    dtg.serialized_cmd_params)
+
+    def test_round_trip(self):
+        for framing in (SBUS_FRAMING_JSON, SBUS_FRAMING_BINARY):
+            dtg = self._round_trip(framing)
+            self.assertEqual([3, 4], dtg.fds)
+            self.assertEqual(SBUS_CMD_EXECUTE, dtg.command)
+            self.assertEqual('task', dtg.task_id)
+            self.assertEqual(self.params, dtg.params)
+            self.assertEqual(self.md, dtg.metadata)
+            self.assertIsNone(dtg.get_service_out_fd())
+
+    def test_binary_is_compact(self):
+        json_dtg = ClientSBusOutDatagram(SBUS_CMD_EXECUTE, [3, 4], self.md,
+                                         self.params)
+        binary_dtg = ClientSBusOutDatagram(SBUS_CMD_EXECUTE, [3, 4], self.md,
+                                           self.params,
+                                           framing=SBUS_FRAMING_BINARY)
+        self.assertLess(len(binary_dtg.serialized_md),
+                        len(json_dtg.serialized_md))
+        # The fd types are interned
+        self.assertNotIn(SBUS_FD_INPUT_OBJECT, binary_dtg.serialized_md)
+
+    def test_binary_without_params(self):
+        command, params, task_id = decode_binary_params(
+            encode_binary_params(SBUS_CMD_EXECUTE, None, None))
+        self.assertEqual(SBUS_CMD_EXECUTE, command)
+        self.assertIsNone(params)
+        self.assertIsNone(task_id)
+
+    def test_binary_malformed(self):
+        data = encode_binary_params(SBUS_CMD_EXECUTE, self.params, 'task')
+        for malformed in (data[:-3], data[:1], '\x00\x02' + data[2:],
+                          data[:2] + 'X' + data[3:]):
+            with self.assertRaises(ValueError):
+                decode_binary_params(malformed)
+        with self.assertRaises(ValueError):
+            decode_binary_md('\x00\x01\x00\x00\x00\x01')
+
+    def test_json_unchanged(self):
+        dtg = ClientSBusOutDatagram(SBUS_CMD_EXECUTE, [3], self.md[:1],
+                                    {'param1': 'value1'}, 'task')
+        self.assertEqual({'command': SBUS_CMD_EXECUTE,
+                          'params': {'param1': 'value1'},
+                          'task_id': 'task'},
+                         json.loads(dtg.serialized_cmd_params))
+        self.assertEqual(self.md[:1], json.loads(dtg.serialized_md))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,11 +13,82 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import logging
+import mock
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from six import StringIO
 
-from storlet_daemon_factory.daemon_factory import start_logger
+from SBusPythonFacade.SBusDatagram import SBusServiceReply, \
+    SBUS_FRAMING_JSON
+from SBusPythonFacade.SBusStorletCommand import SBUS_CMD_BATCH, \
+    SBUS_CMD_DAEMON_STATUS, SBUS_CMD_HALT, SBUS_CMD_PING, \
+    SBUS_CMD_START_DAEMON
+from storlet_daemon_factory.daemon_factory import DaemonFactory, \
+    start_logger
+
+
+class FakeDatagram(object):
+    def __init__(self, command, params=None):
+        self.command = command
+        self.params = params
+        self.read_fd, self.write_fd = os.pipe()
+        self.received = None
+
+    def get_service_out_fd(self):
+        return self.write_fd
+
+    def get_reply(self):
+        try:
+            return SBusServiceReply.parse(os.read(self.read_fd, 4096))
+        finally:
+            os.close(self.read_fd)
+
+
+class FakeSBus(object):
+    """
+    Fake SBus receiving the given datagrams
+    """
+    datagrams = []
+
+    def create(self, path):
+        return 0
+
+    def listen(self, fd):
+        return 0
+
+    def receive(self, fd):
+        dtg = self.datagrams.pop(0)
+        dtg.received = time.time()
+        return dtg
+
+
+class FakeSBusPoller(object):
+    """
+    Fake SBus poller, ready as long as there are datagrams to receive
+    """
+    def create(self):
+        return 0
+
+    def add(self, fd):
+        self.fd = fd
+        return 0
+
+    def wait(self, timeout=None):
+        if FakeSBus.datagrams:
+            return [self.fd]
+        time.sleep(timeout)
+        return []
+
+    def close(self):
+        pass
 
 
 class TestLogger(unittest.TestCase):
@@ -53,4 +124,289 @@ class TestLogger(unittest.TestCase):
 
 class TestDaemonFactory(unittest.TestCase):
     def setUp(self):
-        pass
+        self.factory = DaemonFactory('path', logging.getLogger('test'))
+
+    def test_process_start_daemon_stats(self):
+        self.factory.get_jvm_args = mock.MagicMock(return_value=[])
+        self.factory.spawn_subprocess = \
+            mock.MagicMock(return_value=(True, 'OK'))
+        self.factory.get_process_status_by_name = \
+            mock.MagicMock(side_effect=[(False, ''), (True, '')])
+
+        for _ in range(2):
+            status, _ = self.factory.process_start_daemon(
+                'java', 'path', 'storlet', 5, 'uds_path', 'DEBUG', 'abcdef')
+            self.assertTrue(status)
+        self.assertEqual(1, self.factory.spawn_subprocess.call_count)
+        self.assertEqual(1, self.factory.start_stats['cold'])
+        self.assertEqual(1, self.factory.start_stats['warm'])
+
+    def _spawn(self, script):
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'daemon.py')
+            with open(path, 'w') as f:
+                f.write(script)
+            popen = subprocess.Popen
+
+            def fake_popen(args, **kwargs):
+                if args == 'logger':
+                    # drain the stderr of the daemon
+                    return popen(['cat'], **kwargs)
+                return popen(args, **kwargs)
+
+            self.factory.storlet_name_to_pipe_name['storlet'] = 'uds_path'
+            with mock.patch('storlet_daemon_factory.daemon_factory.'
+                            'subprocess.Popen', fake_popen):
+                start = time.time()
+                ret = self.factory.spawn_subprocess(
+                    [sys.executable, path, 'storlet'])
+                return ret, time.time() - start
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_spawn_subprocess_ready(self):
+        (status, text), elapsed = self._spawn(
+            'import os, sys, time\n'
+            'time.sleep(0.3)\n'
+            'os.write(int(sys.argv[-1]), b"OK")\n'
+            'time.sleep(0.2)\n')
+        self.assertTrue(status)
+        self.assertEqual('OK', text)
+        # The daemon is usable as soon as it reports its readiness
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 1)
+        self.assertIn('storlet', self.factory.storlet_name_to_pid)
+        self.assertEqual(1, sum(self.factory.start_latency_histogram))
+        self.assertEqual(1, self.factory.start_latency_histogram[2])
+        os.waitpid(self.factory.storlet_name_to_pid['storlet'], 0)
+
+    def test_spawn_subprocess_close_fds(self):
+        # The daemon reports its readiness only if it does not inherit the
+        # file descriptors of the factory
+        read_fd, write_fd = os.pipe()
+        try:
+            (status, text), _ = self._spawn(
+                'import os, sys\n'
+                'try:\n'
+                '    os.fstat(%d)\n'
+                'except OSError:\n'
+                '    os.write(int(sys.argv[-1]), b"OK")\n' % write_fd)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+        self.assertTrue(status)
+        self.assertEqual('OK', text)
+        os.waitpid(self.factory.storlet_name_to_pid['storlet'], 0)
+
+    def test_spawn_subprocess_exits(self):
+        self.factory.wait_for_daemon_to_initialize = mock.MagicMock()
+        (status, text), elapsed = self._spawn('import sys\nsys.exit(1)\n')
+        self.assertFalse(status)
+        self.assertLess(elapsed, 1)
+        # No need to ping the daemon, which exited before getting ready
+        self.assertEqual(
+            0, self.factory.wait_for_daemon_to_initialize.call_count)
+        self.assertEqual(0, sum(self.factory.start_latency_histogram))
+
+    def test_spawn_subprocess_no_report(self):
+        self.factory.DAEMON_READY_TIMEOUT = 0.1
+        self.factory.wait_for_daemon_to_initialize = \
+            mock.MagicMock(return_value=True)
+        (status, text), _ = self._spawn('import time\ntime.sleep(0.5)\n')
+        self.assertTrue(status)
+        # Fall back on pinging the daemon
+        self.factory.wait_for_daemon_to_initialize.assert_called_once_with(
+            'storlet')
+        os.waitpid(self.factory.storlet_name_to_pid['storlet'], 0)
+
+    def test_factory_status(self):
+        for latency in (0.05, 0.3, 0.4, 100):
+            self.factory.record_start_latency(latency)
+        dtg = mock.MagicMock()
+        dtg.command = SBUS_CMD_DAEMON_STATUS
+        dtg.params = {}
+        status, text, _ = self.factory.dispatch_command(dtg, 'abcdef')
+        self.assertTrue(status)
+        histogram = json.loads(text)['start_latency_histogram']
+        self.assertEqual([[0.1, 1], [0.25, 0], [0.5, 2], [1, 0], [2, 0],
+                          [5, 0], [10, 0], [None, 1]], histogram)
+
+        # The status of a storlet daemon
+        dtg.params = {'storlet_name': 'storlet'}
+        status, text, _ = self.factory.dispatch_command(dtg, 'abcdef')
+        self.assertFalse(status)
+        self.assertIn('not found', text)
+
+    def _run_main_loop(self, datagrams):
+        FakeSBus.datagrams = list(datagrams)
+        replied = {}
+        log_and_report = self.factory.log_and_report
+
+        def fake_log_and_report(outfile, b_status, error_text,
+                                replies=None):
+            replied[outfile.fileno()] = time.time()
+            log_and_report(outfile, b_status, error_text, replies)
+
+        self.factory.log_and_report = fake_log_and_report
+        with mock.patch('storlet_daemon_factory.daemon_factory.SBus',
+                        FakeSBus), \
+            mock.patch('storlet_daemon_factory.daemon_factory.SBusPoller',
+                       FakeSBusPoller):
+            self.assertEqual(0, self.factory.main_loop('abcdef'))
+        return [replied[dtg.write_fd] - dtg.received for dtg in datagrams]
+
+    def _start_params(self, storlet_name):
+        return {'daemon_language': 'java', 'storlet_path': 'path',
+                'storlet_name': storlet_name, 'pool_size': 5,
+                'uds_path': 'uds_path', 'log_level': 'DEBUG'}
+
+    def test_main_loop_concurrent(self):
+        answered = threading.Event()
+        lock = threading.Lock()
+        pending = []
+        in_flight = []
+
+        def slow_spawn(pargs, env=None):
+            # The start lasts until the queries are answered, which never
+            # happens if they are blocked by the start
+            in_flight.append(answered.wait(5))
+            self.factory.storlet_name_to_pid[pargs[2]] = 1
+            return True, 'OK'
+
+        log_and_report = self.factory.log_and_report
+
+        def fake_log_and_report(outfile, b_status, error_text,
+                                replies=None):
+            log_and_report(outfile, b_status, error_text, replies)
+            with lock:
+                if outfile.fileno() in pending:
+                    pending.remove(outfile.fileno())
+                    if not pending:
+                        answered.set()
+
+        self.factory.get_jvm_args = \
+            lambda lang, path, name, *args: ['java', 'SDaemon', name]
+        self.factory.spawn_subprocess = slow_spawn
+        self.factory.get_process_status_by_pid = \
+            mock.MagicMock(return_value=(True, 'OK'))
+        self.factory.shutdown_process = mock.MagicMock()
+
+        start = FakeDatagram(SBUS_CMD_START_DAEMON,
+                             self._start_params('slow'))
+        queries = []
+        for i in range(20):
+            queries.append(FakeDatagram(SBUS_CMD_DAEMON_STATUS,
+                                        {'storlet_name': 'other'}))
+            queries.append(FakeDatagram(SBUS_CMD_PING))
+        halt = FakeDatagram(SBUS_CMD_HALT)
+        pending.extend(dtg.write_fd for dtg in queries)
+        self.factory.log_and_report = fake_log_and_report
+
+        self._run_main_loop([start] + queries + [halt])
+        # The queries were all answered while the start was in flight
+        self.assertEqual([True], in_flight)
+        self.assertTrue(start.get_reply().status)
+        self.assertTrue(halt.get_reply().status)
+        replies = [dtg.get_reply() for dtg in queries]
+        self.assertEqual([False, True] * 20,
+                         [reply.status for reply in replies])
+        # HALT is processed once the start is done, and stops the daemon
+        self.factory.shutdown_process.assert_called_once_with('slow')
+
+    def test_main_loop_serializes_storlet(self):
+        running = []
+        overlaps = []
+
+        def slow_spawn(pargs, env=None):
+            running.append(pargs[2])
+            overlaps.append(len(running))
+            time.sleep(0.1)
+            self.factory.storlet_name_to_pid[pargs[2]] = 1
+            running.remove(pargs[2])
+            return True, 'OK'
+
+        self.factory.get_jvm_args = \
+            lambda lang, path, name, *args: ['java', 'SDaemon', name]
+        self.factory.spawn_subprocess = slow_spawn
+        self.factory.get_process_status_by_pid = \
+            mock.MagicMock(return_value=(True, 'OK'))
+        self.factory.shutdown_process = mock.MagicMock()
+
+        datagrams = [FakeDatagram(SBUS_CMD_START_DAEMON,
+                                  self._start_params(name))
+                     for name in ('storlet1', 'storlet1', 'storlet2')]
+        datagrams.append(FakeDatagram(SBUS_CMD_HALT))
+        self._run_main_loop(datagrams)
+        # storlet1 was spawned once, concurrently with storlet2
+        self.assertEqual([1, 2], sorted(overlaps))
+        replies = [dtg.get_reply() for dtg in datagrams]
+        self.assertEqual([(True, 'OK'),
+                          (True, 'storlet1 is already running'),
+                          (True, 'OK')],
+                         [(reply.status, reply.message)
+                          for reply in replies[:3]])
+
+    def test_main_loop_command_error(self):
+        # A broken command is reported, and does not stop the factory
+        broken = FakeDatagram(SBUS_CMD_START_DAEMON, {})
+        halt = FakeDatagram(SBUS_CMD_HALT)
+        self._run_main_loop([broken, halt])
+        reply = broken.get_reply()
+        self.assertFalse(reply.status)
+        self.assertEqual('Failed to process command', reply.message)
+        # The framing to use is advertised in every reply
+        self.assertEqual(SBUS_FRAMING_JSON, reply.framing)
+        self.assertTrue(halt.get_reply().status)
+
+    def test_main_loop_batch(self):
+        self.factory.get_process_status_by_name = \
+            mock.MagicMock(side_effect=[(True, 'running'),
+                                        (False, 'not running')])
+        self.factory.shutdown_process = mock.MagicMock()
+        batch = FakeDatagram(SBUS_CMD_BATCH, {'commands': [
+            {'command': SBUS_CMD_DAEMON_STATUS,
+             'params': {'storlet_name': 'storlet1'}},
+            {'command': SBUS_CMD_DAEMON_STATUS,
+             'params': {'storlet_name': 'storlet2'}},
+            {'command': SBUS_CMD_PING},
+            {'command': SBUS_CMD_HALT},
+            {'command': SBUS_CMD_START_DAEMON, 'params': {}}]})
+        halt = FakeDatagram(SBUS_CMD_HALT)
+        self._run_main_loop([batch, halt])
+
+        reply = batch.get_reply()
+        self.assertFalse(reply.status)
+        self.assertEqual(
+            [(True, 'running'), (False, 'not running'), (True, 'OK'),
+             (False, 'SBUS_CMD_HALT can not be batched'),
+             (False, 'Failed to process command')],
+            [(sub.status, sub.message) for sub in reply.replies])
+        # HALT in the batch did not stop the main loop
+        self.assertTrue(halt.get_reply().status)
+
+    def test_main_loop_stop(self):
+        self.factory.POLL_INTERVAL = 0.01
+        self.factory.shutdown_all_processes = mock.MagicMock(
+            return_value=(True, 'OK'))
+        ping = FakeDatagram(SBUS_CMD_PING)
+        # Stop once idle, without any HALT command
+        timer = threading.Timer(0.1, self.factory.stop)
+        timer.start()
+        self._run_main_loop([ping])
+        timer.join()
+
+        self.assertTrue(ping.get_reply().status)
+        self.factory.shutdown_all_processes.assert_called_once_with()
+
+    def test_storlet_lock(self):
+        with self.factory.storlet_lock('storlet'):
+            acquired = []
+            thread = threading.Thread(
+                target=lambda: acquired.append(
+                    self.factory.storlet_locks['storlet'].acquire(False)))
+            thread.start()
+            thread.join()
+            self.assertEqual([False], acquired)
+        with self.factory.storlet_lock(None):
+            pass
@@ -0,0 +1,131 @@
+# Copyright (c) 2010-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import eventlet
+import unittest
+from storlet_gateway.common.coalescing import InvocationCoalescer, \
+    get_invocation_coalescer, _coalescers
+from storlet_gateway.common.exceptions import StorletConfigError
+
+
+class TestInvocationCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.coalescer = InvocationCoalescer(buffer_size=2,
+                                             detach_timeout=0.01)
+        self.invocations = 0
+
+    def invoke(self):
+        self.invocations += 1
+        # Let the concurrent requests come
+        eventlet.sleep(0)
+        return {'Key': 'Value'}, iter(['ab', 'cd', 'ef'])
+
+    def fallback(self):
+        return iter(['abcdef'])
+
+    def test_invoke(self):
+        leader = eventlet.spawn(self.coalescer.invoke, 'key', self.invoke,
+                                self.fallback)
+        eventlet.sleep(0)
+        user_metadata, data_iter = self.coalescer.invoke(
+            'key', self.invoke, self.fallback)
+        leader_metadata, leader_iter = leader.wait()
+
+        self.assertEqual(1, self.invocations)
+        self.assertEqual({'Key': 'Value'}, user_metadata)
+        self.assertEqual({'Key': 'Value'}, leader_metadata)
+        follower = eventlet.spawn(''.join, data_iter)
+        self.assertEqual('abcdef', ''.join(leader_iter))
+        self.assertEqual('abcdef', follower.wait())
+        self.assertEqual({'invocations': 1, 'coalesced': 1, 'detached': 0},
+                         self.coalescer.stats)
+        self.assertEqual({}, self.coalescer.invocations)
+
+        # The next request runs its own invocation
+        user_metadata, data_iter = self.coalescer.invoke(
+            'key', self.invoke, self.fallback)
+        self.assertEqual('abcdef', ''.join(data_iter))
+        self.assertEqual(2, self.invocations)
+
+    def test_invoke_detach(self):
+        leader = eventlet.spawn(self.coalescer.invoke, 'key', self.invoke,
+                                self.fallback)
+        eventlet.sleep(0)
+        _, data_iter = self.coalescer.invoke('key', self.invoke,
+                                             self.fallback)
+        _, leader_iter = leader.wait()
+
+        self.assertEqual('ab', next(data_iter))
+        # The slow request does not stall the others
+        self.assertEqual('abcdef', ''.join(leader_iter))
+        self.assertEqual(1, self.coalescer.stats['detached'])
+        # and goes on from its own invocation
+        self.assertEqual(['cdef'], list(data_iter))
+
+    def test_invoke_single_slow(self):
+        fallbacks = []
+
+        def fallback():
+            fallbacks.append(True)
+            return self.fallback()
+
+        _, data_iter = self.coalescer.invoke('key', self.invoke, fallback)
+        self.assertEqual('ab', next(data_iter))
+        # The slow request stalls no other one, so that the invocation
+        # waits for it rather than being run again
+        eventlet.sleep(0.05)
+        self.assertEqual(['cd', 'ef'], list(data_iter))
+        self.assertEqual([], fallbacks)
+        self.assertEqual(1, self.invocations)
+        self.assertEqual(0, self.coalescer.stats['detached'])
+
+    def test_invoke_failure(self):
+        def invoke():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            self.coalescer.invoke('key', invoke, self.fallback)
+        self.assertEqual({}, self.coalescer.invocations)
+
+        _, data_iter = self.coalescer.invoke('key', self.invoke,
+                                             self.fallback)
+        self.assertEqual('abcdef', ''.join(data_iter))
+
+
+class TestGetInvocationCoalescer(unittest.TestCase):
+
+    def tearDown(self):
+        _coalescers.clear()
+
+    def test_get_invocation_coalescer(self):
+        coalescer = get_invocation_coalescer({})
+        self.assertEqual((1048576, 1.0), (coalescer.buffer_size,
+                                          coalescer.detach_timeout))
+        self.assertIs(coalescer, get_invocation_coalescer({}))
+        self.assertIsNone(get_invocation_coalescer(
+            {'storlet_coalescing_buffer_size': '0'}))
+
+    def test_invalid(self):
+        with self.assertRaises(StorletConfigError):
+            get_invocation_coalescer(
+                {'storlet_coalescing_buffer_size': 'size'})
+        with self.assertRaises(StorletConfigError):
+            get_invocation_coalescer(
+                {'storlet_coalescing_detach_timeout': '0'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# Copyright (c) 2010-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import eventlet
+import mock
+import os
+import tempfile
+import unittest
+from storlet_gateway.common.exceptions import FileManagementError, \
+    StorletConfigError
+from storlet_gateway.common.log_upload import StorletLogUploader, \
+    _LogUpload, get_log_uploader
+
+
+class FakeFileManager(object):
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.logs = []
+
+    def put_log(self, name, fobj):
+        if self.failures:
+            self.failures -= 1
+            raise FileManagementError('Failed to put log file: %s' % name)
+        self.logs.append((name, fobj.read()))
+
+
+class TestStorletLogUploader(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.log_path = tempfile.mkstemp()
+        os.write(fd, 'first\nsecond\n')
+        os.close(fd)
+        self.logger = mock.MagicMock()
+
+    def tearDown(self):
+        os.unlink(self.log_path)
+
+    def test_submit(self):
+        uploader = StorletLogUploader(queue_size=2, retry_interval=0)
+        file_manager = FakeFileManager()
+        self.assertTrue(uploader.submit(file_manager, 'storlet.log',
+                                        self.log_path))
+        # Coalesced with the waiting upload
+        self.assertTrue(uploader.submit(file_manager, 'storlet.log',
+                                        self.log_path))
+        self.assertTrue(uploader.submit(file_manager, 'storlet-1.log',
+                                        self.log_path, offset=6))
+        # The queue is full
+        self.assertFalse(uploader.submit(file_manager, 'storlet-2.log',
+                                         self.log_path, logger=self.logger))
+        self.assertEqual(1, self.logger.warning.call_count)
+        # Nothing is uploaded by the request itself
+        self.assertEqual([], file_manager.logs)
+
+        eventlet.sleep(0)
+        self.assertEqual([('storlet.log', 'first\nsecond\n'),
+                          ('storlet-1.log', 'second\n')],
+                         file_manager.logs)
+        self.assertEqual({'queued': 2, 'coalesced': 1, 'dropped': 1,
+                          'uploaded': 2, 'failed': 0}, uploader.stats)
+        self.assertEqual({}, uploader.pending)
+
+    def test_upload_retries(self):
+        uploader = StorletLogUploader(retries=2, retry_interval=0.01)
+        failing_manager = FakeFileManager(failures=2)
+        file_manager = FakeFileManager()
+        uploader.submit(failing_manager, 'storlet.log', self.log_path)
+        uploader.submit(file_manager, 'storlet-1.log', self.log_path)
+        eventlet.sleep(0)
+        # The retries do not delay the other uploads
+        self.assertEqual([], failing_manager.logs)
+        self.assertEqual(1, len(file_manager.logs))
+
+        eventlet.sleep(0.1)
+        self.assertEqual(1, len(failing_manager.logs))
+        self.assertEqual(2, uploader.stats['uploaded'])
+        self.assertEqual({}, uploader.pending)
+
+        failing_manager = FakeFileManager(failures=3)
+        uploader.submit(failing_manager, 'storlet.log', self.log_path,
+                        logger=self.logger)
+        eventlet.sleep(0.1)
+        self.assertEqual([], failing_manager.logs)
+        self.assertEqual(1, uploader.stats['failed'])
+        self.assertEqual(1, self.logger.error.call_count)
+
+    def test_retry(self):
+        uploader = StorletLogUploader(queue_size=1)
+        file_manager = FakeFileManager()
+        uploader.submit(file_manager, 'storlet.log', self.log_path)
+        # The retry is coalesced with the waiting upload of the same log
+        uploader._retry(_LogUpload(FakeFileManager(), 'storlet.log',
+                                   self.log_path, 0, self.logger))
+        self.assertIs(file_manager, uploader.pending[
+            (self.log_path, 'storlet.log')].file_manager)
+        self.assertEqual(1, uploader.stats['coalesced'])
+
+        # The queue is full
+        uploader._retry(_LogUpload(FakeFileManager(), 'storlet-1.log',
+                                   self.log_path, 0, self.logger))
+        self.assertEqual(1, uploader.stats['failed'])
+        self.assertEqual(1, self.logger.error.call_count)
+
+        eventlet.sleep(0)
+        self.assertEqual(1, len(file_manager.logs))
+        self.assertEqual({}, uploader.pending)
+
+    def test_get_log_uploader(self):
+        uploader = get_log_uploader({})
+        self.assertEqual(3, uploader.retries)
+        self.assertIs(uploader, get_log_uploader({}))
+        self.assertIsNot(uploader, get_log_uploader(
+            {'storlet_log_upload_retries': '1'}))
+
+        with self.assertRaises(StorletConfigError):
+            get_log_uploader({'storlet_log_upload_queue_size': '0'})
+        with self.assertRaises(StorletConfigError):
+            get_log_uploader({'storlet_log_upload_retries': 'a'})
+
+
+if __name__ == '__main__':
+    unittest.main()
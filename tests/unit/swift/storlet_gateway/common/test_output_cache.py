@@ -0,0 +1,166 @@
+# Copyright (c) 2010-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from storlet_gateway.common.exceptions import StorletConfigError
+from storlet_gateway.common.output_cache import StorletOutputCache, \
+    get_output_cache, output_cache_key, _output_caches
+
+
+class TestOutputCacheKey(unittest.TestCase):
+
+    def test_output_cache_key(self):
+        key = output_cache_key('a/c/o', '"etag"', '1.0', 'storlet-1.0.jar',
+                               '1.0', {'k1': 'v1', 'k2': 'v2'})
+        # The ETag quotes and the parameter order do not matter
+        self.assertEqual(key, output_cache_key(
+            'a/c/o', 'etag', '1.0', 'storlet-1.0.jar', '1.0',
+            dict([('k2', 'v2'), ('k1', 'v1')])))
+        self.assertNotEqual(key, output_cache_key(
+            'a/c/o', 'etag', '2.0', 'storlet-1.0.jar', '1.0',
+            {'k1': 'v1', 'k2': 'v2'}))
+        self.assertNotEqual(key, output_cache_key(
+            'a/c/o', 'etag', '1.0', 'storlet-1.0.jar', '2.0',
+            {'k1': 'v1', 'k2': 'v2'}))
+        self.assertNotEqual(key, output_cache_key(
+            'a/c/o', 'etag', '1.0', 'storlet-1.0.jar', '1.0',
+            {'k1': 'v1', 'k2': 'v2'}, 'bytes=1-3'))
+
+
+class TestStorletOutputCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = StorletOutputCache(self.cache_dir, 10, chunk_size=2)
+        self._wait_scan(self.cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_tee_and_get(self):
+        self.assertIsNone(self.cache.get('key'))
+        data = ''.join(self.cache.tee('key', {'Key': 'Value'},
+                                      iter(['abc', 'def'])))
+        self.assertEqual('abcdef', data)
+
+        user_metadata, data_iter = self.cache.get('key')
+        self.assertEqual({'Key': 'Value'}, user_metadata)
+        self.assertEqual(['ab', 'cd', 'ef'], list(data_iter))
+        self.assertEqual({'hits': 1, 'misses': 1, 'stored': 1, 'evicted': 0},
+                         self.cache.stats)
+        self.assertEqual(6, self.cache.size)
+
+    def test_tee_not_complete(self):
+        data_iter = self.cache.tee('key', {}, iter(['abc', 'def']))
+        self.assertEqual('abc', next(data_iter))
+        # The client went away
+        data_iter.close()
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+        # Outputs larger than the cache are not kept
+        self.assertEqual(['abcdef', 'ghijkl'], list(self.cache.tee(
+            'key', {}, iter(['abcdef', 'ghijkl']))))
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_evict(self):
+        list(self.cache.tee('key1', {}, iter(['abcd'])))
+        list(self.cache.tee('key2', {}, iter(['abcd'])))
+        self.cache.get('key1')
+        list(self.cache.tee('key3', {}, iter(['abcd'])))
+        # key2 is the least recently used one
+        self.assertIsNone(self.cache.get('key2'))
+        self.assertIsNotNone(self.cache.get('key1'))
+        self.assertIsNotNone(self.cache.get('key3'))
+        self.assertEqual(8, self.cache.size)
+        self.assertEqual(1, self.cache.stats['evicted'])
+
+    def _wait_scan(self, cache):
+        if cache._scanner is not None:
+            cache._scanner.wait()
+
+    def _write(self, name, data, mtime):
+        path = os.path.join(self.cache_dir, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        os.utime(path, (mtime, mtime))
+
+    def test_scan(self):
+        now = time.time()
+        for key, mtime in (('key1', now - 30), ('key2', now - 20),
+                           ('key3', now - 10)):
+            self._write(key + '.meta', '{}', mtime)
+            self._write(key + '.data', 'abcd', mtime)
+        # Left by dead writers, or being written
+        self._write('.tmpold', 'abcd', now - 7200)
+        self._write('.tmpnew', 'abcd', now)
+        self._write('key4.meta', '{}', now - 7200)
+
+        # The outputs on disk are accounted for at start, and the least
+        # recently used one is evicted
+        cache = StorletOutputCache(self.cache_dir, 10)
+        self.assertEqual(0, cache.size)
+        self._wait_scan(cache)
+        self.assertEqual(8, cache.size)
+        self.assertEqual(1, cache.stats['evicted'])
+        self.assertEqual(['.tmpnew', 'key2.data', 'key2.meta', 'key3.data',
+                          'key3.meta'], sorted(os.listdir(self.cache_dir)))
+
+    def test_rescan(self):
+        self.cache.rescan_interval = 0
+        list(self.cache.tee('key1', {}, iter(['abcd'])))
+        self._wait_scan(self.cache)
+        # Stored by another process
+        self._write('key2.meta', '{}', time.time())
+        self._write('key2.data', 'abcd', time.time())
+        # The scan runs after storing, in the background
+        list(self.cache.tee('key3', {}, iter(['abcd'])))
+        self.assertEqual(8, self.cache.size)
+        self._wait_scan(self.cache)
+        self.assertEqual(8, self.cache.size)
+        self.assertIsNone(self.cache.get('key1'))
+        self.assertIsNotNone(self.cache.get('key3'))
+
+
+class TestGetOutputCache(unittest.TestCase):
+
+    def tearDown(self):
+        _output_caches.clear()
+
+    def test_get_output_cache(self):
+        self.assertIsNone(get_output_cache({}))
+        conf = {'storlet_output_cache_dir': '/tmp/cache',
+                'storlet_output_cache_size': '100'}
+        cache = get_output_cache(conf)
+        self.assertEqual(('/tmp/cache', 100),
+                         (cache.cache_dir, cache.max_size))
+        self.assertIs(cache, get_output_cache(conf))
+
+    def test_invalid(self):
+        with self.assertRaises(StorletConfigError):
+            get_output_cache({'storlet_output_cache_dir': '/tmp/cache',
+                              'storlet_output_cache_size': 'size'})
+        with self.assertRaises(StorletConfigError):
+            get_output_cache({'storlet_output_cache_dir': '/tmp/cache',
+                              'storlet_output_cache_size': '0'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,7 +18,9 @@ import mock
 import os
 import tempfile
 import unittest
-from storlet_gateway.common.stob import FileDescriptorIterator
+import json
+from storlet_gateway.common.stob import FileDescriptorIterator, \
+    StorletParams, StorletRequest
 
 
 class TestFileDescriptorIterator(unittest.TestCase):
@@ -113,3 +115,107 @@ class TestFileDescriptorIterator(unittest.TestCase):
             self.assertEqual(
                 self.iter_like.readlines(7),
                 [b'aaaa\n', b'bb'])
+
+    def test_readline_without_trailing_newline(self):
+        os.ftruncate(self.fd, len(self.content) - 1)
+        with self._mock_select():
+            self.assertEqual(
+                self.iter_like.readlines(),
+                [b'aaaa\n', b'bbbb\n', b'cccc'])
+
+
+class TestFileDescriptorIteratorPipe(unittest.TestCase):
+
+    def setUp(self):
+        self.read_fd, self.write_fd = os.pipe()
+        # Use a small chunk size, so that lines span several reads
+        self.iter_like = FileDescriptorIterator(self.read_fd, 10, None,
+                                                chunk_size=8)
+
+    def tearDown(self):
+        self.iter_like.close()
+        if self.write_fd is not None:
+            os.close(self.write_fd)
+
+    def _write(self, data, close=True):
+        os.write(self.write_fd, data)
+        if close:
+            os.close(self.write_fd)
+            self.write_fd = None
+
+    def test_iter(self):
+        self._write(b'x' * 20)
+        self.assertEqual([b'x' * 8, b'x' * 8, b'x' * 4],
+                         list(self.iter_like))
+
+    def test_readline_long_lines(self):
+        lines = [b'a' * 30 + b'\n', b'b\n', b'\n', b'c' * 17 + b'\n',
+                 b'd' * 5]
+        self._write(b''.join(lines))
+        self.assertEqual(lines, self.iter_like.readlines())
+        with self.assertRaises(StopIteration):
+            self.iter_like.readline()
+
+    def test_readline_and_read(self):
+        self._write(b'aaaa\nbbbbbbbbbbbb\ncc')
+        self.assertEqual(b'aaaa\n', self.iter_like.readline())
+        # The data read ahead by readline is returned first
+        self.assertEqual(b'bbb', self.iter_like.read(3))
+        self.assertEqual(b'bbbbbbbbb\n', self.iter_like.readline())
+        self.assertEqual(b'cc', self.iter_like.read())
+        with self.assertRaises(StopIteration):
+            self.iter_like.read()
+
+    def test_readline_size(self):
+        self._write(b'a' * 20 + b'\nb\n')
+        self.assertEqual(b'a' * 12, self.iter_like.readline(12))
+        self.assertEqual(b'a' * 8 + b'\n', self.iter_like.readline(12))
+        self.assertEqual(b'b\n', self.iter_like.readline(12))
+
+    def test_buffer_reused(self):
+        self._write(b'line\n' * 100)
+        buf = self.iter_like._buf
+        self.assertEqual([b'line\n'] * 100, self.iter_like.readlines())
+        # Lines shorter than the chunk size do not need a larger buffer
+        self.assertIs(buf, self.iter_like._buf)
+        self.assertEqual(8, len(self.iter_like._buf))
+
+    def test_close(self):
+        self._write(b'data')
+        self.iter_like.close()
+        self.assertTrue(self.iter_like.closed)
+        with self.assertRaises(ValueError):
+            self.iter_like.readline()
+        with self.assertRaises(OSError):
+            os.fstat(self.read_fd)
+
+
+class TestStorletParams(unittest.TestCase):
+
+    def test_copy_on_write(self):
+        params = {'key1': 'value1', 'key2': 'value2'}
+        sparams = StorletParams(params)
+        # Nothing is copied until the parameters change
+        self.assertIs(params, sparams.as_dict())
+        self.assertEqual(params, sparams)
+        self.assertEqual('value1', sparams['key1'])
+        self.assertIn('key2', sparams)
+        self.assertEqual(2, len(sparams))
+
+        sparams['key3'] = 'value3'
+        del sparams['key1']
+        sparams.update({'key4': 'value4'})
+        self.assertEqual({'key2': 'value2', 'key3': 'value3',
+                          'key4': 'value4'}, sparams)
+        # The given parameters are left unchanged
+        self.assertEqual({'key1': 'value1', 'key2': 'value2'}, params)
+        self.assertIsNot(params, sparams.as_dict())
+        self.assertEqual(sparams, json.loads(json.dumps(sparams.as_dict())))
+
+    def test_request(self):
+        params = {'key': 'value'}
+        sreq = StorletRequest('Storlet-1.0.jar', params, {}, iter([]))
+        sreq.params['storlet_execution_path'] = 'path'
+        self.assertEqual({'key': 'value'}, params)
+        self.assertEqual({}, StorletRequest('Storlet-1.0.jar', None, {},
+                                            iter([])).params)
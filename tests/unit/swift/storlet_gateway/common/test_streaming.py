@@ -0,0 +1,178 @@
+# Copyright (c) 2010-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl
+import mock
+import os
+import tempfile
+import unittest
+from six import StringIO
+from storlet_gateway.common.exceptions import StorletConfigError
+from storlet_gateway.common.stob import FileDescriptorIterator
+from storlet_gateway.common.streaming import AdaptiveChunkSize, \
+    FixedChunkSize, StreamingPolicy, F_GETPIPE_SZ, set_pipe_size, \
+    _MemoryMonitor
+
+
+class FakeMonitor(object):
+    def __init__(self, ratio=1.0):
+        self.ratio = ratio
+
+    def available_ratio(self):
+        return self.ratio
+
+
+class TestStreamingPolicy(unittest.TestCase):
+
+    def test_default(self):
+        policy = StreamingPolicy({})
+        self.assertEqual('fixed', policy.mode)
+        self.assertEqual(65536, policy.chunk_size)
+        self.assertEqual(0, policy.pipe_size)
+        chunk_policy = policy.create_chunk_policy()
+        self.assertIsInstance(chunk_policy, FixedChunkSize)
+        self.assertEqual(65536, chunk_policy.chunk_size)
+
+    def test_adaptive(self):
+        policy = StreamingPolicy({'storlet_chunk_mode': 'adaptive',
+                                  'storlet_chunk_size': '4096',
+                                  'storlet_max_chunk_size': '16384',
+                                  'storlet_low_memory_ratio': '0.2'})
+        chunk_policy = policy.create_chunk_policy()
+        self.assertIsInstance(chunk_policy, AdaptiveChunkSize)
+        self.assertEqual(4096, chunk_policy.min_chunk_size)
+        self.assertEqual(16384, chunk_policy.max_chunk_size)
+        self.assertEqual(0.2, chunk_policy.low_memory_ratio)
+
+        # max chunk size is at least the chunk size
+        policy = StreamingPolicy({'storlet_chunk_mode': 'adaptive',
+                                  'storlet_chunk_size': '4096',
+                                  'storlet_max_chunk_size': '1024'})
+        self.assertEqual(4096, policy.max_chunk_size)
+
+    def test_invalid(self):
+        for conf in ({'storlet_chunk_mode': 'unknown'},
+                     {'storlet_chunk_size': 'foo'},
+                     {'storlet_chunk_size': '0'},
+                     {'storlet_pipe_size': 'foo'}):
+            with self.assertRaises(StorletConfigError):
+                StreamingPolicy(conf)
+
+    def test_iter_reader(self):
+        policy = StreamingPolicy({'storlet_chunk_size': '3'})
+        sio = StringIO('abcdefgh')
+        self.assertEqual(['abc', 'def', 'gh'],
+                         list(policy.iter_reader(sio.read)))
+
+        policy = StreamingPolicy({'storlet_chunk_mode': 'adaptive',
+                                  'storlet_chunk_size': '2',
+                                  'storlet_max_chunk_size': '8'})
+        sio = StringIO('a' * 30)
+        self.assertEqual([2, 4, 8, 8, 8],
+                         [len(chunk) for chunk in
+                          policy.iter_reader(sio.read)])
+
+    def test_apply_pipe_size(self):
+        read_fd, write_fd = os.pipe()
+        try:
+            StreamingPolicy({}).apply_pipe_size(write_fd)
+            default_size = fcntl.fcntl(write_fd, F_GETPIPE_SZ)
+
+            StreamingPolicy({'storlet_pipe_size': str(default_size * 2)}).\
+                apply_pipe_size(write_fd)
+            self.assertEqual(default_size * 2,
+                             fcntl.fcntl(read_fd, F_GETPIPE_SZ))
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def test_set_pipe_size_failure(self):
+        with tempfile.TemporaryFile() as f:
+            self.assertFalse(set_pipe_size(f.fileno(), 1024 * 1024))
+
+
+class TestAdaptiveChunkSize(unittest.TestCase):
+
+    def test_update(self):
+        monitor = FakeMonitor()
+        policy = AdaptiveChunkSize(1024, 8192, 0.1, monitor)
+        self.assertEqual(1024, policy.chunk_size)
+
+        # grows while the reads return full chunks
+        policy.update(1024, 1024)
+        self.assertEqual(2048, policy.chunk_size)
+        policy.update(2048, 2048)
+        policy.update(4096, 4096)
+        policy.update(8192, 8192)
+        self.assertEqual(8192, policy.chunk_size)
+
+        # stays while the reads return more than half a chunk
+        policy.update(8192, 4096)
+        self.assertEqual(8192, policy.chunk_size)
+
+        # shrinks when the reads return less than half a chunk
+        policy.update(8192, 100)
+        self.assertEqual(4096, policy.chunk_size)
+
+        # gets back to the minimum under memory pressure
+        monitor.ratio = 0.05
+        policy.update(4096, 4096)
+        self.assertEqual(1024, policy.chunk_size)
+
+    def test_file_descriptor_iterator(self):
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, b'a' * 60)
+        os.close(write_fd)
+        policy = AdaptiveChunkSize(4, 32, 0.1, FakeMonitor())
+        iter_like = FileDescriptorIterator(read_fd, 10, None,
+                                           chunk_policy=policy)
+        self.assertEqual([4, 8, 16, 32], [len(chunk) for chunk in iter_like])
+        # explicit sizes do not change the chunk size
+        self.assertEqual(32, policy.chunk_size)
+
+
+class TestMemoryMonitor(unittest.TestCase):
+
+    def test_available_ratio(self):
+        with tempfile.NamedTemporaryFile() as meminfo:
+            meminfo.write('MemTotal:        1000 kB\n'
+                          'MemFree:          100 kB\n'
+                          'MemAvailable:     250 kB\n')
+            meminfo.flush()
+            monitor = _MemoryMonitor(10, meminfo.name)
+            with mock.patch('storlet_gateway.common.streaming.time.time',
+                            return_value=100):
+                self.assertEqual(0.25, monitor.available_ratio())
+
+            # The file is read once per interval
+            meminfo.seek(0)
+            meminfo.write('MemTotal:        1000 kB\n'
+                          'MemFree:          100 kB\n'
+                          'MemAvailable:     500 kB\n')
+            meminfo.flush()
+            with mock.patch('storlet_gateway.common.streaming.time.time',
+                            return_value=105):
+                self.assertEqual(0.25, monitor.available_ratio())
+            with mock.patch('storlet_gateway.common.streaming.time.time',
+                            return_value=110):
+                self.assertEqual(0.5, monitor.available_ratio())
+
+    def test_available_ratio_unknown(self):
+        monitor = _MemoryMonitor(10, '/nonexistent')
+        self.assertEqual(1.0, monitor.available_ratio())
+
+
+if __name__ == '__main__':
+    unittest.main()
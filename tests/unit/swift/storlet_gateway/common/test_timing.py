@@ -0,0 +1,134 @@
+# Copyright (c) 2010-2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import unittest
+from storlet_gateway.common.exceptions import StorletConfigError
+from storlet_gateway.common.timing import InvocationTimer, \
+    StatsdTimingEmitter, TimingHistogram, TimingPolicy, timing_histogram
+
+
+class FakeEmitter(object):
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, scope, storlet, phase, seconds):
+        self.emitted.append((scope, storlet, phase, seconds))
+
+
+class TestInvocationTimer(unittest.TestCase):
+
+    def test_record(self):
+        emitter = FakeEmitter()
+        timer = InvocationTimer('scope', 'Storlet', [emitter])
+        timer.record('invoke', 0.5)
+        timer.record('invoke', 0.25)
+        timer.record('update_container', 0.001)
+        self.assertEqual({'invoke': 0.75, 'update_container': 0.001},
+                         timer.totals)
+        self.assertEqual(('scope', 'Storlet', 'invoke', 0.25),
+                         emitter.emitted[1])
+
+        timer.finish()
+        self.assertEqual('total', emitter.emitted[-1][2])
+        # The phases are reported in their order, and total last
+        header = timer.format_header()
+        self.assertTrue(header.startswith('update_container=1.000, '
+                                          'invoke=750.000, total='))
+
+    def test_phase(self):
+        emitter = FakeEmitter()
+        timer = InvocationTimer('scope', 'Storlet', [emitter])
+        with timer.phase('invoke'):
+            pass
+        # Failed phases are recorded as well
+        with self.assertRaises(ValueError):
+            with timer.phase('read_metadata'):
+                raise ValueError()
+        self.assertEqual(['invoke', 'read_metadata'],
+                         [emitted[2] for emitted in emitter.emitted])
+
+
+class TestTimingHistogram(unittest.TestCase):
+
+    def test_emit(self):
+        histogram = TimingHistogram([0.1, 1])
+        histogram.emit('scope', 'Storlet', 'invoke', 0.05)
+        histogram.emit('scope', 'Storlet', 'invoke', 0.1)
+        histogram.emit('scope', 'Storlet', 'invoke', 0.5)
+        histogram.emit('scope', 'Storlet', 'invoke', 3)
+        histogram.emit('scope', 'Storlet', 'first_byte', 3)
+
+        exported = histogram.export()
+        self.assertEqual(2, len(exported))
+        invoke = exported[('scope', 'Storlet', 'invoke')]
+        self.assertEqual([2, 1, 1], invoke['counts'])
+        self.assertEqual(4, invoke['count'])
+        self.assertAlmostEqual(3.65, invoke['sum'])
+
+        histogram.reset()
+        self.assertEqual({}, histogram.export())
+
+
+class TestStatsdTimingEmitter(unittest.TestCase):
+
+    def test_emit(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind(('127.0.0.1', 0))
+            sock.settimeout(5)
+            emitter = StatsdTimingEmitter('127.0.0.1', sock.getsockname()[1])
+            emitter.emit('scope', 'org.openstack.Storlet', 'invoke', 0.0125)
+            self.assertEqual(
+                'storlets.scope.org_openstack_Storlet.invoke:12.500|ms',
+                sock.recv(1024))
+        finally:
+            sock.close()
+
+
+class TestTimingPolicy(unittest.TestCase):
+
+    def test_default(self):
+        policy = TimingPolicy({})
+        self.assertEqual([], policy.emitters)
+        timer = policy.create_timer('scope', 'Storlet')
+        self.assertEqual(('scope', 'Storlet'), (timer.scope, timer.storlet))
+
+    def test_emitters(self):
+        conf = {'storlet_timing_emitters': 'histogram, statsd',
+                'storlet_timing_statsd_host': '127.0.0.1',
+                'storlet_timing_statsd_port': '8126',
+                'storlet_timing_statsd_prefix': 'test'}
+        policy = TimingPolicy(conf)
+        self.assertIs(timing_histogram, policy.emitters[0])
+        statsd = policy.emitters[1]
+        self.assertEqual(('127.0.0.1', 8126), statsd.addr)
+        self.assertEqual('test', statsd.prefix)
+        # The statsd emitters are shared
+        self.assertIs(statsd, TimingPolicy(conf).emitters[1])
+
+    def test_invalid(self):
+        with self.assertRaises(StorletConfigError):
+            TimingPolicy({'storlet_timing_emitters': 'unknown'})
+        with self.assertRaises(StorletConfigError):
+            TimingPolicy({'storlet_timing_emitters': 'statsd'})
+        with self.assertRaises(StorletConfigError):
+            TimingPolicy({'storlet_timing_emitters': 'statsd',
+                          'storlet_timing_statsd_host': 'localhost',
+                          'storlet_timing_statsd_port': 'port'})
+
+
+if __name__ == '__main__':
+    unittest.main()
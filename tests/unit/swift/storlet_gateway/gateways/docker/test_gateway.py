@@ -14,13 +14,21 @@
 # limitations under the License.
 
 from contextlib import contextmanager
+import eventlet
+import mock
+import os
+import shutil
+import tempfile
+import time
 import unittest
 from six import StringIO
 from swift.common.swob import HTTPException, Request
 from tests.unit.swift import FakeLogger
 from tests.unit.swift.storlet_middleware import FakeApp
+from storlet_gateway.common.exceptions import StorletRuntimeException, \
+    StorletSendError
 from storlet_gateway.gateways.docker.gateway import DockerStorletRequest, \
-    StorletGatewayDocker
+    StorletGatewayDocker, StorletCacheManifest, storlet_cache_manifest
 
 
 class TestDockerStorletRequest(unittest.TestCase):
@@ -248,5 +256,343 @@ class TestStorletGatewayDocker(unittest.TestCase):
         with self.assertRaises(ValueError):
             StorletGatewayDocker.validate_dependency_registration(params, obj)
 
+
+class TestStorletGatewayDockerCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sconf = {
+            'cache_dir': os.path.join(self.tmpdir, 'cache', 'scopes'),
+            'storlets_dir': os.path.join(self.tmpdir, 'storlets', 'scopes'),
+            'storlet_timeout': '9',
+        }
+        self.logger = FakeLogger()
+        self.scope = 'scope'
+        self.gateway = StorletGatewayDocker(self.sconf, self.logger,
+                                            self.scope)
+        storlet_cache_manifest.invalidate(self.scope)
+
+    def tearDown(self):
+        storlet_cache_manifest.invalidate(self.scope)
+        shutil.rmtree(self.tmpdir)
+
+    def _create_sreq(self, storlet_body='storlet', timestamp='1'):
+        file_manager = mock.MagicMock()
+        file_manager.get_storlet.side_effect = \
+            lambda name: (iter([storlet_body]), None)
+        file_manager.get_dependency.side_effect = \
+            lambda name: (iter(['dependency']), '0755')
+        options = {'storlet_main': 'org.openstack.storlet.Storlet',
+                   'storlet_dependency': 'dep1,dep2',
+                   'storlet_x_timestamp': timestamp,
+                   'storlet_content_length': str(len(storlet_body)),
+                   'file_manager': file_manager}
+        return DockerStorletRequest('storlet-1.0.jar', {}, {}, iter([]),
+                                    options=options)
+
+    @contextmanager
+    def _count_fs_calls(self):
+        calls = []
+        nested = []
+
+        def wrap(func):
+            # os.path functions use os.stat, which should not be counted
+            # twice
+            def wrapped(*args, **kwargs):
+                if not nested:
+                    calls.append(func.__name__)
+                nested.append(func)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    nested.pop()
+            return wrapped
+
+        module = 'storlet_gateway.gateways.docker.gateway.os'
+        with mock.patch(module + '.stat', wrap(os.stat)), \
+            mock.patch(module + '.makedirs', wrap(os.makedirs)), \
+            mock.patch(module + '.path.exists', wrap(os.path.exists)), \
+            mock.patch(module + '.path.isfile', wrap(os.path.isfile)):
+            yield calls
+
+    def test_update_docker_container_from_cache(self):
+        sreq = self._create_sreq()
+        self.assertTrue(self.gateway.update_docker_container_from_cache(sreq))
+        self.assertEqual(1, sreq.file_manager.get_storlet.call_count)
+        self.assertEqual(2, sreq.file_manager.get_dependency.call_count)
+        docker_path = self.gateway.paths.host_storlet(sreq.storlet_main)
+        for obj_name in ['storlet-1.0.jar', 'dep1', 'dep2']:
+            self.assertTrue(
+                os.path.isfile(os.path.join(docker_path, obj_name)))
+
+        # Everything is deployed, and no file system check is needed
+        sreq = self._create_sreq()
+        with self._count_fs_calls() as calls:
+            self.assertFalse(
+                self.gateway.update_docker_container_from_cache(sreq))
+        self.assertEqual([], calls)
+        self.assertEqual(0, sreq.file_manager.get_storlet.call_count)
+
+        # Without the manifest, the same request checks the file system
+        storlet_cache_manifest.invalidate(self.scope)
+        sreq = self._create_sreq()
+        with self._count_fs_calls() as calls:
+            self.assertFalse(
+                self.gateway.update_docker_container_from_cache(sreq))
+        # 1 check for the scope + 7 checks for the storlet
+        # + 6 checks for each dependency
+        self.assertEqual(20, len(calls))
+
+    def test_update_docker_container_from_cache_new_version(self):
+        sreq = self._create_sreq()
+        self.gateway.update_docker_container_from_cache(sreq)
+
+        # A new version of the storlet is uploaded
+        sreq = self._create_sreq('new storlet', '%f' % (time.time() + 10))
+        with self._count_fs_calls() as calls:
+            self.assertTrue(
+                self.gateway.update_docker_container_from_cache(sreq))
+        self.assertNotEqual([], calls)
+        self.assertEqual(1, sreq.file_manager.get_storlet.call_count)
+        self.assertEqual(0, sreq.file_manager.get_dependency.call_count)
+        docker_path = self.gateway.paths.host_storlet(sreq.storlet_main)
+        with open(os.path.join(docker_path, 'storlet-1.0.jar')) as f:
+            self.assertEqual('new storlet', f.read())
+
+    def test_update_docker_container_from_cache_single_flight(self):
+        sreq = self._create_sreq()
+        self.gateway.update_docker_container_from_cache(sreq)
+
+        # Many requests find the storlet outdated at the same time
+        sreqs = [self._create_sreq('new storlet', '%f' % time.time())
+                 for _ in range(5)]
+        for sreq in sreqs:
+            sreq.file_manager.get_storlet.side_effect = \
+                self._slow_get_storlet('new storlet')
+
+        pool = eventlet.GreenPool()
+        for sreq in sreqs:
+            pool.spawn(self.gateway.update_docker_container_from_cache, sreq)
+        pool.waitall()
+
+        self.assertEqual(
+            1, sum(sreq.file_manager.get_storlet.call_count
+                   for sreq in sreqs))
+        docker_path = self.gateway.paths.host_storlet(sreq.storlet_main)
+        with open(os.path.join(docker_path, 'storlet-1.0.jar')) as f:
+            self.assertEqual('new storlet', f.read())
+
+    def _slow_get_storlet(self, body):
+        def get_storlet(name):
+            def data_iter():
+                eventlet.sleep(0.01)
+                yield body
+            return data_iter(), None
+        return get_storlet
+
+    def test_bring_from_cache_failure(self):
+        sreq = self._create_sreq()
+
+        def broken_iter():
+            yield 'stor'
+            raise IOError()
+
+        sreq.file_manager.get_storlet.side_effect = \
+            lambda name: (broken_iter(), None)
+        with self.assertRaises(IOError):
+            self.gateway.bring_from_cache(sreq.storlet_id, sreq, True)
+        # Neither the object nor any temporary file was left in the cache
+        self.assertEqual(
+            [], os.listdir(self.gateway.paths.get_host_storlet_cache_dir()))
+
+    def test_bring_from_cache_deploy(self):
+        sreq = self._create_sreq()
+        self.gateway.update_docker_container_from_cache(sreq)
+        cache_path = os.path.join(
+            self.gateway.paths.get_host_dependency_cache_dir(), 'dep1')
+        docker_path = os.path.join(
+            self.gateway.paths.host_storlet(sreq.storlet_main), 'dep1')
+        # The object is linked into the container
+        self.assertEqual(os.stat(cache_path).st_ino,
+                         os.stat(docker_path).st_ino)
+        self.assertEqual(0o755, os.stat(docker_path).st_mode & 0o777)
+
+        # The object is copied when it can not be linked
+        os.unlink(docker_path)
+        storlet_cache_manifest.invalidate(self.scope)
+        with mock.patch('storlet_gateway.gateways.docker.gateway.os.link',
+                        side_effect=OSError()):
+            self.assertTrue(
+                self.gateway.update_docker_container_from_cache(sreq))
+        self.assertNotEqual(os.stat(cache_path).st_ino,
+                            os.stat(docker_path).st_ino)
+        self.assertEqual(0o755, os.stat(docker_path).st_mode & 0o777)
+        with open(docker_path) as f:
+            self.assertEqual('dependency', f.read())
+        self.assertEqual(['dep1', 'dep2', 'storlet-1.0.jar'],
+                         sorted(os.listdir(os.path.dirname(docker_path))))
+
+
+class TestStorletGatewayDockerLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.sconf = {'storlet_timeout': '9'}
+        self.gateway = StorletGatewayDocker(self.sconf, FakeLogger(), 'scope')
+        self.gateway.log_uploader = mock.MagicMock()
+        options = {'storlet_main': 'org.openstack.storlet.Storlet',
+                   'storlet_dependency': '',
+                   'generate_log': True,
+                   'file_manager': mock.MagicMock()}
+        self.sreq = DockerStorletRequest('storlet-1.0.jar', {}, {}, iter([]),
+                                         options=options)
+
+    def test_upload_storlet_logs(self):
+        self.gateway._upload_storlet_logs('/path/to/log', self.sreq, 10)
+        self.gateway.log_uploader.submit.assert_called_once_with(
+            self.sreq.file_manager, 'storlet.log', '/path/to/log', 0,
+            self.gateway.logger)
+
+        self.sreq.generate_log = False
+        self.gateway._upload_storlet_logs('/path/to/log', self.sreq, 10)
+        self.assertEqual(1, self.gateway.log_uploader.submit.call_count)
+
+    def test_get_sandbox(self):
+        self.gateway.sconf['docker_repo'] = 'localhost:5001'
+        sandbox = self.gateway._get_sandbox()
+        # The sandbox is used by all the invocations of the gateway
+        self.assertIs(sandbox, self.gateway._get_sandbox())
+        self.assertEqual('scope', sandbox.scope)
+
+    def test_upload_storlet_logs_per_invocation(self):
+        self.gateway.log_per_invocation = True
+        self.gateway._upload_storlet_logs('/path/to/log', self.sreq, 10)
+        args = self.gateway.log_uploader.submit.call_args[0]
+        self.assertTrue(args[1].startswith('storlet-'))
+        self.assertNotEqual('storlet.log', args[1])
+        self.assertEqual(10, args[3])
+
+
+class TestStorletGatewayDockerInvocation(unittest.TestCase):
+
+    def setUp(self):
+        self.gateway = StorletGatewayDocker({'storlet_timeout': '9'},
+                                            FakeLogger(), 'scope')
+        options = {'storlet_main': 'org.openstack.storlet.Storlet',
+                   'storlet_dependency': '',
+                   'file_manager': mock.MagicMock()}
+        self.sreq = DockerStorletRequest('storlet-1.0.jar', {}, {}, iter([]),
+                                         options=options)
+        self.sbox = mock.MagicMock()
+        self.gateway._run_time_sbox = self.sbox
+        self.protocols = []
+
+        def fake_create_protocol(sreq, run_time_sbox, timer):
+            return self.protocols.pop(0)
+
+        for name, value in (('update_docker_container_from_cache', False),
+                            ('_get_log_size', 0)):
+            patcher = mock.patch.object(self.gateway, name,
+                                        return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(self.gateway, '_create_protocol',
+                                    fake_create_protocol)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _add_protocol(self, side_effect):
+        protocol = mock.MagicMock()
+        protocol.communicate.side_effect = side_effect
+        self.protocols.append(protocol)
+        return protocol
+
+    def test_invocation_flow(self):
+        self.sbox.activate_storlet_daemon.return_value = False
+        sresp = mock.MagicMock()
+        self._add_protocol([sresp])
+        self.assertIs(sresp, self.gateway.invocation_flow(self.sreq))
+        self.sbox.activate_storlet_daemon.assert_called_once_with(
+            self.sreq, False)
+
+    def test_invocation_flow_send_failure_status_cached(self):
+        # The daemon cached as running died meanwhile
+        self.sbox.activate_storlet_daemon.side_effect = [True, False]
+        sresp = mock.MagicMock()
+        self._add_protocol(StorletSendError())
+        self._add_protocol([sresp])
+        self.assertIs(sresp, self.gateway.invocation_flow(self.sreq))
+        self.sbox.invalidate_daemon_status.assert_called_once_with(
+            self.sreq.storlet_main)
+        self.assertEqual([mock.call(self.sreq, False)] * 2,
+                         self.sbox.activate_storlet_daemon.call_args_list)
+
+        # Retried once only
+        self.sbox.reset_mock()
+        self.sbox.activate_storlet_daemon.side_effect = [True, True]
+        self._add_protocol(StorletSendError())
+        self._add_protocol(StorletSendError())
+        self.assertRaises(StorletSendError, self.gateway.invocation_flow,
+                          self.sreq)
+        self.assertEqual(2, self.sbox.activate_storlet_daemon.call_count)
+        self.assertEqual([], self.protocols)
+
+    def test_invocation_flow_send_failure_not_cached(self):
+        # The daemon factory was just asked, so that there is no retry
+        self.sbox.activate_storlet_daemon.return_value = False
+        self._add_protocol(StorletSendError())
+        self.assertRaises(StorletSendError, self.gateway.invocation_flow,
+                          self.sreq)
+        self.assertEqual(1, self.sbox.activate_storlet_daemon.call_count)
+        self.sbox.invalidate_daemon_status.assert_called_once_with(
+            self.sreq.storlet_main)
+
+    def test_invocation_flow_failure(self):
+        # The input may have been sent already, so that there is no retry
+        self.sbox.activate_storlet_daemon.return_value = True
+        self._add_protocol(StorletRuntimeException())
+        self.assertRaises(StorletRuntimeException,
+                          self.gateway.invocation_flow, self.sreq)
+        self.assertEqual(1, self.sbox.activate_storlet_daemon.call_count)
+
+
+class TestStorletCacheManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.manifest = StorletCacheManifest()
+
+    def test_is_deployed(self):
+        self.assertFalse(self.manifest.is_deployed('scope', 'main', 'obj',
+                                                   ('1', '10')))
+        self.manifest.set_deployed('scope', 'main', 'obj', ('1', '10'))
+        self.assertTrue(self.manifest.is_deployed('scope', 'main', 'obj',
+                                                  ('1', '10')))
+        self.assertFalse(self.manifest.is_deployed('scope', 'main', 'obj',
+                                                   ('2', '10')))
+        self.assertFalse(self.manifest.is_deployed('scope', 'main2', 'obj',
+                                                   ('1', '10')))
+        self.assertEqual({'hits': 1, 'misses': 3}, self.manifest.stats)
+
+        self.manifest.set_deployed('scope', 'main', 'dep', None)
+        self.assertTrue(self.manifest.is_deployed('scope', 'main', 'dep',
+                                                  None))
+
+    def test_invalidate(self):
+        self.manifest.set_deployed('scope', 'main1', 'obj', None)
+        self.manifest.set_deployed('scope', 'main2', 'obj', None)
+        self.manifest.set_deployed('other', 'main1', 'obj', None)
+
+        self.manifest.invalidate('scope', 'main1')
+        self.assertFalse(self.manifest.is_deployed('scope', 'main1', 'obj',
+                                                   None))
+        self.assertTrue(self.manifest.is_deployed('scope', 'main2', 'obj',
+                                                  None))
+
+        self.manifest.invalidate('scope')
+        self.assertFalse(self.manifest.is_deployed('scope', 'main2', 'obj',
+                                                   None))
+        self.assertTrue(self.manifest.is_deployed('other', 'main1', 'obj',
+                                                  None))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -13,17 +13,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import fcntl
 import mock
 import os
+import shutil
 import unittest
 import tempfile
 from contextlib import contextmanager
 from six import StringIO
 
-from storlet_gateway.common.exceptions import StorletRuntimeException
+from storlet_gateway.common.exceptions import StorletRuntimeException, \
+    StorletSendError
+from storlet_gateway.common.streaming import F_GETPIPE_SZ, StreamingPolicy
+from storlet_gateway.common.timing import InvocationTimer
 from storlet_gateway.gateways.docker.gateway import DockerStorletRequest
 from storlet_gateway.gateways.docker.runtime import RunTimeSandbox, \
-    RunTimePaths, StorletInvocationProtocol
+    RunTimePaths, StorletInvocationProtocol, get_sbus_client, _sbus_clients, \
+    daemon_status_cache, DaemonStatusCache, recent_storlets, \
+    RecentStorlets, activation_stats, ActivationStats
+from SBusPythonFacade.SBusDatagram import SBusServiceReply, \
+    SBUS_FRAMING_BINARY, SBUS_FRAMING_JSON
+from SBusPythonFacade.SBusStorletCommand import SBUS_CMD_DAEMON_STATUS, \
+    SBUS_CMD_PING, SBUS_CMD_START_DAEMON, SBUS_CMD_STOP_DAEMON
 from tests.unit.swift import FakeLogger
 from exceptions import AssertionError
 
@@ -78,6 +89,31 @@ def _mock_os_pipe(bufs):
         yield pipes
 
 
+class FakeSBusClient(object):
+    """
+    Replays the given replies, None meaning that the command failed to send
+    """
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.calls = []
+        self.batches = []
+
+    def call(self, path, command, params=None, task_id=None):
+        self.calls.append((path, command, params))
+        reply = self.replies.pop(0)
+        if reply is None:
+            return None
+        return SBusServiceReply.parse(reply)
+
+    def call_batch(self, path, commands):
+        self.batches.append(len(commands))
+        replies = [self.call(path, command, params)
+                   for command, params in commands]
+        if None in replies:
+            return None
+        return replies
+
+
 class TestRuntimePaths(unittest.TestCase):
 
     def setUp(self):
@@ -197,48 +233,75 @@ class TestRunTimeSandbox(unittest.TestCase):
         self.conf = {'docker_repo': 'localhost:5001'}
         self.scope = '0123456789abc'
         self.sbox = RunTimeSandbox(self.scope, self.conf, self.logger)
+        daemon_status_cache.invalidate(self.scope)
+        recent_storlets.forget(self.scope)
 
     def tearDown(self):
-        pass
-
-    def test_parse_sandbox_factory_answer(self):
-        status, msg = self.sbox._parse_sandbox_factory_answer('True:message')
-        self.assertTrue(status)
-        self.assertEqual(msg, 'message')
-
-        status, msg = self.sbox._parse_sandbox_factory_answer('False:message')
-        self.assertFalse(status)
-        self.assertEqual(msg, 'message')
-
-    def _check_all_pipese_closed(self, pipes):
-        for _pipe in pipes:
-            self.assertTrue(_pipe[0].closed)
-            self.assertTrue(_pipe[1].closed)
+        daemon_status_cache.invalidate(self.scope)
+        recent_storlets.forget(self.scope)
+
+    def _set_replies(self, replies):
+        client = FakeSBusClient(replies)
+        patcher = mock.patch('storlet_gateway.gateways.docker.runtime.'
+                             'get_sbus_client', return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return client
+
+    def test_sbus_client_shared_in_scope(self):
+        other = RunTimeSandbox(self.scope, self.conf, self.logger)
+        self.assertIs(self.sbox.sbus_client, other.sbus_client)
+        self.assertIs(self.sbox.sbus_client, get_sbus_client(self.scope))
+        self.assertIsNot(self.sbox.sbus_client,
+                         get_sbus_client('another_scope'))
+
+    def test_sbus_client_evicted(self):
+        with mock.patch.dict(_sbus_clients, clear=True):
+            client = get_sbus_client('scope1', max_clients=2)
+            with mock.patch('SBusPythonFacade.SBusClient.os.pipe') as _pipe:
+                _pipe.return_value = (3, 4)
+                with client.reply_pipe():
+                    pass
+            client._sockets['path'] = [5]
+            get_sbus_client('scope2', max_clients=2)
+            self.assertIs(client, get_sbus_client('scope1', max_clients=2))
+
+            # scope2 is the least recently used one
+            get_sbus_client('scope3', max_clients=2)
+            self.assertEqual(['scope1', 'scope3'], list(_sbus_clients))
+            with mock.patch('SBusPythonFacade.SBusClient.os.close') as close:
+                get_sbus_client('scope4', max_clients=2)
+            # Its sockets and pipes are closed
+            self.assertEqual([mock.call(5), mock.call(3), mock.call(4)],
+                             close.call_args_list)
+            self.assertTrue(client.closed)
+            self.assertIsNot(client, get_sbus_client('scope1'))
 
     def test_ping(self):
-        with _mock_os_pipe(['True:OK']) as pipes, _mock_sbus(0):
-            self.assertEqual(self.sbox.ping(), 1)
-            self._check_all_pipese_closed(pipes)
+        client = self._set_replies(['True:OK'])
+        self.assertEqual(self.sbox.ping(), 1)
+        self.assertEqual(client.calls,
+                         [(self.sbox.paths.host_factory_pipe(),
+                           SBUS_CMD_PING, None)])
+
+        self._set_replies(['False:ERROR'])
+        self.assertEqual(self.sbox.ping(), 0)
 
-        with _mock_os_pipe(['False:ERROR']) as pipes, _mock_sbus(-1):
-            self.assertEqual(self.sbox.ping(), -1)
-            self._check_all_pipese_closed(pipes)
+        self._set_replies([None])
+        self.assertEqual(self.sbox.ping(), -1)
 
     def test_wait(self):
-        with _mock_os_pipe(['True:OK']) as pipes, _mock_sbus(0), \
-            mock.patch('storlet_gateway.gateways.docker.runtime.'
-                       'time.sleep') as _s:
+        self._set_replies(['True:OK'])
+        with mock.patch('storlet_gateway.gateways.docker.runtime.'
+                        'time.sleep') as _s:
             self.sbox.wait()
             self.assertEqual(_s.call_count, 0)
-            self._check_all_pipese_closed(pipes)
 
-        with _mock_os_pipe(['False:ERROR', 'True:OK']) as pipes, \
-            _mock_sbus(0), \
-            mock.patch('storlet_gateway.gateways.docker.runtime.'
-                       'time.sleep') as _s:
+        self._set_replies(['False:ERROR', 'True:OK'])
+        with mock.patch('storlet_gateway.gateways.docker.runtime.'
+                        'time.sleep') as _s:
             self.sbox.wait()
             self.assertEqual(_s.call_count, 1)
-            self._check_all_pipese_closed(pipes)
 
         # TODO(takashi): should test timeout case
 
@@ -270,6 +333,339 @@ class TestRunTimeSandbox(unittest.TestCase):
                 self.sbox.restart()
             self.sbox.wait = _wait
 
+    def test_start_storlet_daemon(self):
+        client = self._set_replies(['True:OK', 'False:ERROR', None])
+        self.assertEqual(
+            self.sbox.start_storlet_daemon('path', 'storlet'), 1)
+        path, command, params = client.calls[0]
+        self.assertEqual(SBUS_CMD_START_DAEMON, command)
+        self.assertEqual('storlet', params['storlet_name'])
+        self.assertEqual('path', params['storlet_path'])
+        self.assertEqual(
+            self.sbox.start_storlet_daemon('path', 'storlet'), 0)
+        self.assertEqual(
+            self.sbox.start_storlet_daemon('path', 'storlet'), -1)
+
+    def test_stop_storlet_daemon(self):
+        client = self._set_replies(['True:OK', 'False:ERROR', None])
+        self.assertEqual(self.sbox.stop_storlet_daemon('storlet'), 1)
+        self.assertEqual((SBUS_CMD_STOP_DAEMON, {'storlet_name': 'storlet'}),
+                         client.calls[0][1:])
+        self.assertEqual(self.sbox.stop_storlet_daemon('storlet'), 0)
+        self.assertEqual(self.sbox.stop_storlet_daemon('storlet'), -1)
+
+    def test_get_storlet_daemon_status(self):
+        client = self._set_replies(['True:OK', 'False:ERROR', None])
+        self.assertEqual(self.sbox.get_storlet_daemon_status('storlet'), 1)
+        self.assertEqual((SBUS_CMD_DAEMON_STATUS,
+                          {'storlet_name': 'storlet'}),
+                         client.calls[0][1:])
+        self.assertEqual(self.sbox.get_storlet_daemon_status('storlet'), 0)
+        self.assertEqual(self.sbox.get_storlet_daemon_status('storlet'), -1)
+
+    def test_start_storlet_daemons(self):
+        client = self._set_replies(['True:OK', 'False:ERROR'])
+        self.assertEqual([1, 0], self.sbox.start_storlet_daemons(
+            [('path1', 'storlet1'), ('path2', 'storlet2')]))
+        self.assertEqual([2], client.batches)
+        self.assertEqual(['storlet1', 'storlet2'],
+                         [call[2]['storlet_name'] for call in client.calls])
+        self.assertEqual('path2', client.calls[1][2]['storlet_path'])
+
+        self._set_replies(['True:OK', None])
+        self.assertEqual(-1, self.sbox.start_storlet_daemons(
+            [('path1', 'storlet1'), ('path2', 'storlet2')]))
+
+    def test_get_storlet_daemons_status(self):
+        client = self._set_replies(['True:OK', 'False:ERROR'])
+        self.assertEqual({'storlet1': 1, 'storlet2': 0},
+                         self.sbox.get_storlet_daemons_status(
+                             ['storlet1', 'storlet2']))
+        self.assertEqual([(SBUS_CMD_DAEMON_STATUS,
+                           {'storlet_name': 'storlet1'}),
+                          (SBUS_CMD_DAEMON_STATUS,
+                           {'storlet_name': 'storlet2'})],
+                         [call[1:] for call in client.calls])
+
+        self._set_replies([None])
+        self.assertEqual(-1, self.sbox.get_storlet_daemons_status(
+            ['storlet1']))
+
+    def test_get_factory_status(self):
+        client = self._set_replies(
+            [SBusServiceReply(
+                True, '{"cold": 1, "start_latency_histogram": [[0.1, 1]]}').
+             serialize(),
+             'False: error', 'True: foo', None])
+        self.assertEqual({'cold': 1, 'start_latency_histogram': [[0.1, 1]]},
+                         self.sbox.get_factory_status())
+        self.assertEqual((SBUS_CMD_DAEMON_STATUS, None), client.calls[0][1:])
+        for _ in range(3):
+            self.assertIsNone(self.sbox.get_factory_status())
+
+    def test_get_framing(self):
+        factory_pipe = self.sbox.paths.host_factory_pipe()
+        self.sbox.sbus_client._framing.pop(factory_pipe, None)
+        self.assertEqual(SBUS_FRAMING_JSON, self.sbox.get_framing())
+        # The framing advertised by the factory applies to the daemons,
+        # when the binary framing is enabled
+        self.sbox.sbus_client._framing[factory_pipe] = SBUS_FRAMING_BINARY
+        try:
+            self.assertEqual(SBUS_FRAMING_JSON, self.sbox.get_framing())
+            conf = dict(self.conf, sbus_binary_framing='true')
+            sbox = RunTimeSandbox(self.scope, conf, self.logger)
+            self.assertEqual(SBUS_FRAMING_BINARY, sbox.get_framing())
+        finally:
+            self.sbox.sbus_client._framing.pop(factory_pipe)
+            self.sbox.sbus_client.max_framing = SBUS_FRAMING_JSON
+
+    def _get_sreq(self):
+        sreq = mock.MagicMock()
+        sreq.storlet_main = 'org.openstack.storlet.Storlet'
+        sreq.storlet_id = 'storlet-1.0.jar'
+        sreq.dependencies = []
+        return sreq
+
+    def test_activate_storlet_daemon_status_cached(self):
+        sreq = self._get_sreq()
+        # The daemon is not running, and gets started
+        client = self._set_replies(['False:ERROR', 'True:OK'])
+        self.assertFalse(self.sbox.activate_storlet_daemon(sreq, False))
+        self.assertEqual([SBUS_CMD_DAEMON_STATUS, SBUS_CMD_START_DAEMON],
+                         [call[1] for call in client.calls])
+
+        # The daemon status is not asked again
+        client = self._set_replies([])
+        self.assertTrue(self.sbox.activate_storlet_daemon(sreq, False))
+        self.assertTrue(self.sbox.activate_storlet_daemon(sreq, False))
+        self.assertEqual([], client.calls)
+
+        # The daemon is restarted when the storlet was updated
+        client = self._set_replies(['True:OK', 'True:OK', 'True:OK'])
+        self.sbox.activate_storlet_daemon(sreq, True)
+        self.assertEqual([SBUS_CMD_DAEMON_STATUS, SBUS_CMD_STOP_DAEMON,
+                          SBUS_CMD_START_DAEMON],
+                         [call[1] for call in client.calls])
+
+    def test_activate_storlet_daemon_status_invalidated(self):
+        sreq = self._get_sreq()
+        self._set_replies(['True:OK'])
+        self.sbox.activate_storlet_daemon(sreq, False)
+
+        self.sbox.invalidate_daemon_status(sreq.storlet_main)
+        client = self._set_replies(['True:OK'])
+        self.sbox.activate_storlet_daemon(sreq, False)
+        self.assertEqual([SBUS_CMD_DAEMON_STATUS],
+                         [call[1] for call in client.calls])
+
+        # Restarting the sandbox forgets all the daemons of the scope
+        with mock.patch('storlet_gateway.gateways.docker.runtime.'
+                        'RunTimePaths.create_host_pipe_prefix'), \
+            mock.patch('storlet_gateway.gateways.docker.runtime.'
+                       'subprocess.call') as _call, \
+            mock.patch('storlet_gateway.gateways.docker.runtime.'
+                       'eventlet.spawn_n'):
+            _call.return_value = 0
+            self.sbox.wait = mock.MagicMock()
+            self.sbox.restart()
+        client = self._set_replies(['True:OK'])
+        self.sbox.activate_storlet_daemon(sreq, False)
+        self.assertEqual([SBUS_CMD_DAEMON_STATUS],
+                         [call[1] for call in client.calls])
+
+    def test_activate_storlet_daemon_status_not_cached(self):
+        self.sbox.daemon_status_cache_ttl = 0
+        sreq = self._get_sreq()
+        client = self._set_replies(['True:OK', 'True:OK'])
+        self.sbox.activate_storlet_daemon(sreq, False)
+        self.sbox.activate_storlet_daemon(sreq, False)
+        self.assertEqual([SBUS_CMD_DAEMON_STATUS, SBUS_CMD_DAEMON_STATUS],
+                         [call[1] for call in client.calls])
+
+    def test_activate_storlet_daemon_stats(self):
+        sreq = self._get_sreq()
+        stats = dict(activation_stats.stats)
+        self._set_replies(['False:ERROR', 'True:OK'])
+        self.sbox.activate_storlet_daemon(sreq, False)
+        self.assertEqual(stats['cold'] + 1, activation_stats.stats['cold'])
+        self.assertEqual(stats['warm'], activation_stats.stats['warm'])
+
+        # cached status
+        self.sbox.activate_storlet_daemon(sreq, False)
+        # running daemon reported by the factory
+        self.sbox.invalidate_daemon_status()
+        self._set_replies(['True:OK'])
+        self.sbox.activate_storlet_daemon(sreq, False)
+        self.assertEqual(stats['cold'] + 1, activation_stats.stats['cold'])
+        self.assertEqual(stats['warm'] + 2, activation_stats.stats['warm'])
+
+        self.assertEqual(
+            [(sreq.storlet_main,
+              '/home/swift/%s/%s' % (sreq.storlet_main, sreq.storlet_id))],
+            recent_storlets.get(self.scope))
+
+    def _restart(self):
+        with mock.patch('storlet_gateway.gateways.docker.runtime.'
+                        'RunTimePaths.create_host_pipe_prefix'), \
+            mock.patch('storlet_gateway.gateways.docker.runtime.'
+                       'subprocess.call') as _call, \
+            mock.patch('storlet_gateway.gateways.docker.runtime.'
+                       'eventlet.spawn_n') as _spawn:
+            _call.return_value = 0
+            self.sbox.wait = mock.MagicMock()
+            self.sbox.restart()
+        return _spawn
+
+    def test_restart_prewarm(self):
+        # Nothing to prewarm
+        _spawn = self._restart()
+        self.assertEqual(0, _spawn.call_count)
+
+        recent_storlets.record(self.scope, 'storlet1', 'path1')
+        recent_storlets.record(self.scope, 'storlet2', 'path2')
+        _spawn = self._restart()
+        _spawn.assert_called_once_with(
+            self.sbox.prewarm_storlet_daemons,
+            [('storlet2', 'path2'), ('storlet1', 'path1')])
+
+        self.sbox.prewarm_recent_storlets = False
+        _spawn = self._restart()
+        self.assertEqual(0, _spawn.call_count)
+
+    def test_prewarm_targets_from_conf(self):
+        storlets_dir = tempfile.mkdtemp()
+        try:
+            conf = dict(self.conf, storlets_dir=storlets_dir,
+                        prewarm_storlets='storlet1, storlet2, storlet3')
+            sbox = RunTimeSandbox(self.scope, conf, self.logger)
+            os.makedirs(sbox.paths.host_storlet('storlet1'))
+            for name in ('storlet1.jar', 'dep.jar'):
+                open(os.path.join(sbox.paths.host_storlet('storlet1'), name),
+                     'w').close()
+            # storlet3 is not deployed
+            recent_storlets.record(self.scope, 'storlet2', 'path2')
+            self.assertEqual(
+                [('storlet2', 'path2'),
+                 ('storlet1',
+                  '/home/swift/storlet1/dep.jar:'
+                  '/home/swift/storlet1/storlet1.jar')],
+                sbox._get_prewarm_targets())
+        finally:
+            shutil.rmtree(storlets_dir)
+
+    def test_prewarm_storlet_daemons(self):
+        prewarmed = activation_stats.stats['prewarmed']
+        daemon_status_cache.set_running(self.scope, 'storlet1', 10)
+        client = self._set_replies(['True:OK', 'False:ERROR'])
+        stats = dict(daemon_status_cache.stats)
+        self.assertEqual(1, self.sbox.prewarm_storlet_daemons(
+            [('storlet1', 'path1'), ('storlet2', 'path2'),
+             ('storlet3', 'path3')]))
+        # The prewarm is not counted in the hit rate of the activations
+        self.assertEqual(stats, daemon_status_cache.stats)
+        # storlet1 is running already, the others are started at once
+        self.assertEqual([2], client.batches)
+        self.assertEqual(['storlet2', 'storlet3'],
+                         [call[2]['storlet_name'] for call in client.calls])
+        self.assertEqual(prewarmed + 1, activation_stats.stats['prewarmed'])
+
+        # The prewarmed daemon is not checked on the first invocation
+        client = self._set_replies([])
+        sreq = self._get_sreq()
+        sreq.storlet_main = 'storlet2'
+        self.assertTrue(self.sbox.activate_storlet_daemon(sreq, False))
+        self.assertEqual([], client.calls)
+        self.assertFalse(daemon_status_cache.is_running(self.scope,
+                                                        'storlet3'))
+
+
+class TestRecentStorlets(unittest.TestCase):
+
+    def test_record(self):
+        recent = RecentStorlets(max_storlets=2)
+        recent.record('scope', 'storlet1', 'path1')
+        recent.record('scope', 'storlet2', 'path2')
+        recent.record('other', 'storlet3', 'path3')
+        self.assertEqual([('storlet2', 'path2'), ('storlet1', 'path1')],
+                         recent.get('scope'))
+
+        # The most recent goes first, and the oldest gets out
+        recent.record('scope', 'storlet1', 'path1-2')
+        recent.record('scope', 'storlet3', 'path3')
+        self.assertEqual([('storlet3', 'path3'), ('storlet1', 'path1-2')],
+                         recent.get('scope'))
+        self.assertEqual([('storlet3', 'path3')], recent.get('other'))
+
+    def test_forget(self):
+        recent = RecentStorlets()
+        recent.record('scope', 'storlet1', 'path1')
+        recent.record('scope', 'storlet2', 'path2')
+        recent.forget('scope', 'storlet1')
+        self.assertEqual([('storlet2', 'path2')], recent.get('scope'))
+        recent.forget('scope')
+        self.assertEqual([], recent.get('scope'))
+
+
+class TestActivationStats(unittest.TestCase):
+
+    def test_record(self):
+        stats = ActivationStats()
+        self.assertEqual(0.0, stats.average('cold'))
+        stats.record('cold', 2.0)
+        stats.record('cold', 1.0)
+        stats.record('warm', 0.5)
+        self.assertEqual(2, stats.stats['cold'])
+        self.assertEqual(1.5, stats.average('cold'))
+        self.assertEqual(2.0, stats.stats['cold_max'])
+        self.assertEqual(0.5, stats.average('warm'))
+
+
+class TestDaemonStatusCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = DaemonStatusCache()
+
+    def test_is_running(self):
+        self.assertFalse(self.cache.is_running('scope', 'storlet'))
+        with mock.patch('storlet_gateway.gateways.docker.runtime.'
+                        'time.time') as _time:
+            _time.return_value = 100
+            self.cache.set_running('scope', 'storlet', 10)
+            self.assertTrue(self.cache.is_running('scope', 'storlet'))
+            self.assertFalse(self.cache.is_running('scope', 'other'))
+            self.assertFalse(self.cache.is_running('other', 'storlet'))
+            # expired
+            _time.return_value = 110
+            self.assertFalse(self.cache.is_running('scope', 'storlet'))
+        self.assertEqual({'hits': 1, 'misses': 4}, self.cache.stats)
+        self.assertEqual(0.2, self.cache.hit_rate)
+
+    def test_is_cached(self):
+        self.assertFalse(self.cache.is_cached('scope', 'storlet'))
+        self.cache.set_running('scope', 'storlet', 10)
+        self.assertTrue(self.cache.is_cached('scope', 'storlet'))
+        self.assertEqual({'hits': 0, 'misses': 0}, self.cache.stats)
+
+    def test_set_running_disabled(self):
+        self.cache.set_running('scope', 'storlet', 0)
+        self.assertFalse(self.cache.is_running('scope', 'storlet'))
+
+    def test_invalidate(self):
+        self.cache.set_running('scope', 'storlet1', 10)
+        self.cache.set_running('scope', 'storlet2', 10)
+        self.cache.set_running('other', 'storlet1', 10)
+
+        self.cache.invalidate('scope', 'storlet1')
+        self.assertFalse(self.cache.is_running('scope', 'storlet1'))
+        self.assertTrue(self.cache.is_running('scope', 'storlet2'))
+
+        self.cache.invalidate('scope')
+        self.assertFalse(self.cache.is_running('scope', 'storlet2'))
+        self.assertTrue(self.cache.is_running('other', 'storlet1'))
+
+    def test_hit_rate_empty(self):
+        self.assertEqual(0.0, self.cache.hit_rate)
+
 
 class TestStorletInvocationProtocol(unittest.TestCase):
     def setUp(self):
@@ -328,5 +724,75 @@ class TestStorletInvocationProtocol(unittest.TestCase):
             # sanity
             self.assertRaises(StopIteration, next, pipes)
 
+    def test_invoke_send_failure(self):
+        with _mock_sbus(-1), _mock_os_pipe([''] * 4):
+            with self.protocol.storlet_logger.activate(), \
+                    self.protocol._activate_invocation_descriptors():
+                self.assertRaises(StorletSendError, self.protocol._invoke)
+
+    def test_invoke_framing(self):
+        self.protocol.framing = SBUS_FRAMING_BINARY
+        with _mock_os_pipe([''] * 4), \
+            mock.patch('storlet_gateway.gateways.docker.runtime.'
+                       'SBus.send') as fake_send:
+            fake_send.return_value = 0
+            with mock.patch.object(
+                    self.protocol, '_wait_for_read_with_timeout'):
+                with self.protocol.storlet_logger.activate(), \
+                        self.protocol._activate_invocation_descriptors():
+                    self.protocol._invoke()
+            dtg = fake_send.call_args[0][1]
+            self.assertEqual(SBUS_FRAMING_BINARY, dtg.framing)
+            self.assertTrue(dtg.serialized_cmd_params.startswith('\x00'))
+
+    def test_communicate_timing(self):
+        self.protocol.timer = InvocationTimer('scope', 'Storlet')
+        self.protocol.srequest = DockerStorletRequest(
+            'Storlet-1.0.jar', {}, {}, data_fd=0,
+            options={'storlet_main': 'org.openstack.storlet.Storlet',
+                     'storlet_dependency': ''})
+        with _mock_os_pipe([''] * 4), \
+                mock.patch.object(self.protocol, '_invoke'), \
+                mock.patch.object(self.protocol, '_read_metadata'), \
+                mock.patch.object(self.protocol,
+                                  '_wait_for_read_with_timeout'):
+            self.protocol.communicate()
+        self.assertEqual(['first_byte', 'invoke', 'read_metadata'],
+                         sorted(self.protocol.timer.totals))
+
+    def test_prepare_invocation_descriptors_pipe_size(self):
+        self.protocol.streaming_policy = \
+            StreamingPolicy({'storlet_pipe_size': str(1024 * 1024)})
+        self.protocol._prepare_invocation_descriptors()
+        try:
+            for fd in (self.protocol._input_data_write_fd,
+                       self.protocol.data_read_fd):
+                self.assertEqual(1024 * 1024, fcntl.fcntl(fd, F_GETPIPE_SZ))
+        finally:
+            self.protocol._close_input_data_descriptors()
+            self.protocol._close_remote_side_descriptors()
+            self.protocol._close_local_side_descriptors()
+
+    def _read_input_data(self, data_iter):
+        self.protocol.srequest = DockerStorletRequest(
+            'Storlet-1.0.jar', {}, {}, data_iter,
+            options={'storlet_main': 'org.openstack.storlet.Storlet',
+                     'storlet_dependency': ''})
+        read_fd, self.protocol._input_data_write_fd = os.pipe()
+        try:
+            self.protocol._write_input_data()
+            data = b''
+            while True:
+                chunk = os.read(read_fd, 4096)
+                if not chunk:
+                    return data
+                data += chunk
+        finally:
+            os.close(read_fd)
+
+    def test_write_input_data(self):
+        self.assertEqual(b'abcdef',
+                         self._read_input_data(iter([b'abc', b'def'])))
+
 if __name__ == '__main__':
     unittest.main()
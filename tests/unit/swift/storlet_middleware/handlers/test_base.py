@@ -20,8 +20,10 @@ from six import StringIO
 
 from swift.common.swob import Request
 from storlet_gateway.common.exceptions import FileManagementError
+from storlet_gateway.gateways.stub import StorletGatewayStub
 from storlet_middleware.handlers import StorletBaseHandler
-from storlet_middleware.handlers.base import SwiftFileManager
+from storlet_middleware.handlers.base import ClassifiedHeaders, \
+    StorletGatewayRegistry, SwiftFileManager, _internal_clients
 from tests.unit.swift import FakeLogger
 
 
@@ -34,7 +36,8 @@ class TestSwiftFileManager(unittest.TestCase):
     @contextmanager
     def _mock_internal_client(self, cls):
         with mock.patch('storlet_middleware.handlers.base.InternalClient',
-                        cls):
+                        cls), \
+                mock.patch.dict(_internal_clients, clear=True):
             yield
 
     def test_get_storlet(self):
@@ -117,10 +120,12 @@ class TestSwiftFileManager(unittest.TestCase):
 
             def upload_object(self, fobj, account, container, obj,
                               headers=None):
-                pass
+                uploaded.append((account, container, obj))
 
+        uploaded = []
         with self._mock_internal_client(DummyClient):
             self.manager.put_log(name, mock.MagicMock())
+        self.assertEqual([('a', 'log', name)], uploaded)
 
         class DummyClient(object):
             def __init__(self, *args, **kwargs):
@@ -134,6 +139,24 @@ class TestSwiftFileManager(unittest.TestCase):
             with self.assertRaises(FileManagementError):
                 self.manager.put_log(name, mock.MagicMock())
 
+    def test_client(self):
+        created = []
+
+        class DummyClient(object):
+            def __init__(self, conf_file, user_agent, request_tries):
+                created.append((conf_file, request_tries))
+
+        with self._mock_internal_client(DummyClient):
+            client = self.manager.client
+            # The client is shared by the file managers of the process
+            manager = SwiftFileManager('b', 'storlet', 'dependency', 'log',
+                                       'client.conf', self.logger)
+            self.assertIs(client, manager.client)
+            manager = SwiftFileManager('b', 'storlet', 'dependency', 'log',
+                                       'client.conf', self.logger, 3)
+            self.assertIsNot(client, manager.client)
+        self.assertEqual([('client.conf', 1), ('client.conf', 3)], created)
+
 
 class TestStorletBaseHandler(unittest.TestCase):
     def test_init_failed_via_base_handler(self):
@@ -156,5 +179,113 @@ class TestStorletBaseHandler(unittest.TestCase):
                     assert_not_implemented(method, path, headers)
 
 
+class TestClassifiedHeaders(unittest.TestCase):
+    def test_classify(self):
+        headers = {'X-Object-Meta-Key': 'value',
+                   'X-Object-Meta-Storlet-Main': 'org.openstack.Storlet',
+                   'X-Storlet-Parameter-1': 'a:b',
+                   'X-Storlet-Generate-Log': 'true',
+                   'X-Storlet-Range': 'bytes=1-3,5-7',
+                   'X-Run-Storlet': 'Storlet-1.0.jar',
+                   'Content-Length': '10'}
+        classified = ClassifiedHeaders(headers)
+        self.assertEqual({'Key': 'value'}, classified.user_metadata)
+        self.assertEqual({'Main': 'org.openstack.Storlet'},
+                         classified.storlet_metadata)
+        self.assertEqual({'storlet_parameter_1': 'a:b'}, classified.options)
+        self.assertEqual(['a:b'], classified.parameters)
+        self.assertEqual(
+            sorted(['X-Object-Meta-Storlet-Main', 'X-Storlet-Parameter-1',
+                    'X-Storlet-Generate-Log', 'X-Storlet-Range',
+                    'X-Run-Storlet']),
+            sorted(classified.storlet_keys))
+        self.assertEqual([(1, 3), (5, 7)], classified.storlet_ranges)
+
+        self.assertIsNone(ClassifiedHeaders({}).storlet_ranges)
+
+
+class FakeHandler(StorletBaseHandler):
+    def _parse_vaco(self):
+        return self.request.split_path(4, 4, rest_with_last=True)
+
+
+class TestStorletBaseHandlerHeaders(unittest.TestCase):
+    def setUp(self):
+        self.req = Request.blank(
+            '/v1/a/c/o', headers={'X-Run-Storlet': 'Storlet-1.0.jar',
+                                  'X-Storlet-Range': 'bytes=1-3'})
+        self.handler = FakeHandler(
+            self.req, {'gateway_module': StorletGatewayStub},
+            mock.MagicMock(), FakeLogger())
+
+    def test_classify_request_headers(self):
+        classified = self.handler._classify_headers(self.req.headers)
+        self.assertIs(classified,
+                      self.handler._classify_headers(self.req.headers))
+        self.assertTrue(self.handler.is_storlet_range_request)
+        self.assertFalse(self.handler.is_storlet_multiple_range_request)
+
+        # Other headers are not cached
+        self.assertIsNot(self.handler._classify_headers({}),
+                         self.handler._classify_headers({}))
+
+    def test_request_headers_changed(self):
+        self.assertEqual({}, self.handler._get_user_metadata(
+            self.req.headers))
+        self.handler._set_metadata_in_headers(self.req.headers,
+                                              {'Key': 'value'})
+        self.assertEqual({'Key': 'value'},
+                         self.handler._get_user_metadata(self.req.headers))
+
+        self.req.headers['X-Storlet-Range'] = 'bytes=1-3,5-7'
+        self.handler._request_headers_changed()
+        self.assertTrue(self.handler.is_storlet_multiple_range_request)
+
+
+class TestStorletGatewayRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = StorletGatewayRegistry(
+            StorletGatewayStub, {}, FakeLogger(), max_gateways=2,
+            idle_timeout=10)
+
+    def test_get(self):
+        gateway = self.registry.get('scope1')
+        self.assertEqual('scope1', gateway.scope)
+        self.assertIs(gateway, self.registry.get('scope1'))
+        self.assertIsNot(gateway, self.registry.get('scope2'))
+        self.assertEqual({'created': 2, 'reused': 1, 'evicted': 0},
+                         self.registry.stats)
+
+    def test_evict_lru(self):
+        gateway1 = self.registry.get('scope1')
+        gateway2 = self.registry.get('scope2')
+        self.registry.get('scope1')
+        self.registry.get('scope3')
+        # scope2 is the least recently used one
+        self.assertIs(gateway1, self.registry.get('scope1'))
+        self.assertIsNot(gateway2, self.registry.get('scope2'))
+        self.assertEqual(2, self.registry.stats['evicted'])
+
+    def test_evict_idle(self):
+        with mock.patch('storlet_middleware.handlers.base.time.time',
+                        return_value=100):
+            gateway = self.registry.get('scope1')
+        with mock.patch('storlet_middleware.handlers.base.time.time',
+                        return_value=109):
+            self.assertIs(gateway, self.registry.get('scope1'))
+        with mock.patch('storlet_middleware.handlers.base.time.time',
+                        return_value=119):
+            self.assertIsNot(gateway, self.registry.get('scope1'))
+        self.assertEqual(1, self.registry.stats['evicted'])
+
+    def test_setup_gateway(self):
+        req = Request.blank('/v1/AUTH_a/c/o',
+                            headers={'X-Run-Storlet': 'Storlet-1.0.jar'})
+        handler = FakeHandler(req, {'gateway_module': StorletGatewayStub},
+                              mock.MagicMock(), FakeLogger(), self.registry)
+        handler._setup_gateway()
+        self.assertIs(self.registry.get(handler.scope), handler.gateway)
+
+
 if __name__ == '__main__':
     unittest.main()
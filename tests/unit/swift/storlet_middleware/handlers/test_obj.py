@@ -13,12 +13,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import eventlet
 import mock
+import shutil
+import tempfile
 import unittest
 
 from swift.common.swob import Request, HTTPOk, HTTPCreated
+from storlet_gateway.common.output_cache import _output_caches
+from storlet_gateway.common.timing import InvocationTimer
+from storlet_gateway.gateways.stub import StorletGatewayStub
 from storlet_middleware.handlers import StorletObjectHandler
 
+from tests.unit.swift.storlet_middleware import FakeApp
 from tests.unit.swift.storlet_middleware.handlers import \
     BaseTestStorletMiddleware, create_handler_config
 
@@ -82,6 +89,34 @@ class TestStorletMiddlewareObject(BaseTestStorletMiddleware):
         self.assertEqual('200 OK', resp.status)
         self.assertEqual('FAKE APP', resp.body)
 
+    def test_GET_with_storlets_and_timing(self):
+        target = '/sda1/p/AUTH_a/c/o'
+        self.base_app.register('GET', target, HTTPOk, body='FAKE APP')
+        invocation_flow = StorletGatewayStub.invocation_flow
+
+        def fake_invocation_flow(gateway, sreq):
+            sresp = invocation_flow(gateway, sreq)
+            if sreq.options['report_timing']:
+                sresp.timing = InvocationTimer('a', 'Storlet')
+                sresp.timing.record('invoke', 0.5)
+            return sresp
+
+        def get(headers):
+            headers.update({'X-Backend-Storlet-Policy-Index': '0',
+                            'X-Run-Storlet': 'Storlet-1.0.jar'})
+            req = Request.blank(target, environ={'REQUEST_METHOD': 'GET'},
+                                headers=headers)
+            with mock.patch.object(StorletGatewayStub, 'invocation_flow',
+                                   fake_invocation_flow):
+                return self.get_response(req)
+
+        resp = get({'X-Storlet-Timing': 'true'})
+        self.assertEqual('200 OK', resp.status)
+        self.assertEqual('invoke=500.000', resp.headers['X-Storlet-Timing'])
+
+        resp = get({})
+        self.assertNotIn('X-Storlet-Timing', resp.headers)
+
     def test_GET_with_storlets_and_http_range(self):
         target = '/sda1/p/AUTH_a/c/o'
         self.base_app.register('GET', target, HTTPOk, body='FAKE APP')
@@ -212,5 +247,137 @@ class TestStorletObjectHandler(unittest.TestCase):
             handler.obj = 'obj'
 
 
+class TestStorletObjectHandlerOutputCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.conf = create_handler_config('object')
+        self.conf['storlet_execute_on_proxy_only'] = False
+        self.conf['storlet_output_cache_dir'] = self.cache_dir
+        self.app = FakeApp()
+        self.target = '/sda1/p/AUTH_a/c/o'
+        self.app.register('GET', self.target, HTTPOk,
+                          headers={'Etag': 'etag', 'X-Timestamp': '1.0'},
+                          body='FAKE APP')
+
+    def tearDown(self):
+        _output_caches.clear()
+        shutil.rmtree(self.cache_dir)
+
+    def get(self, headers, params='?a=b'):
+        headers.update({'X-Backend-Storlet-Policy-Index': '0',
+                        'X-Run-Storlet': 'Storlet-1.0.jar',
+                        'X-Storlet-X-Timestamp': '1.0'})
+        req = Request.blank(self.target + params,
+                            environ={'REQUEST_METHOD': 'GET'},
+                            headers=headers)
+        handler = StorletObjectHandler(req, self.conf, self.app,
+                                       mock.MagicMock())
+        with mock.patch.object(StorletGatewayStub, 'invocation_flow',
+                               wraps=handler.gateway.invocation_flow) as flow:
+            resp = handler.handle_request()
+            self.assertEqual('FAKE APP', resp.body)
+            return flow.call_count
+
+    def test_cacheable(self):
+        headers = {'X-Storlet-Cacheable': 'true'}
+        self.assertEqual(1, self.get(dict(headers)))
+        self.assertEqual(0, self.get(dict(headers)))
+        # Other parameters
+        self.assertEqual(1, self.get(dict(headers), '?a=c'))
+        # The logs are only generated by an invocation
+        self.assertEqual(1, self.get({'X-Storlet-Cacheable': 'true',
+                                      'X-Storlet-Generate-Log': 'true'}))
+        # The metadata of the input object changed
+        self.app.register('GET', self.target, HTTPOk,
+                          headers={'Etag': 'etag', 'X-Timestamp': '2.0'},
+                          body='FAKE APP')
+        self.assertEqual(1, self.get(dict(headers)))
+        self.assertEqual(0, self.get(dict(headers)))
+
+    def test_not_cacheable(self):
+        self.assertEqual(1, self.get({}))
+        self.assertEqual(1, self.get({}))
+
+    def test_not_cacheable_etag(self):
+        req = Request.blank(self.target, environ={'REQUEST_METHOD': 'GET'},
+                            headers={'X-Backend-Storlet-Policy-Index': '0',
+                                     'X-Run-Storlet': 'Storlet-1.0.jar',
+                                     'X-Storlet-X-Timestamp': '1.0'})
+        handler = StorletObjectHandler(req, self.conf, self.app,
+                                       mock.MagicMock())
+        resp = handler.handle_request()
+        self.assertEqual('FAKE APP', resp.body)
+        # The ETag of the input object does not describe the output
+        self.assertNotIn('Etag', resp.headers)
+
+    def test_etag(self):
+        def get(headers):
+            headers.update({'X-Backend-Storlet-Policy-Index': '0',
+                            'X-Run-Storlet': 'Storlet-1.0.jar',
+                            'X-Storlet-X-Timestamp': '1.0',
+                            'X-Storlet-Cacheable': 'true'})
+            req = Request.blank(self.target,
+                                environ={'REQUEST_METHOD': 'GET'},
+                                headers=headers)
+            handler = StorletObjectHandler(req, self.conf, self.app,
+                                           mock.MagicMock())
+            with mock.patch.object(
+                    StorletGatewayStub, 'invocation_flow',
+                    wraps=handler.gateway.invocation_flow) as flow:
+                resp = handler.handle_request()
+                resp.body
+                return resp, flow.call_count
+
+        resp, invocations = get({})
+        self.assertEqual(200, resp.status_int)
+        etag = resp.headers['Etag']
+        self.assertNotEqual('etag', etag)
+
+        # The output is not modified, so that the storlet is not invoked
+        resp, invocations = get({'If-None-Match': '"%s"' % etag})
+        self.assertEqual(304, resp.status_int)
+        self.assertEqual(etag, resp.headers['Etag'])
+        self.assertEqual(0, invocations)
+
+        resp, invocations = get({'If-None-Match': '"other"'})
+        self.assertEqual(200, resp.status_int)
+        self.assertEqual(etag, resp.headers['Etag'])
+
+        # The storlet is invoked to generate its logs
+        resp, invocations = get({'If-None-Match': '"%s"' % etag,
+                                 'X-Storlet-Generate-Log': 'true'})
+        self.assertEqual(200, resp.status_int)
+        self.assertEqual(1, invocations)
+
+    def test_coalescing(self):
+        del self.conf['storlet_output_cache_dir']
+        invocation_flow = StorletGatewayStub.invocation_flow
+        sreqs = []
+
+        def fake_invocation_flow(gateway, sreq):
+            sreqs.append(sreq)
+            # Let the concurrent request come
+            eventlet.sleep(0)
+            return invocation_flow(gateway, sreq)
+
+        def get():
+            req = Request.blank(
+                self.target, environ={'REQUEST_METHOD': 'GET'},
+                headers={'X-Backend-Storlet-Policy-Index': '0',
+                         'X-Run-Storlet': 'Storlet-1.0.jar',
+                         'X-Storlet-X-Timestamp': '1.0',
+                         'X-Storlet-Cacheable': 'true'})
+            handler = StorletObjectHandler(req, self.conf, self.app,
+                                           mock.MagicMock())
+            return handler.handle_request().body
+
+        with mock.patch.object(StorletGatewayStub, 'invocation_flow',
+                               fake_invocation_flow):
+            requests = [eventlet.spawn(get) for _ in range(2)]
+            self.assertEqual(['FAKE APP', 'FAKE APP'],
+                             [request.wait() for request in requests])
+        self.assertEqual(1, len(sreqs))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -18,8 +18,10 @@ import unittest
 
 from contextlib import contextmanager
 from swift.common.swob import Request, HTTPOk, HTTPCreated, HTTPAccepted, \
-    HTTPNotFound
+    HTTPNoContent, HTTPNotFound
 from storlet_middleware.handlers import StorletProxyHandler
+from storlet_middleware.handlers.proxy import StorletVerificationCache, \
+    _verification_caches
 
 from tests.unit.swift.storlet_middleware.handlers import \
     BaseTestStorletMiddleware, create_handler_config
@@ -40,10 +42,32 @@ def storlet_enabled():
         yield
 
 
+class FakeMemcache(object):
+    def __init__(self):
+        self.store = {}
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, time=0):
+        self.store[key] = value
+
+    def incr(self, key, delta=1, time=0):
+        self.store[key] = self.store.get(key, 0) + delta
+        return self.store[key]
+
+
 class TestStorletMiddlewareProxy(BaseTestStorletMiddleware):
     def setUp(self):
         super(TestStorletMiddlewareProxy, self).setUp()
         self.conf['execution_server'] = 'proxy'
+        self.caches_patcher = mock.patch.dict(_verification_caches,
+                                              clear=True)
+        self.caches_patcher.start()
+
+    def tearDown(self):
+        self.caches_patcher.stop()
+        super(TestStorletMiddlewareProxy, self).tearDown()
 
     def test_GET_without_storlets(self):
         def basic_get(path):
@@ -88,6 +112,69 @@ class TestStorletMiddlewareProxy(BaseTestStorletMiddleware):
             self.assertEqual(target, calls[-1][1])
             self.assertIn('X-Run-Storlet', calls[-1][2])
 
+    def test_GET_with_storlets_verification_cache(self):
+        target = '/v1/AUTH_a/c/o'
+        self.base_app.register('GET', target, HTTPOk, body='FAKE RESULT')
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register('GET', storlet, HTTPOk, headers={},
+                               body='jar binary')
+        self.base_app.register('POST', storlet, HTTPAccepted)
+
+        def get(token):
+            req = Request.blank(
+                target, environ={'REQUEST_METHOD': 'GET'},
+                headers={'X-Run-Storlet': 'Storlet-1.0.jar',
+                         'X-Auth-Token': token})
+            resp = self.get_response(req)
+            self.assertEqual('200 OK', resp.status)
+            self.assertEqual('FAKE RESULT', resp.body)
+
+        with storlet_enabled():
+            get('token1')
+            get('token1')
+            self.assertEqual(1, self.base_app.call_count('HEAD', storlet))
+            self.assertEqual(2, self.base_app.call_count('GET', target))
+
+            # The verification is done per auth identity
+            get('token2')
+            self.assertEqual(2, self.base_app.call_count('HEAD', storlet))
+
+            # Updating the storlet invalidates the verifications
+            def post():
+                req = Request.blank(
+                    storlet, environ={'REQUEST_METHOD': 'POST'},
+                    headers={'X-Object-Meta-Storlet-Language': 'Java',
+                             'X-Object-Meta-Storlet-Interface-Version': '1.0',
+                             'X-Object-Meta-Storlet-Dependency': 'dependency',
+                             'X-Object-Meta-Storlet-Main':
+                                 'org.openstack.storlet.Storlet'})
+                return self.get_response(req).status
+
+            self.assertEqual('202 Accepted', post())
+            get('token1')
+            self.assertEqual(3, self.base_app.call_count('HEAD', storlet))
+
+            # A failed update does not
+            self.base_app.register('POST', storlet, HTTPNotFound)
+            self.assertEqual('404 Not Found', post())
+            get('token1')
+            self.assertEqual(3, self.base_app.call_count('HEAD', storlet))
+
+            # Deleting the storlet invalidates the verifications
+            self.base_app.register('DELETE', storlet, HTTPNoContent)
+            req = Request.blank(storlet, environ={'REQUEST_METHOD': 'DELETE'})
+            self.assertEqual('204 No Content', self.get_response(req).status)
+            get('token1')
+            self.assertEqual(4, self.base_app.call_count('HEAD', storlet))
+
+        # Disabled cache
+        self.base_app.reset_calls()
+        self.conf['storlet_verification_cache_ttl'] = '0'
+        with storlet_enabled():
+            get('token1')
+            get('token1')
+            self.assertEqual(2, self.base_app.call_count('HEAD', storlet))
+
     def test_GET_with_storlets_disabled_account(self):
         target = '/v1/AUTH_a/c/o'
 
@@ -102,6 +189,15 @@ class TestStorletMiddlewareProxy(BaseTestStorletMiddleware):
             calls = self.base_app.get_calls()
             self.assertEqual(0, len(calls))
 
+    def test_DELETE_storlet_disabled_account(self):
+        storlet = '/v1/AUTH_a/storlet/Storlet-1.0.jar'
+        self.base_app.register('DELETE', storlet, HTTPNoContent)
+
+        with fake_acc_info({'meta': {}}):
+            req = Request.blank(storlet, environ={'REQUEST_METHOD': 'DELETE'})
+            self.assertEqual('204 No Content', self.get_response(req).status)
+            self.assertEqual(1, self.base_app.call_count('DELETE', storlet))
+
     def test_GET_with_storlets_object_404(self):
         target = '/v1/AUTH_a/c/o'
         self.base_app.register('GET', target, HTTPNotFound)
@@ -530,5 +626,80 @@ class TestStorletProxyHandler(unittest.TestCase):
         self.assertEqual(headers['X-Object-Meta-Key4'], 'Value4')
 
 
+class TestStorletVerificationCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = StorletVerificationCache(ttl=10, max_entries=2)
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('a', 's', 'id'))
+        self.cache.put('a', 's', 'id', {'Main': 'Storlet'})
+        params = self.cache.get('a', 's', 'id')
+        self.assertEqual({'Main': 'Storlet'}, params)
+        # The cached parameters are not changed by the callers
+        params['Main'] = 'Other'
+        self.assertEqual({'Main': 'Storlet'}, self.cache.get('a', 's', 'id'))
+        self.assertIsNone(self.cache.get('a', 's', 'other'))
+        self.assertEqual({'hits': 2, 'misses': 2, 'invalidations': 0},
+                         self.cache.stats)
+
+    def test_expiry(self):
+        with mock.patch('storlet_middleware.handlers.proxy.time.time',
+                        return_value=100):
+            self.cache.put('a', 's', 'id', {})
+        with mock.patch('storlet_middleware.handlers.proxy.time.time',
+                        return_value=109):
+            self.assertEqual({}, self.cache.get('a', 's', 'id'))
+        with mock.patch('storlet_middleware.handlers.proxy.time.time',
+                        return_value=110):
+            self.assertIsNone(self.cache.get('a', 's', 'id'))
+
+    def test_eviction(self):
+        self.cache.put('a', 's1', 'id', {})
+        self.cache.put('a', 's2', 'id', {})
+        self.cache.get('a', 's1', 'id')
+        self.cache.put('a', 's3', 'id', {})
+        # The least recently used entry is evicted
+        self.assertIsNone(self.cache.get('a', 's2', 'id'))
+        self.assertIsNotNone(self.cache.get('a', 's1', 'id'))
+        self.assertIsNotNone(self.cache.get('a', 's3', 'id'))
+
+    def test_invalidate(self):
+        self.cache.put('a', 's1', 'id1', {})
+        self.cache.put('a', 's2', 'id2', {})
+        self.cache.invalidate('a', 's1')
+        self.assertIsNone(self.cache.get('a', 's1', 'id1'))
+        self.assertIsNotNone(self.cache.get('a', 's2', 'id2'))
+
+    def test_memcache(self):
+        memcache = FakeMemcache()
+        self.cache.put('a', 's', 'id', {'Main': 'Storlet'}, memcache)
+
+        # Another proxy process gets the verification from memcache
+        other = StorletVerificationCache()
+        self.assertEqual({'Main': 'Storlet'},
+                         other.get('a', 's', 'id', memcache))
+        other.invalidate('a', 's', memcache)
+        self.assertIsNone(other.get('a', 's', 'id', memcache))
+
+    def test_memcache_invalidate_other_process(self):
+        memcache = FakeMemcache()
+        other = StorletVerificationCache()
+        self.cache.put('a', 's', 'id', {'Main': 'Storlet'}, memcache)
+        other.put('a', 's', 'id', {'Main': 'Storlet'}, memcache)
+        self.assertIsNotNone(other.get('a', 's', 'id', memcache))
+
+        # The storlet is updated through this process, which invalidates
+        # the verifications kept by the other one
+        self.cache.invalidate('a', 's', memcache)
+        self.assertIsNone(other.get('a', 's', 'id', memcache))
+        self.assertIsNone(self.cache.get('a', 's', 'id', memcache))
+
+        other.put('a', 's', 'id', {'Main': 'Storlet2'}, memcache)
+        self.assertEqual({'Main': 'Storlet2'},
+                         other.get('a', 's', 'id', memcache))
+        self.assertEqual({'Main': 'Storlet2'},
+                         self.cache.get('a', 's', 'id', memcache))
+
+
 if __name__ == '__main__':
     unittest.main()